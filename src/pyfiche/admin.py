@@ -0,0 +1,330 @@
+import argparse
+import datetime
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import FicheServer
+from .classes.index import PasteIndex, PasteInfo, batched
+from .classes.reaper import Reaper
+from .classes.storage import CODECS, PasteStorage
+
+
+def compress(args: argparse.Namespace) -> int:
+    storage = PasteStorage(args.data_dir, shard_depth=args.shard_depth)
+    pastes = before = after = 0
+
+    def compress_paste(slug):
+        try:
+            return storage.compress(slug, args.compression)
+        except OSError as e:
+            print(f"Could not compress {slug}: {e}", file=sys.stderr)
+
+    # zlib and lzma release the GIL while compressing, so threads are enough
+    with ThreadPoolExecutor(args.jobs) as executor:
+        for result in executor.map(compress_paste, storage.slugs()):
+            if result is None:
+                continue
+
+            pastes += 1
+            before += result[0]
+            after += result[1]
+
+    saved = (1 - after / before) * 100 if before else 0
+    print(
+        f"Compressed {pastes} pastes with {args.compression}: "
+        f"{before} -> {after} bytes ({saved:.1f}% saved)"
+    )
+
+    return 0
+
+
+def remove(args: argparse.Namespace) -> int:
+    storage = PasteStorage(args.data_dir, shard_depth=args.shard_depth)
+    index = PasteIndex(args.index) if args.index else None
+    status = 0
+
+    for slug in args.slugs:
+        # Same check as in Recup and Lines, so nothing outside the data
+        # directory can be removed
+        valid = slug and all(c in FicheServer.FICHE_SYMBOLS for c in slug)
+
+        if not valid or not storage.remove(slug):
+            print(f"Paste {slug} not found", file=sys.stderr)
+            status = 1
+
+        if valid and index:
+            index.remove(slug)
+
+    return status
+
+
+def collect(args: argparse.Namespace) -> int:
+    storage = PasteStorage(args.data_dir, shard_depth=args.shard_depth)
+    print(f"Removed {storage.collect()} unused blobs")
+    removed = storage.cleanup(FicheServer.STALE_UPLOAD_AGE)
+    print(f"Removed {removed} stale temporary files")
+    return 0
+
+
+def reshard(args: argparse.Namespace) -> int:
+    if not args.shard_depth:
+        print("Set the shard depth to migrate to with -n", file=sys.stderr)
+        return 1
+
+    storage = PasteStorage(args.data_dir, shard_depth=args.shard_depth)
+
+    def migrate_paste(slug):
+        try:
+            return storage.migrate(slug)
+        except OSError as e:
+            print(f"Could not move {slug}: {e}", file=sys.stderr)
+            return False
+
+    with ThreadPoolExecutor(args.jobs) as executor:
+        moved = sum(executor.map(migrate_paste, storage.flat_slugs()))
+
+    print(f"Moved {moved} pastes to a shard depth of {args.shard_depth}")
+    return 0
+
+
+def scan_parallel(storage: PasteStorage, executor: ThreadPoolExecutor):
+    # Lists the shard directories in parallel; flat pastes come first
+    shards = []
+
+    with os.scandir(storage.root) as entries:
+        for entry in entries:
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+
+            if storage.shard_depth and len(entry.name) == storage.SHARD_WIDTH:
+                shards.append(
+                    executor.submit(
+                        lambda path: list(storage.scan(path, storage.shard_depth - 1)),
+                        entry.path,
+                    )
+                )
+            else:
+                yield entry.name
+
+    for shard in shards:
+        yield from shard.result()
+
+    if storage.segments:
+        yield from storage.segments.slugs()
+
+
+def compact(args: argparse.Namespace) -> int:
+    storage = PasteStorage(args.data_dir, shard_depth=args.shard_depth)
+
+    if not storage.segments:
+        print("No pastes are stored in segments", file=sys.stderr)
+        return 1
+
+    started = time.monotonic()
+    compacted, reclaimed = storage.segments.compact(args.max_usage)
+    count, size, used = storage.segments.stats()
+
+    print(
+        f"Compacted {compacted} segments in {time.monotonic() - started:.2f} "
+        f"seconds, reclaiming {reclaimed} bytes"
+    )
+    print(f"{count} segments: {size} bytes, {used} bytes in use")
+    return 0
+
+
+def reindex(args: argparse.Namespace) -> int:
+    if not args.index:
+        print("Set the index to rebuild with -i", file=sys.stderr)
+        return 1
+
+    storage = PasteStorage(args.data_dir, shard_depth=args.shard_depth)
+    index = PasteIndex(args.index)
+
+    def describe(slug):
+        try:
+            paste = storage.find(slug)
+            return PasteInfo.from_paste(paste) if paste else None
+        except OSError as e:
+            print(f"Could not read {slug}: {e}", file=sys.stderr)
+
+    def describe_all(executor):
+        # In batches, so millions of pastes don't turn into millions of
+        # pending futures
+        for slugs in batched(scan_parallel(storage, executor), 1000):
+            yield from filter(None, executor.map(describe, slugs))
+
+    with ThreadPoolExecutor(args.jobs) as executor:
+        count = index.rebuild(describe_all(executor))
+
+    print(f"Indexed {count} pastes in {args.index}")
+    return 0
+
+
+def reap(args: argparse.Namespace) -> int:
+    if not args.index:
+        print("Set the index to find expired pastes in with -i", file=sys.stderr)
+        return 1
+
+    storage = PasteStorage(args.data_dir, shard_depth=args.shard_depth)
+    reaper = Reaper(
+        storage, PasteIndex(args.index), batch_size=args.batch_size, pause=args.pause
+    )
+
+    started = time.monotonic()
+    count = reaper.reap()
+    elapsed = time.monotonic() - started
+
+    print(
+        f"Removed {count} expired pastes in {elapsed:.2f} seconds "
+        f"({count / elapsed if elapsed else 0:.0f} pastes/s)"
+    )
+    return 0
+
+
+def stats(args: argparse.Namespace) -> int:
+    if not args.index:
+        print("Set the index to read with -i", file=sys.stderr)
+        return 1
+
+    index = PasteIndex(args.index)
+    count, size, oldest, newest = index.stats()
+
+    print(f"Pastes: {count}")
+    print(f"Total size: {size} bytes")
+
+    if count:
+        print(f"Oldest: {datetime.datetime.fromtimestamp(oldest)}")
+        print(f"Newest: {datetime.datetime.fromtimestamp(newest)}")
+
+    print(f"Complete: {'yes' if index.complete else 'no (run reindex)'}")
+    return 0
+
+
+# Define the main function
+def main():
+    # Create an argument parser
+    parser = argparse.ArgumentParser(
+        description="PyFiche Admin - maintenance commands for a PyFiche data directory"
+    )
+    parser.add_argument(
+        "-o", "--data_dir", help="Fiche server output directory path (default: data/)"
+    )
+    parser.add_argument(
+        "-n",
+        "--shard_depth",
+        type=int,
+        help="Number of directory levels pastes are spread over (default: 0)",
+    )
+    parser.add_argument(
+        "-i", "--index", help="SQLite paste index (default: None - no index)"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="Number of pastes processed in parallel (default: number of CPUs)",
+    )
+
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    compress_parser = commands.add_parser(
+        "compress", help="Compress all uncompressed pastes"
+    )
+    compress_parser.add_argument(
+        "-z",
+        "--compression",
+        choices=tuple(CODECS),
+        help="Codec to compress pastes with (default: zlib)",
+    )
+    compress_parser.set_defaults(func=compress)
+
+    remove_parser = commands.add_parser(
+        "remove", help="Remove pastes, and their blobs if no other paste uses them"
+    )
+    remove_parser.add_argument("slugs", nargs="+", metavar="slug")
+    remove_parser.set_defaults(func=remove)
+
+    collect_parser = commands.add_parser(
+        "gc", help="Remove blobs no paste uses any more and stale temporary files"
+    )
+    collect_parser.set_defaults(func=collect)
+
+    reshard_parser = commands.add_parser(
+        "reshard",
+        help="Move pastes from the flat layout into shard directories (set -n); "
+        "start the servers with the same -n first",
+    )
+    reshard_parser.set_defaults(func=reshard)
+
+    compact_parser = commands.add_parser(
+        "compact", help="Reclaim the space of removed pastes in segment files"
+    )
+    compact_parser.add_argument(
+        "-u",
+        "--max_usage",
+        type=float,
+        default=0.5,
+        help="Rewrite segments of which at most this share is in use (default: 0.5)",
+    )
+    compact_parser.set_defaults(func=compact)
+
+    reindex_parser = commands.add_parser(
+        "reindex", help="Rebuild the paste index (set -i) from the data directory"
+    )
+    reindex_parser.set_defaults(func=reindex)
+
+    reap_parser = commands.add_parser(
+        "reap", help="Remove expired pastes now instead of waiting for the servers"
+    )
+    reap_parser.add_argument(
+        "-b",
+        "--batch_size",
+        type=int,
+        default=100,
+        help="Number of pastes removed between pauses (default: 100)",
+    )
+    reap_parser.add_argument(
+        "-p",
+        "--pause",
+        type=float,
+        default=0.1,
+        help="Pause between batches (in seconds) (default: 0.1)",
+    )
+    reap_parser.set_defaults(func=reap)
+
+    stats_parser = commands.add_parser(
+        "stats", help="Show the number, size and age of the pastes in the index"
+    )
+    stats_parser.set_defaults(func=stats)
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # Get environment variables
+    data_dir = os.environ.get("PYFICHE_DATA_DIR", "data/")
+    shard_depth = os.environ.get("PYFICHE_SHARD_DEPTH", 0)
+    index = os.environ.get("PYFICHE_INDEX", None)
+    compression = os.environ.get("PYFICHE_COMPRESSION", "none")
+
+    # Set the arguments
+    args.data_dir = args.data_dir or data_dir
+    args.shard_depth = args.shard_depth or int(shard_depth)
+    args.index = args.index or index
+    args.jobs = args.jobs or os.cpu_count() or 1
+
+    if args.command == "compress" and not args.compression:
+        args.compression = compression if compression in CODECS else "zlib"
+
+    if not os.path.isdir(args.data_dir):
+        print(f"Data directory ({args.data_dir}) does not exist!", file=sys.stderr)
+        return 1
+
+    return args.func(args)
+
+
+# Check if the script is run directly
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+import argparse
+import sys
+import os
+
+from . import CombinedServer, FicheServer
+
+# Define the main function
+def main():
+    # Create an argument parser
+    parser = argparse.ArgumentParser(description='PyFiche All - run the Fiche, Recup and Lines servers in one process')
+
+    # Add arguments to the parser
+    parser.add_argument('-p', '--fiche_port', type=int, help='Port of Fiche server (default: 9999)')
+    parser.add_argument('-u', '--recup_port', type=int, help='Port of Recup server (default: 9998)')
+    parser.add_argument('-H', '--lines_port', type=int, help='Port of Lines server (default: 9997)')
+    parser.add_argument('-d', '--domain', help='Domain to use in URLs (default: localhost)')
+    parser.add_argument('-L', '--listen_addr', help='Listen Address (default: 0.0.0.0)')
+    parser.add_argument('-s', '--slug_size', type=int, help='Length of slugs to generate (default: 8)')
+    parser.add_argument('-S', '--https', action='store_true', help='HTTPS (requires reverse proxy)')
+    parser.add_argument('-o', '--data_dir', help='Data directory path (default: data/)')
+    parser.add_argument('-M', '--max_size', type=int, help='Maximum file size (in bytes) (default: 5242880)')
+    parser.add_argument('-l', '--log_file', help='Log file path (default: None - log to stdout)')
+    parser.add_argument('-b', '--banlist', help='Banlist file path')
+    parser.add_argument('-w', '--allowlist', help='Allowlist file path')
+    parser.add_argument('-D', '--debug', action='store_true', help='Debug mode')
+    parser.add_argument('-t', '--timeout', type=float, help='Maximum idle time before an upload is considered complete (in seconds) (default: 3)')
+    parser.add_argument('-m', '--min_timeout', type=float, help='Minimum idle time once a client has started sending data (in seconds) (default: 1)')
+    parser.add_argument('-T', '--deadline', type=float, help='Maximum total duration of an upload (in seconds), 0 to disable (default: 60)')
+    parser.add_argument('-e', '--engine', choices=FicheServer.ENGINES, help='Connection engine of Fiche and Recup (default: threading)')
+    parser.add_argument('-c', '--max_connections', type=int, help='Maximum number of connections handled at once, per server (default: 64)')
+    parser.add_argument('-q', '--queue_size', type=int, help='Maximum number of connections waiting to be handled, per server (default: 128)')
+    parser.add_argument('-I', '--max_inflight', type=int, help='Maximum number of Fiche upload bytes held in memory across all connections, 0 to disable (default: 104857600)')
+    parser.add_argument('-k', '--keepalive_timeout', type=float, help='Time after which idle keep-alive connections to Lines are closed (in seconds) (default: 5)')
+    parser.add_argument('-C', '--cache_size', type=int, help='Maximum size of the in-memory cache of pastes and pages shared by all servers (in bytes), 0 to disable (default: 67108864)')
+    parser.add_argument('-z', '--compression', choices=FicheServer.COMPRESSION_CODECS, help='Compress pastes on disk with this codec (default: none)')
+    parser.add_argument('-x', '--dedup', action='store_true', help='Store identical pastes only once')
+    parser.add_argument('-n', '--shard_depth', type=int, help='Number of directory levels pastes are spread over, 0 for a flat layout (default: 0)')
+    parser.add_argument('-i', '--index', help='SQLite database to record paste metadata in (default: None - no index)')
+    parser.add_argument('-g', '--segment_max', type=int, help='Append pastes up to this size (in bytes) to shared segment files instead of storing each in its own directory, 0 to disable (default: 0)')
+    parser.add_argument('-E', '--expiry', type=int, help='Time after which pastes expire (in seconds), requires an index, 0 to keep pastes forever (default: 0)')
+    parser.add_argument('-R', '--reap_interval', type=float, help='Time between removals of expired pastes (in seconds), 0 to disable (default: 60)')
+    parser.add_argument('-P', '--metrics_port', type=int, help='Serve Prometheus metrics of all servers on this port of 127.0.0.1 (default: None - no metrics)')
+    parser.add_argument('-A', '--metrics_path', help='Also serve Prometheus metrics on this path of the Lines server, e.g. /metrics (default: None)')
+    parser.add_argument('-r', '--rate_limit', type=float, help='Maximum number of requests per second per client address and server, with bursts of up to 10 seconds worth (default: 0 - no limit)')
+    parser.add_argument('-y', '--byte_rate_limit', type=int, help='Maximum number of uploaded and downloaded bytes per second per client address and server (default: 0 - no limit)')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # Get environment variables
+    fiche_port = os.environ.get('PYFICHE_PORT', 9999)
+    recup_port = os.environ.get('PYFICHE_RECUP_PORT', 9998)
+    lines_port = os.environ.get('PYFICHE_LINES_PORT', 9997)
+    domain = os.environ.get('PYFICHE_DOMAIN', 'localhost')
+    listen_addr = os.environ.get('PYFICHE_LISTEN_ADDR', '0.0.0.0')
+    slug_size = os.environ.get('PYFICHE_SLUG_SIZE', 8)
+    https = os.environ.get('PYFICHE_HTTPS', False)
+    data_dir = os.environ.get('PYFICHE_DATA_DIR', os.environ.get('PYFICHE_OUTPUT_DIR', 'data/'))
+    max_size = os.environ.get('PYFICHE_MAX_SIZE', 5242880)
+    log_file = os.environ.get('PYFICHE_LOG_FILE', None)
+    banlist = os.environ.get('PYFICHE_BANLIST', None)
+    allowlist = os.environ.get('PYFICHE_ALLOWLIST', None)
+    debug = os.environ.get('PYFICHE_DEBUG', False)
+    timeout = os.environ.get('PYFICHE_TIMEOUT', None)
+    min_timeout = os.environ.get('PYFICHE_MIN_TIMEOUT', None)
+    deadline = os.environ.get('PYFICHE_DEADLINE', None)
+    engine = os.environ.get('PYFICHE_ENGINE', 'threading')
+    max_connections = os.environ.get('PYFICHE_MAX_CONNECTIONS', 64)
+    queue_size = os.environ.get('PYFICHE_QUEUE_SIZE', 128)
+    max_inflight = os.environ.get('PYFICHE_MAX_INFLIGHT', 104857600)
+    keepalive_timeout = os.environ.get('PYFICHE_LINES_KEEPALIVE_TIMEOUT', 5)
+    cache_size = os.environ.get('PYFICHE_CACHE_SIZE', 67108864)
+    compression = os.environ.get('PYFICHE_COMPRESSION', 'none')
+    dedup = os.environ.get('PYFICHE_DEDUP', False)
+    shard_depth = os.environ.get('PYFICHE_SHARD_DEPTH', 0)
+    index = os.environ.get('PYFICHE_INDEX', None)
+    segment_max = os.environ.get('PYFICHE_SEGMENT_MAX', 0)
+    expiry = os.environ.get('PYFICHE_EXPIRY', 0)
+    reap_interval = os.environ.get('PYFICHE_REAP_INTERVAL', None)
+    metrics_port = os.environ.get('PYFICHE_METRICS_PORT', 0)
+    metrics_path = os.environ.get('PYFICHE_LINES_METRICS_PATH', None)
+    rate_limit = os.environ.get('PYFICHE_RATE_LIMIT', 0)
+    byte_rate_limit = os.environ.get('PYFICHE_BYTE_RATE_LIMIT', 0)
+
+    # Set the arguments
+    args.fiche_port = args.fiche_port or int(fiche_port)
+    args.recup_port = args.recup_port or int(recup_port)
+    args.lines_port = args.lines_port or int(lines_port)
+    args.domain = args.domain or domain
+    args.listen_addr = args.listen_addr or listen_addr
+    args.slug_size = args.slug_size or int(slug_size)
+    args.https = args.https or bool(https)
+    args.data_dir = args.data_dir or data_dir
+    args.max_size = args.max_size or int(max_size)
+    args.log_file = args.log_file or log_file
+    args.banlist = args.banlist or banlist
+    args.allowlist = args.allowlist or allowlist
+    args.debug = args.debug or bool(debug)
+    args.timeout = args.timeout or (float(timeout) if timeout else None)
+    args.min_timeout = args.min_timeout or (float(min_timeout) if min_timeout else None)
+    args.deadline = args.deadline if args.deadline is not None else (float(deadline) if deadline else None)
+    args.engine = args.engine or engine
+    args.max_connections = args.max_connections or int(max_connections)
+    args.queue_size = args.queue_size or int(queue_size)
+    args.max_inflight = args.max_inflight if args.max_inflight is not None else int(max_inflight)
+    args.keepalive_timeout = args.keepalive_timeout or float(keepalive_timeout)
+    args.cache_size = args.cache_size if args.cache_size is not None else int(cache_size)
+    args.compression = args.compression or compression
+    args.dedup = args.dedup or bool(dedup)
+    args.shard_depth = args.shard_depth or int(shard_depth)
+    args.index = args.index or index
+    args.segment_max = args.segment_max or int(segment_max)
+    args.expiry = args.expiry or int(expiry)
+    args.reap_interval = args.reap_interval if args.reap_interval is not None else (float(reap_interval) if reap_interval else None)
+    args.metrics_port = args.metrics_port or int(metrics_port)
+    args.metrics_path = args.metrics_path or metrics_path
+    args.rate_limit = args.rate_limit or float(rate_limit)
+    args.byte_rate_limit = args.byte_rate_limit or int(byte_rate_limit)
+
+    # Create the servers
+    combined = CombinedServer.from_args(args)
+
+    # Run them until one of them stops
+    sys.exit(combined.run())
+
+# Check if the script is run directly
+if __name__ == '__main__':
+    main()
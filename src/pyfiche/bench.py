@@ -0,0 +1,1138 @@
+import argparse
+import datetime
+import http.client
+import ipaddress
+import json
+import os
+import platform
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+from .classes.fiche import FicheServer
+from .classes.ipfilter import IPFilter
+from .classes.slugs import SlugAllocator
+from .classes.storage import PasteStorage
+
+WORKLOADS = (
+    "upload",
+    "recup",
+    "lines-html",
+    "lines-raw",
+    "lines-html-gzip",
+    "lines-raw-gzip",
+    "lines-post",
+    "lines-form",
+)
+SERVERS = {
+    "fiche": "pyfiche.fiche_server",
+    "recup": "pyfiche.recup_server",
+    "lines": "pyfiche.lines_server",
+}
+# In-process benchmarks of single components, run with -m instead
+MICRO = ("ipfilter", "storage", "slugs")
+# Paste layouts of the storage benchmark: shard depth and whether pastes go
+# to segments
+LAYOUTS = {
+    "flat": (0, False),
+    "sharded": (1, False),
+    "segments": (0, True),
+}
+# Server each workload is sent to
+TARGETS = {
+    "upload": "fiche",
+    "recup": "recup",
+    "lines-html": "lines",
+    "lines-raw": "lines",
+    "lines-html-gzip": "lines",
+    "lines-raw-gzip": "lines",
+    "lines-post": "lines",
+    "lines-form": "lines",
+}
+PAYLOADS = ("text", "log")
+# Request headers of clients that accept compressed responses
+GZIP_HEADERS = {"Accept-Encoding": "gzip"}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def proc_status(pid: int) -> Dict[str, int]:
+    # Peak RSS (in kB) and thread count, where /proc is available
+    status = {}
+
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("VmHWM", "Threads"):
+                    status[key] = int(value.split()[0])
+    except OSError:
+        pass
+
+    return status
+
+
+def process_tree(pid: int) -> List[int]:
+    # The process and its children, e.g. prefork workers
+    pids = [pid]
+
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for child in f.read().split():
+                pids.extend(process_tree(int(child)))
+    except OSError:
+        pass
+
+    return pids
+
+
+def proc_cpu_time(pid: int) -> Optional[float]:
+    # User and system CPU time (in seconds), where /proc is available
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The command name may contain spaces, fields follow its ")"
+            fields = f.read().rpartition(")")[2].split()
+    except OSError:
+        return None
+
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def tree_status(pid: int) -> Dict[str, int]:
+    # Peak RSS and thread count of the process and its children, added up
+    total: Dict[str, int] = {}
+
+    for process in process_tree(pid):
+        for key, value in proc_status(process).items():
+            total[key] = total.get(key, 0) + value
+
+    return total
+
+
+def open_stalled(port: int, count: int) -> List[socket.socket]:
+    # Connections that send the start of a request and then nothing, like
+    # a slow or stuck client
+    stalled = []
+
+    for _ in range(count):
+        sock = socket.create_connection(("127.0.0.1", port), 5.0)
+        sock.sendall(b"GET / HTTP/1.1\r\n")
+        stalled.append(sock)
+
+    return stalled
+
+
+def percentile(values: List[float], pct: float) -> float:
+    # Nearest-rank percentile of sorted values
+    if not values:
+        return 0.0
+
+    rank = max(int(len(values) * pct / 100 + 0.5), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+class Server:
+    """A PyFiche server running as a process of its own."""
+
+    def __init__(self, name: str, args: List[str], data_dir: str, log_dir: str):
+        self.name = name
+        self.port = free_port()
+        self.log_file = os.path.join(log_dir, f"{name}.log")
+        data_flag = "--output_dir" if name == "fiche" else "--data_dir"
+        command = [
+            sys.executable,
+            "-m",
+            SERVERS[name],
+            "--listen_addr",
+            "127.0.0.1",
+            "--port",
+            str(self.port),
+            data_flag,
+            data_dir,
+            "--log_file",
+            self.log_file,
+            *args,
+        ]
+        # Access logs of http.server go to stderr, regardless of --log_file
+        with open(os.path.join(log_dir, f"{name}.out"), "wb") as output:
+            self.process = subprocess.Popen(
+                command,
+                stdin=subprocess.DEVNULL,
+                stdout=output,
+                stderr=subprocess.STDOUT,
+            )
+        self.peak_threads = 0
+        self.peak_rss = 0
+
+    def wait(self, timeout: float = 10.0) -> None:
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(
+                    f"{self.name} exited with {self.process.returncode}, "
+                    f"see {self.log_file}"
+                )
+
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 0.1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+
+        raise RuntimeError(f"{self.name} did not start within {timeout} seconds")
+
+    def sample(self) -> None:
+        status = tree_status(self.process.pid)
+        self.peak_threads = max(self.peak_threads, status.get("Threads", 0))
+        self.peak_rss = max(self.peak_rss, status.get("VmHWM", 0))
+
+    def cpu_time(self) -> Optional[float]:
+        # CPU time of the server and its workers so far
+        times = [proc_cpu_time(pid) for pid in process_tree(self.process.pid)]
+
+        if None in times:
+            return None
+
+        return sum(times)
+
+    def stats(self) -> Dict[str, Optional[int]]:
+        return {
+            "peak_rss_kb": self.peak_rss or None,
+            "peak_threads": self.peak_threads or None,
+        }
+
+    def stop(self) -> None:
+        self.process.terminate()
+
+        try:
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+class Client:
+    """Requests of every workload, made by one benchmark thread."""
+
+    def __init__(self, ports: Dict[str, int], timeout: float):
+        self.ports = ports
+        self.timeout = timeout
+        # Response bytes received, headers of HTTP responses left out
+        self.received = 0
+        self._http: Optional[http.client.HTTPConnection] = None
+        self._encoding: Optional[str] = None
+
+    def upload(self, data: bytes) -> str:
+        # Like `nc -N`: send everything, shut down the sending side, read the URL
+        with socket.create_connection(
+            ("127.0.0.1", self.ports["fiche"]), self.timeout
+        ) as sock:
+            sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+            url = self._read_all(sock).decode().strip()
+
+        if not url.startswith("http"):
+            raise RuntimeError(f"Upload failed: {url!r}")
+
+        return url.rsplit("/", 1)[-1]
+
+    def recup(self, slug: str, size: int) -> None:
+        with socket.create_connection(
+            ("127.0.0.1", self.ports["recup"]), self.timeout
+        ) as sock:
+            sock.sendall(slug.encode() + b"\n")
+            received = len(self._read_all(sock))
+
+        if received < size:
+            raise RuntimeError(f"Received {received} of {size} bytes of {slug}")
+
+    def lines_html(self, slug: str, size: int, headers=None) -> None:
+        self._request("GET", f"/{slug}", headers=headers)
+
+    def lines_raw(self, slug: str, size: int, headers=None) -> None:
+        body = self._request("GET", f"/{slug}/raw", headers=headers)
+        received = len(body)
+
+        # Compressed responses are checked by the uncompressed size in the
+        # gzip trailer. Decompressing them would take the client longer than
+        # the server takes to answer, and on few cores slow the server down.
+        if headers and self._encoding == "gzip":
+            received = int.from_bytes(body[-4:], "little")
+
+        if received != size:
+            raise RuntimeError(f"Received {received} of {size} bytes of {slug}")
+
+    def lines_post(self, data: bytes) -> None:
+        self._request(
+            "POST",
+            "/",
+            data,
+            {"Content-Type": "application/octet-stream"},
+            expect=303,
+        )
+
+    def lines_form(self, data: bytes) -> None:
+        # Like a browser submitting the upload form with a file
+        boundary = "pyfiche-bench-boundary"
+        body = b"".join(
+            [
+                f"--{boundary}\r\n".encode(),
+                b"Content-Disposition: form-data; "
+                b'name="file"; filename="paste.txt"\r\n',
+                b"Content-Type: text/plain\r\n\r\n",
+                data,
+                f"\r\n--{boundary}--\r\n".encode(),
+            ]
+        )
+        self._request(
+            "POST",
+            "/",
+            body,
+            {"Content-Type": f"multipart/form-data; boundary={boundary}"},
+            expect=303,
+        )
+
+    def close(self) -> None:
+        if self._http:
+            self._http.close()
+            self._http = None
+
+    def _request(self, method, path, body=None, headers=None, expect=200) -> bytes:
+        # One keep-alive connection per thread, like a browser tab
+        if self._http is None:
+            self._http = http.client.HTTPConnection(
+                "127.0.0.1", self.ports["lines"], timeout=self.timeout
+            )
+
+        try:
+            self._http.request(method, path, body, headers or {})
+            response = self._http.getresponse()
+            data = response.read()
+            self.received += len(data)
+            self._encoding = response.getheader("Content-Encoding")
+        except (OSError, http.client.HTTPException):
+            self.close()
+            raise
+
+        if response.will_close:
+            self.close()
+
+        if response.status != expect:
+            raise RuntimeError(f"{method} {path} returned {response.status}")
+
+        return data
+
+    def _read_all(self, sock: socket.socket) -> bytes:
+        chunks = []
+
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                return b"".join(chunks)
+            self.received += len(chunk)
+            chunks.append(chunk)
+
+
+def run_workload(
+    request: Callable[[Client], None],
+    ports: Dict[str, int],
+    concurrency: int,
+    duration: float,
+    requests: int,
+    timeout: float,
+) -> Dict[str, object]:
+    # Runs request from concurrency threads until duration has passed or
+    # requests have been made, whichever comes first
+    latencies: List[List[float]] = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    received = [0] * concurrency
+    error_samples: List[str] = []
+    counter = iter(range(requests)) if requests else None
+    lock = threading.Lock()
+    start = threading.Barrier(concurrency + 1)
+    deadline = 0.0
+
+    def worker(number: int) -> None:
+        client = Client(ports, timeout)
+        start.wait()
+
+        try:
+            while time.monotonic() < deadline:
+                if counter is not None:
+                    with lock:
+                        if next(counter, None) is None:
+                            break
+
+                began = time.perf_counter()
+
+                try:
+                    request(client)
+                except Exception as e:
+                    errors[number] += 1
+                    if len(error_samples) < 5:
+                        error_samples.append(str(e))
+                    continue
+
+                latencies[number].append(time.perf_counter() - began)
+        finally:
+            client.close()
+            received[number] = client.received
+
+    threads = [
+        threading.Thread(target=worker, args=(number,), daemon=True)
+        for number in range(concurrency)
+    ]
+
+    for thread in threads:
+        thread.start()
+
+    began = time.monotonic()
+    deadline = began + duration
+    start.wait()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.monotonic() - began
+    merged = sorted(latency for worker in latencies for latency in worker)
+
+    return {
+        "requests": len(merged),
+        "errors": sum(errors),
+        "error_samples": error_samples,
+        "elapsed": elapsed,
+        "throughput": len(merged) / elapsed if elapsed else 0.0,
+        "received_bytes": sum(received),
+        "bytes_per_request": sum(received) / len(merged) if merged else 0.0,
+        "mb_per_s": sum(received) / 1e6 / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(merged, 50) * 1000,
+        "p95_ms": percentile(merged, 95) * 1000,
+        "p99_ms": percentile(merged, 99) * 1000,
+        "max_ms": (merged[-1] if merged else 0.0) * 1000,
+    }
+
+
+def payload(size: int, kind: str = "text") -> bytes:
+    # Text, so Lines renders it as a paste rather than a binary download
+    if kind == "log":
+        return log_payload(size)
+
+    line = b"The quick brown fox jumps over the lazy dog. 0123456789\n"
+    return (line * (size // len(line) + 1))[:size]
+
+
+def log_payload(size: int) -> bytes:
+    # Lines like those of a web server log: rising timestamps, a few dozen
+    # clients and paths. Compresses to about a seventh with gzip.
+    rng = random.Random(size)
+    clients = [random_address(rng, 4) for _ in range(32)]
+    paths = ("/", "/raw", "/static/style.css", "/favicon.ico", "/api/v1/items")
+    lines = []
+    length = 0
+    ms = 0
+
+    while length < size:
+        ms += rng.randint(0, 2000)
+        line = (
+            f"2024-05-{1 + ms // 86400000:02} "
+            f"{ms // 3600000 % 24:02}:{ms // 60000 % 60:02}:{ms // 1000 % 60:02}"
+            f".{ms % 1000:03} INFO {rng.choice(clients)} "
+            f"\"GET {rng.choice(paths)} HTTP/1.1\" "
+            f"{rng.choice((200, 200, 200, 304, 404))} {rng.randint(0, 9999)}\n"
+        ).encode()
+        lines.append(line)
+        length += len(line)
+
+    return b"".join(lines)[:size]
+
+
+def make_request(workload: str, size: int, slugs: List[str], kind: str = "text"):
+    data = payload(size, kind)
+    position = iter(range(sys.maxsize))
+
+    def next_slug() -> str:
+        # Spread fetches over all seeded pastes
+        return slugs[next(position) % len(slugs)]
+
+    if workload == "upload":
+        return lambda client: client.upload(data)
+    if workload == "recup":
+        return lambda client: client.recup(next_slug(), size)
+    if workload == "lines-html":
+        return lambda client: client.lines_html(next_slug(), size)
+    if workload == "lines-raw":
+        return lambda client: client.lines_raw(next_slug(), size)
+    if workload == "lines-html-gzip":
+        return lambda client: client.lines_html(next_slug(), size, GZIP_HEADERS)
+    if workload == "lines-raw-gzip":
+        return lambda client: client.lines_raw(next_slug(), size, GZIP_HEADERS)
+    if workload == "lines-post":
+        return lambda client: client.lines_post(data)
+    if workload == "lines-form":
+        return lambda client: client.lines_form(data)
+
+    raise ValueError(f"Unknown workload {workload}")
+
+
+def print_results(results: List[Dict[str, object]], baseline=None) -> None:
+    previous = {}
+
+    for result in (baseline or {}).get("results", []):
+        previous[(result["workload"], result["size"])] = result
+
+    header = (
+        f"{'workload':<16} {'size':>9} {'req/s':>9} {'MB/s':>8} {'B/req':>9} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'CPU us':>8} {'errors':>6}"
+    )
+    print(header)
+    print("-" * len(header))
+
+    for result in results:
+        cpu = result["cpu_us_per_request"]
+        line = (
+            f"{result['workload']:<16} {result['size']:>9} "
+            f"{result['throughput']:>9.1f} {result['mb_per_s']:>8.1f} "
+            f"{result['bytes_per_request']:>9.0f} {result['p50_ms']:>8.2f} "
+            f"{result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+            f"{cpu if cpu is not None else float('nan'):>8.0f} "
+            f"{result['errors']:>6}"
+        )
+
+        old = previous.get((result["workload"], result["size"]))
+        if old and old["throughput"] and old["p50_ms"]:
+            line += (
+                f"  req/s {result['throughput'] / old['throughput'] - 1:+.1%}"
+                f", p50 {result['p50_ms'] / old['p50_ms'] - 1:+.1%}"
+            )
+
+        print(line)
+
+
+def random_address(rng: random.Random, version: int) -> str:
+    if version == 4:
+        return str(ipaddress.IPv4Address(rng.getrandbits(32)))
+    return str(ipaddress.IPv6Address(rng.getrandbits(128)))
+
+
+def linear_lookup(path: str, addr: str) -> bool:
+    # How ban and allow lists were checked before IPFilter: the whole file
+    # parsed again for every connection
+    ip = ipaddress.ip_address(addr)
+
+    with open(path) as file:
+        for line in file:
+            line = line.strip()
+            if line and ip in ipaddress.ip_network(line, strict=False):
+                return True
+
+    return False
+
+
+def micro_ipfilter(args: argparse.Namespace) -> Dict[str, object]:
+    # A list of -e entries, half IPv4 /24 and half IPv6 /64 networks,
+    # checked against random addresses of both families
+    rng = random.Random(0)
+
+    with tempfile.TemporaryDirectory(prefix="pyfiche-bench-") as temp:
+        path = os.path.join(temp, "banlist.txt")
+
+        with open(path, "w") as file:
+            for number in range(args.entries):
+                addr = random_address(rng, 4 if number % 2 else 6)
+                prefix = 24 if number % 2 else 64
+                network = ipaddress.ip_network(f"{addr}/{prefix}", strict=False)
+                file.write(f"{network}\n")
+
+        addrs = [random_address(rng, rng.choice((4, 6))) for _ in range(100000)]
+        ipfilter = IPFilter(path)
+
+        began = time.perf_counter()
+        ipfilter.load()
+        compile_s = time.perf_counter() - began
+        ipfilter.reload_if_changed()
+
+        began = time.perf_counter()
+        for addr in addrs:
+            _ = addr in ipfilter
+        lookup_s = time.perf_counter() - began
+
+        linear = addrs[: args.linear]
+        began = time.perf_counter()
+        for addr in linear:
+            linear_lookup(path, addr)
+        linear_s = time.perf_counter() - began
+
+    return {
+        "entries": args.entries,
+        "compile_s": compile_s,
+        "lookups_per_s": len(addrs) / lookup_s,
+        "linear_lookup_s": linear_s / len(linear) if linear else None,
+    }
+
+
+def disk_usage(root: str) -> Tuple[int, int]:
+    # Bytes allocated on disk and inodes used by a directory tree
+    allocated = inodes = 0
+
+    for directory, dirs, files in os.walk(root):
+        for name in [".", *files]:
+            allocated += os.lstat(os.path.join(directory, name)).st_blocks * 512
+            inodes += 1
+
+    return allocated, inodes
+
+
+def micro_storage(args: argparse.Namespace) -> Dict[str, object]:
+    # Writes --pastes log-like pastes of random sizes through PasteStorage
+    # in every layout and with every codec of -z, then reads a sample of
+    # them back. Every run gets the same pastes. With segments, it also
+    # removes --remove of them and compacts the segments.
+    rng = random.Random(0)
+    low, high = (int(size) for size in args.paste_sizes.split(","))
+    # Pastes are slices of one large log, so generating them takes no time
+    log = log_payload(max(high * 4, 4194304))
+    symbols = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+    pastes: Dict[str, Tuple[int, int]] = {}
+
+    while len(pastes) < args.pastes:
+        size = rng.randint(low, high)
+        offset = rng.randint(0, len(log) - size)
+        pastes["".join(rng.choices(symbols, k=8))] = (offset, size)
+
+    slugs = list(pastes)
+    reads = rng.sample(slugs, min(len(slugs), args.reads))
+    results = {
+        "pastes": len(pastes),
+        "bytes": sum(size for _, size in pastes.values()),
+    }
+
+    for layout in args.layouts.split(","):
+        if layout not in LAYOUTS:
+            raise SystemExit(f"Unknown layout {layout}, use: {tuple(LAYOUTS)}")
+
+    runs = [
+        (layout, codec)
+        for layout in args.layouts.split(",")
+        for codec in args.codecs.split(",")
+    ]
+
+    for layout, codec in runs:
+        shard_depth, segmented = LAYOUTS[layout]
+
+        with tempfile.TemporaryDirectory(prefix="pyfiche-bench-") as root:
+            storage = PasteStorage(
+                root,
+                None if codec == "none" else codec,
+                shard_depth=shard_depth,
+                segment_max=high if segmented else 0,
+            )
+
+            if segmented:
+                storage.segments.SEGMENT_SIZE = args.segment_size
+
+            began = time.perf_counter()
+            for slug, (offset, size) in pastes.items():
+                storage.claim(slug, size)
+                with storage.upload() as upload:
+                    upload.write(log[offset : offset + size])
+                    storage.commit(upload, slug)
+            write_s = time.perf_counter() - began
+
+            allocated, inodes = disk_usage(root)
+
+            latencies = []
+            for slug in reads:
+                began = time.perf_counter()
+                storage.find(slug).read()
+                latencies.append(time.perf_counter() - began)
+            latencies.sort()
+
+            result = {
+                "writes_per_s": len(slugs) / write_s,
+                "disk_bytes": allocated,
+                "inodes": inodes,
+                "read_p50_us": percentile(latencies, 50) * 1e6,
+                "read_p99_us": percentile(latencies, 99) * 1e6,
+            }
+
+            if segmented:
+                result.update(compact_segments(storage, slugs, args.remove, rng))
+                storage.segments.close()
+
+        results[f"{layout} {codec}"] = result
+
+    return results
+
+
+def compact_segments(
+    storage: PasteStorage, slugs: List[str], fraction: float, rng: random.Random
+) -> Dict[str, object]:
+    # Removes a random fraction of the pastes, then compacts the segments
+    # like pyfiche-admin compact
+    for slug in rng.sample(slugs, int(len(slugs) * fraction)):
+        storage.remove(slug)
+
+    # Closing the segment being appended to releases its lock, so it can be
+    # compacted as well
+    storage.segments.close()
+    before, before_size, _ = storage.segments.stats()
+
+    began = time.perf_counter()
+    compacted, reclaimed = storage.segments.compact()
+    compact_s = time.perf_counter() - began
+
+    count, size, used = storage.segments.stats()
+
+    return {
+        "removed": int(len(slugs) * fraction),
+        "segments_before": before,
+        "segment_bytes_before": before_size,
+        "compacted": compacted,
+        "compact_s": compact_s,
+        "reclaimed_bytes": reclaimed,
+        "segments_after": count,
+        "segment_bytes_after": size,
+    }
+
+
+class SyntheticStorage(PasteStorage):
+    # Lists the given number of random slugs as existing pastes, so the
+    # filter of SlugAllocator can be loaded with millions of them without
+    # creating a directory for each. Claims still create directories.
+
+    def __init__(self, root: str, existing: int, length: int, symbols: str):
+        super().__init__(root)
+        self.existing = existing
+        self.length = length
+        self.symbols = symbols
+
+    def slugs(self):
+        # The same slugs every time, as the filter may be loaded repeatedly
+        rng = random.Random(0)
+
+        for _ in range(self.existing):
+            yield "".join(rng.choices(self.symbols, k=self.length))
+
+
+def micro_slugs(args: argparse.Namespace) -> Dict[str, object]:
+    # Loads the slug filter with --existing pastes, then allocates
+    # --allocations slugs, claiming a directory for each like the servers
+    # do. Allocating before the filter is loaded is timed as well.
+    symbols = FicheServer.FICHE_SYMBOLS
+
+    with tempfile.TemporaryDirectory(prefix="pyfiche-bench-") as root:
+        storage = SyntheticStorage(root, args.existing, args.slug_size, symbols)
+
+        unfiltered = SlugAllocator(storage, args.slug_size, symbols)
+        began = time.perf_counter()
+        for _ in range(args.allocations):
+            unfiltered.allocate()
+        unfiltered_s = time.perf_counter() - began
+
+        allocator = SlugAllocator(storage, args.slug_size, symbols)
+        began = time.perf_counter()
+        allocator.load(background=False)
+        load_s = time.perf_counter() - began
+
+        began = time.perf_counter()
+        for _ in range(args.allocations):
+            allocator.allocate()
+        allocate_s = time.perf_counter() - began
+
+    return {
+        "existing": args.existing,
+        "load_s": load_s,
+        "allocations_per_s": args.allocations / allocate_s,
+        "collisions": allocator.collisions,
+        "unfiltered_per_s": args.allocations / unfiltered_s,
+    }
+
+
+MICRO_BENCHMARKS = {
+    "ipfilter": micro_ipfilter,
+    "storage": micro_storage,
+    "slugs": micro_slugs,
+}
+
+
+def run_micro(args: argparse.Namespace) -> Dict[str, object]:
+    names = args.micro.split(",")
+
+    for name in names:
+        if name not in MICRO:
+            raise SystemExit(f"Unknown micro benchmark {name}, use: {MICRO}")
+
+    results = {}
+
+    for name in names:
+        if args.verbose:
+            print(f"Running {name}...", flush=True)
+        results[name] = MICRO_BENCHMARKS[name](args)
+
+    return {
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "micro": results,
+    }
+
+
+def print_micro(results: Dict[str, object], indent: str = "") -> None:
+    for name, result in results.items():
+        if isinstance(result, dict):
+            print(f"{indent}{name}")
+            print_micro(result, indent + "  ")
+            continue
+
+        if isinstance(result, float):
+            result = f"{result:.6g}"
+        print(f"{indent}{name:<20} {result}")
+
+
+def run(args: argparse.Namespace) -> Dict[str, object]:
+    workloads = args.workloads.split(",")
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            raise SystemExit(f"Unknown workload {workload}, use: {WORKLOADS}")
+
+    needed = {TARGETS[workload] for workload in workloads}
+    # Fetch workloads need pastes uploaded through Fiche first
+    if needed & {"recup", "lines"}:
+        needed.add("fiche")
+
+    server_args = {
+        "fiche": shlex.split(args.fiche_args),
+        "recup": shlex.split(args.recup_args),
+        "lines": shlex.split(args.lines_args),
+    }
+
+    with tempfile.TemporaryDirectory(prefix="pyfiche-bench-") as temp:
+        data_dir = args.data_dir or os.path.join(temp, "data")
+        os.makedirs(data_dir, exist_ok=True)
+        servers = {
+            name: Server(name, server_args[name], data_dir, temp)
+            for name in SERVERS
+            if name in needed
+        }
+        stop_sampling = threading.Event()
+
+        def sampler():
+            while not stop_sampling.wait(0.1):
+                for server in servers.values():
+                    server.sample()
+
+        try:
+            for server in servers.values():
+                server.wait()
+
+            ports = {name: server.port for name, server in servers.items()}
+            threading.Thread(target=sampler, daemon=True).start()
+            results = []
+
+            for size in sizes:
+                slugs = []
+
+                if needed & {"recup", "lines"}:
+                    client = Client(ports, args.timeout)
+                    slugs = [
+                        client.upload(payload(size, args.payload))
+                        for _ in range(args.seed)
+                    ]
+
+                for workload in workloads:
+                    if args.verbose:
+                        print(f"Running {workload} with {size} bytes...", flush=True)
+
+                    # Only the server a workload is sent to is charged for it
+                    server = servers[TARGETS[workload]]
+                    stalled = open_stalled(server.port, args.stalled)
+                    cpu_before = server.cpu_time()
+
+                    try:
+                        result = run_workload(
+                            make_request(workload, size, slugs, args.payload),
+                            ports,
+                            args.concurrency,
+                            args.duration,
+                            args.requests,
+                            args.timeout,
+                        )
+                    finally:
+                        for sock in stalled:
+                            sock.close()
+
+                    cpu_after = server.cpu_time()
+
+                    cpu = None
+                    if cpu_before is not None and cpu_after is not None:
+                        cpu = cpu_after - cpu_before
+                    result["server_cpu_s"] = cpu
+                    result["cpu_us_per_request"] = (
+                        cpu / result["requests"] * 1e6
+                        if cpu is not None and result["requests"]
+                        else None
+                    )
+                    results.append({"workload": workload, "size": size, **result})
+        finally:
+            stop_sampling.set()
+            server_stats = {}
+
+            for name, server in servers.items():
+                server.sample()
+                server_stats[name] = server.stats()
+                server.stop()
+
+    return {
+        "started": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "requests": args.requests,
+        "payload": args.payload,
+        "stalled": args.stalled,
+        "server_args": {name: extra for name, extra in server_args.items() if extra},
+        "results": results,
+        "servers": server_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the PyFiche servers on localhost."
+    )
+    parser.add_argument(
+        "-w",
+        "--workloads",
+        default=",".join(WORKLOADS),
+        help=f"Comma-separated workloads to run (default: {','.join(WORKLOADS)})",
+    )
+    parser.add_argument(
+        "-m",
+        "--micro",
+        help=(
+            "Run these comma-separated in-process benchmarks instead of the "
+            f"workloads: {','.join(MICRO)}"
+        ),
+    )
+    parser.add_argument(
+        "-e",
+        "--entries",
+        type=int,
+        default=100000,
+        help="Number of networks in the list for ipfilter (default: 100000)",
+    )
+    parser.add_argument(
+        "--linear",
+        type=int,
+        default=3,
+        help="Lookups timed with the old linear scan for ipfilter (default: 3)",
+    )
+    parser.add_argument(
+        "--pastes",
+        type=int,
+        default=2000,
+        help="Number of pastes written for storage (default: 2000)",
+    )
+    parser.add_argument(
+        "--paste-sizes",
+        default="100,4000",
+        help="Smallest and largest paste for storage, in bytes (default: 100,4000)",
+    )
+    parser.add_argument(
+        "-z",
+        "--codecs",
+        default="none",
+        help="Comma-separated codecs to store pastes with for storage (default: none)",
+    )
+    parser.add_argument(
+        "--layouts",
+        default="flat",
+        help=(
+            "Comma-separated paste layouts for storage: "
+            f"{','.join(LAYOUTS)} (default: flat)"
+        ),
+    )
+    parser.add_argument(
+        "--segment-size",
+        type=int,
+        default=4194304,
+        help="Size of each segment for storage, in bytes (default: 4194304)",
+    )
+    parser.add_argument(
+        "--remove",
+        type=float,
+        default=0.7,
+        help="Fraction of pastes removed before compacting segments (default: 0.7)",
+    )
+    parser.add_argument(
+        "--reads",
+        type=int,
+        default=2000,
+        help="Number of pastes read back for storage (default: 2000)",
+    )
+    parser.add_argument(
+        "--existing",
+        type=int,
+        default=10000000,
+        help="Number of existing pastes for slugs (default: 10000000)",
+    )
+    parser.add_argument(
+        "--allocations",
+        type=int,
+        default=10000,
+        help="Number of slugs allocated for slugs (default: 10000)",
+    )
+    parser.add_argument(
+        "--slug-size",
+        type=int,
+        default=FicheServer.slug_size,
+        help=f"Length of the slugs for slugs (default: {FicheServer.slug_size})",
+    )
+    parser.add_argument(
+        "-s",
+        "--sizes",
+        default="1024,65536,1048576",
+        help="Comma-separated paste sizes in bytes (default: 1024,65536,1048576)",
+    )
+    parser.add_argument(
+        "-p",
+        "--payload",
+        choices=PAYLOADS,
+        default="text",
+        help=(
+            "Content of the pastes: one repeated sentence, or log lines "
+            "(default: text)"
+        ),
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=16,
+        help="Number of concurrent clients (default: 16)",
+    )
+    parser.add_argument(
+        "-d",
+        "--duration",
+        type=float,
+        default=5.0,
+        help="Duration of each workload (in seconds) (default: 5)",
+    )
+    parser.add_argument(
+        "-n",
+        "--requests",
+        type=int,
+        default=0,
+        help="Stop each workload after this many requests (default: 0 - no limit)",
+    )
+    parser.add_argument(
+        "-i",
+        "--stalled",
+        type=int,
+        default=0,
+        help=(
+            "Number of connections holding an incomplete request open during "
+            "each workload (default: 0)"
+        ),
+    )
+    parser.add_argument(
+        "-S",
+        "--seed",
+        type=int,
+        default=100,
+        help="Number of pastes uploaded for fetch workloads (default: 100)",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=30.0,
+        help="Timeout of each request (in seconds) (default: 30)",
+    )
+    parser.add_argument(
+        "-o",
+        "--data_dir",
+        help="Data directory to use (default: a temporary directory)",
+    )
+    parser.add_argument(
+        "--fiche-args", default="", help="Additional arguments for pyfiche-server"
+    )
+    parser.add_argument(
+        "--recup-args", default="", help="Additional arguments for pyfiche-recup"
+    )
+    parser.add_argument(
+        "--lines-args", default="", help="Additional arguments for pyfiche-lines"
+    )
+    parser.add_argument(
+        "-j", "--json", help="Write the results as JSON to this file, - for stdout"
+    )
+    parser.add_argument(
+        "-b", "--baseline", help="JSON results of an earlier run to compare with"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show progress")
+
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if args.micro:
+        report = run_micro(args)
+
+        if args.json == "-":
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            print_micro(report["micro"])
+
+            if args.json:
+                with open(args.json, "w") as f:
+                    json.dump(report, f, indent=2)
+
+        return 0
+
+    report = run(args)
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_results(report["results"], baseline)
+        print()
+
+        for name, stats in report["servers"].items():
+            rss = stats["peak_rss_kb"]
+            print(
+                f"{name}: peak RSS {rss / 1024:.1f} MiB, "
+                f"peak threads {stats['peak_threads']}"
+                if rss is not None
+                else f"{name}: peak RSS and threads not available"
+            )
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+
+    failed = sum(result["errors"] for result in report["results"])
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
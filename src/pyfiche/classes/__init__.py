@@ -1,3 +1,4 @@
 from .fiche import FicheServer
 from .recup import RecupServer
-from .lines import LinesServer
\ No newline at end of file
+from .lines import LinesServer
+from .combined import CombinedServer
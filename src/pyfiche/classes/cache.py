@@ -0,0 +1,72 @@
+import threading
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+
+
+class PasteCache:
+    """LRU cache bounded by the total size of the cached values.
+
+    Keys are (slug, view) tuples. Every entry is stored together with a
+    validator (e.g. an ETag); a lookup with a different validator counts as
+    a miss and drops the stale entry."""
+
+    def __init__(self, max_bytes: int, max_entry_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = (
+            max_entry_bytes if max_entry_bytes is not None else max_bytes // 4
+        )
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple[str, Hashable], Tuple[Any, Any, int]]" = (
+            OrderedDict()
+        )
+        self._slugs: Dict[str, Set[Tuple[str, Hashable]]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Tuple[str, Hashable], validator: Any) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] != validator:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Tuple[str, Hashable], validator: Any, value: Any, size: int):
+        if size > self.max_entry_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (validator, value, size)
+            self._slugs.setdefault(key[0], set()).add(key)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, slug: str) -> None:
+        with self._lock:
+            for key in list(self._slugs.get(slug, ())):
+                self._remove(key)
+
+    def _remove(self, key: Tuple[str, Hashable]) -> None:
+        _, _, size = self._entries.pop(key)
+        self.size -= size
+
+        keys = self._slugs[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._slugs[key[0]]
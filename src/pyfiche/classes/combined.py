@@ -0,0 +1,131 @@
+import argparse
+import logging
+import threading
+
+from typing import List, Optional
+
+from .cache import PasteCache
+from .fiche import FicheServer
+from .index import PasteIndex
+from .lines import LinesServer
+from .metrics import serve_metrics
+from .recup import RecupServer
+from .slugs import SlugAllocator
+from .storage import PasteStorage
+
+
+class CombinedServer:
+    """Runs Fiche, Recup and Lines in one process, each on its own thread.
+
+    The servers share the paste storage, index and slug allocator, and with
+    them one paste cache: a paste uploaded through Fiche or Lines is served
+    from memory by all three right away. The IP filters and the metrics
+    registry are per process anyway, so they are shared too, and a single
+    port serves the metrics of all servers."""
+
+    JOIN_INTERVAL = 1.0  # seconds between checks of the server threads
+
+    cache_size: int = LinesServer.cache_size  # 0 to disable
+    metrics_port: int = 0  # 0 to disable
+
+    def __init__(self, fiche: FicheServer, recup: RecupServer, lines: LinesServer):
+        self.fiche = fiche
+        self.recup = recup
+        self.lines = lines
+        self.logger: logging.Logger = fiche.logger or logging.getLogger("pyfiche")
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> "CombinedServer":
+        # Every server takes the options it knows from a copy of args
+        def server_args(port: int, **kwargs) -> argparse.Namespace:
+            return argparse.Namespace(
+                **{
+                    **vars(args),
+                    "port": port,
+                    "metrics_port": 0,
+                    "workers": 1,
+                    **kwargs,
+                }
+            )
+
+        fiche = FicheServer.from_args(
+            server_args(
+                args.fiche_port,
+                output_dir=args.data_dir,
+                buffer_size=None,
+                user_name=None,
+            )
+        )
+        recup = RecupServer.from_args(
+            server_args(args.recup_port, buffer_size=None, timeout=None)
+        )
+        lines = LinesServer.from_args(server_args(args.lines_port))
+
+        combined = cls(fiche, recup, lines)
+        if args.cache_size is not None:
+            combined.cache_size = args.cache_size
+        combined.metrics_port = args.metrics_port or combined.metrics_port
+
+        return combined
+
+    @property
+    def servers(self) -> List[object]:
+        return [self.fiche, self.recup, self.lines]
+
+    def share(self) -> None:
+        # Replaces what the servers would create for themselves
+        fiche = self.fiche
+
+        storage = PasteStorage(
+            fiche.output_dir,
+            fiche.compression,
+            fiche.dedup,
+            fiche.shard_depth,
+            fiche.segment_max,
+            self.cache_size,
+        )
+        slugs = SlugAllocator(
+            storage, fiche.slug_size, FicheServer.FICHE_SYMBOLS, self.logger
+        )
+        index: Optional[PasteIndex] = (
+            PasteIndex(fiche.index_file) if fiche.index_file else None
+        )
+
+        for server in self.servers:
+            server._storage = storage
+            server._index = index
+            server._slugs = slugs
+
+        # Lines keeps its rendered pages next to the pastes themselves
+        self.lines._cache = (
+            storage.cache if storage.cache is not None else PasteCache(0)
+        )
+
+        # Fiche's reaper removes expired pastes for all servers
+        self.lines.reap_interval = 0
+
+    def run(self) -> int:
+        # Recup refuses to start without the data directory
+        self.fiche.output_dir.mkdir(parents=True, exist_ok=True)
+        self.share()
+
+        if self.metrics_port:
+            serve_metrics(self.metrics_port, logger=self.logger)
+
+        threads = [
+            threading.Thread(target=server.run, name=f"pyfiche-{name}", daemon=True)
+            for name, server in zip(("fiche", "recup", "lines"), self.servers)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while all(thread.is_alive() for thread in threads):
+                threads[0].join(self.JOIN_INTERVAL)
+        except KeyboardInterrupt:
+            return 0
+
+        stopped = [thread.name for thread in threads if not thread.is_alive()]
+        self.logger.fatal(f"Server thread {', '.join(stopped)} stopped, exiting")
+        return 1
@@ -3,18 +3,39 @@ import os
 import socket
 import time
 import datetime
-import threading
-import random
 import string
 import logging
-import ipaddress
+import asyncio
 
 from typing import Optional, Tuple
 
+from .index import PasteIndex, PasteInfo
+from .ipfilter import IPFilter
+from .metrics import ServerMetrics, serve_metrics
+from .pool import (
+    WorkerPool,
+    AsyncWorkerPool,
+    ByteBudget,
+    BUSY_MESSAGE,
+    reject_connection,
+    reject_connection_async,
+)
+from .prefork import Prefork, listen_socket
+from .ratelimit import RateLimiter, rate_limit_message
+from .reaper import Reaper
+from .slugs import SlugAllocator
+from .storage import CODECS, PasteStorage, PasteUpload
+
 
 class FicheServer:
     FICHE_SYMBOLS = string.ascii_letters + string.digits
     OUTPUT_FILE_NAME = "index.txt"
+    ENGINES = ("threading", "asyncio")
+    COMPRESSION_CODECS = ("none", *CODECS)
+    IDLE_TIMEOUT_FACTOR = 4
+    STALE_UPLOAD_AGE = 3600
+    # How long an upload is read and discarded after rejecting it
+    REJECT_DRAIN_TIMEOUT = 0.5
 
     domain: str = "localhost"
     port: int = 9999
@@ -23,6 +44,26 @@ class FicheServer:
     https: bool = False
     buffer_size: int = 4096
     max_size: int = 5242880  # 5 MB by default
+    engine: str = "threading"
+    max_connections: int = 64
+    queue_size: int = 128
+    max_inflight: int = 104857600  # 100 MB by default, 0 to disable
+    timeout: float = 3.0
+    min_timeout: float = 1.0
+    deadline: float = 60.0  # 0 to disable
+    compression: Optional[str] = None
+    dedup: bool = False
+    shard_depth: int = 0
+    index_file: Optional[str] = None
+    segment_max: int = 0  # 0 to store every paste as a file
+    expiry: int = 0  # in seconds, 0 to keep pastes forever
+    reap_interval: float = 60.0  # 0 to disable
+    metrics_port: int = 0  # 0 to disable
+    rate_limit: float = 0.0  # requests per second per client, 0 to disable
+    byte_rate_limit: int = 0  # bytes per second per client, 0 to disable
+    workers: int = 1
+    # Number of this worker process, if there are several
+    worker: Optional[int] = None
     _output_dir: pathlib.Path = pathlib.Path("data/")
     _log_file: Optional[pathlib.Path] = None
     _banlist: Optional[pathlib.Path] = None
@@ -95,18 +136,43 @@ class FicheServer:
         fiche.allowlist = args.allowlist or fiche.allowlist
         fiche.buffer_size = args.buffer_size or fiche.buffer_size
         fiche.max_size = args.max_size or fiche.max_size
+        fiche.engine = args.engine or fiche.engine
+        fiche.max_connections = args.max_connections or fiche.max_connections
+        fiche.queue_size = args.queue_size or fiche.queue_size
+        if args.max_inflight is not None:
+            fiche.max_inflight = args.max_inflight
+        fiche.timeout = args.timeout or fiche.timeout
+        fiche.min_timeout = min(args.min_timeout or fiche.min_timeout, fiche.timeout)
+        if args.deadline is not None:
+            fiche.deadline = args.deadline
+        if args.compression and args.compression != "none":
+            fiche.compression = args.compression
+        fiche.dedup = args.dedup or fiche.dedup
+        fiche.shard_depth = args.shard_depth or fiche.shard_depth
+        fiche.index_file = args.index or fiche.index_file
+        fiche.segment_max = args.segment_max or fiche.segment_max
+        fiche.expiry = args.expiry or fiche.expiry
+        if args.reap_interval is not None:
+            fiche.reap_interval = args.reap_interval
+        fiche.metrics_port = args.metrics_port or fiche.metrics_port
+        fiche.rate_limit = args.rate_limit or fiche.rate_limit
+        fiche.byte_rate_limit = args.byte_rate_limit or fiche.byte_rate_limit
+        fiche.workers = args.workers or fiche.workers
 
         fiche.logger = logging.getLogger("pyfiche")
         fiche.logger.setLevel(logging.INFO if not args.debug else logging.DEBUG)
-        handler = (
-            logging.StreamHandler()
-            if not args.log_file
-            else logging.FileHandler(args.log_file)
-        )
-        handler.setFormatter(
-            logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-        )
-        fiche.logger.addHandler(handler)
+
+        # Servers run together in one process share the logger
+        if not fiche.logger.handlers:
+            handler = (
+                logging.StreamHandler()
+                if not args.log_file
+                else logging.FileHandler(args.log_file)
+            )
+            handler.setFormatter(
+                logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+            )
+            fiche.logger.addHandler(handler)
 
         if args.user_name:
             fiche.logger.fatal(
@@ -118,137 +184,406 @@ class FicheServer:
     def get_date(self):
         return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    def start_server(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((self.listen_addr, self.port))
-            s.listen()
+    def start_server(self, sock: Optional[socket.socket] = None):
+        if self.engine == "asyncio":
+            asyncio.run(self.start_server_async(sock))
+            return
 
+        if sock is None:
+            sock = listen_socket(self.listen_addr, self.port)
+
+        with sock as s:
             self.logger.info(
                 f"Server started listening on: {self.listen_addr}:{self.port}"
             )
 
+            pool = WorkerPool(
+                self.handle_connection,
+                self.max_connections,
+                self.queue_size,
+                self.logger,
+                self.reject_connection,
+            )
+
             while True:
                 conn, addr = s.accept()
-                threading.Thread(
-                    target=self.handle_connection,
-                    args=(
-                        conn,
-                        addr,
-                    ),
-                ).start()
+                pool.submit(conn, addr)
+
+    async def start_server_async(self, sock: Optional[socket.socket] = None):
+        pool = AsyncWorkerPool(
+            self.handle_connection_async,
+            self.max_connections,
+            self.queue_size,
+            self.logger,
+            self.reject_connection_async,
+        )
 
-    def generate_slug(
-        self,
-        length: Optional[int] = None,
-        symbols: Optional[str] = None,
-        output_dir: Optional[str] = None,
-    ):
-        symbols = symbols or self.FICHE_SYMBOLS
+        if sock is None:
+            sock = listen_socket(self.listen_addr, self.port)
+
+        server = await asyncio.start_server(pool.submit, sock=sock)
 
-        slug = "".join(
-            random.choice(symbols) for _ in range(length or self.slug_size)
+        self.logger.info(
+            f"Server started listening on: {self.listen_addr}:{self.port} (asyncio)"
         )
 
-        output_dir = output_dir or self.output_dir
+        async with server:
+            await server.serve_forever()
 
-        if output_dir:
-            if os.path.exists(os.path.join(output_dir, slug)):
-                return self.generate_slug(length, symbols, output_dir)
+    @property
+    def storage(self) -> PasteStorage:
+        if not hasattr(self, "_storage"):
+            self._storage = PasteStorage(
+                self.output_dir,
+                self.compression,
+                self.dedup,
+                self.shard_depth,
+                self.segment_max,
+            )
+        return self._storage
 
-        return slug
+    @property
+    def index(self) -> Optional[PasteIndex]:
+        if self.index_file and not hasattr(self, "_index"):
+            self._index = PasteIndex(self.index_file)
+        return getattr(self, "_index", None)
 
-    def create_directory(self, output_dir, slug):
-        path = os.path.join(output_dir, slug)
-        try:
-            if not os.path.exists(path):
-                os.makedirs(path)
-            return path
-        except Exception as e:
-            self.logger.error(f"Error creating directory {path}: {e}")
-            return None
+    @property
+    def slugs(self) -> SlugAllocator:
+        if not hasattr(self, "_slugs"):
+            self._slugs = SlugAllocator(
+                self.storage, self.slug_size, self.FICHE_SYMBOLS, self.logger
+            )
+        return self._slugs
+
+    @property
+    def metrics(self) -> ServerMetrics:
+        if not hasattr(self, "_metrics"):
+            self._metrics = ServerMetrics("fiche", worker=self.worker)
+        return self._metrics
 
-    def save_to_file(self, data, slug):
-        path = os.path.join(self.output_dir, slug, self.OUTPUT_FILE_NAME)
+    def reject_connection(self, conn: socket.socket) -> None:
+        self.metrics.rejected["busy"].inc()
+        reject_connection(conn)
 
-        os.makedirs(os.path.dirname(path), exist_ok=True)
+    async def reject_connection_async(self, writer: asyncio.StreamWriter) -> None:
+        self.metrics.rejected["busy"].inc()
+        await reject_connection_async(writer)
 
-        try:
-            with open(path, "wb") as file:
-                file.write(data)
-            return path
-        except Exception as e:
-            self.logger.error(f"Error saving file {path}: {e}")
-            return None
+    @property
+    def inflight(self) -> ByteBudget:
+        if not hasattr(self, "_inflight"):
+            self._inflight = ByteBudget(self.max_inflight)
+        return self._inflight
 
-    def handle_connection(self, conn: socket.socket, addr: Tuple[str, int]):
-        self.logger.info(f"Incoming connection from: {addr}")
+    @property
+    def ratelimiter(self) -> RateLimiter:
+        if not hasattr(self, "_ratelimiter"):
+            self._ratelimiter = RateLimiter(self.rate_limit, self.byte_rate_limit)
+        return self._ratelimiter
 
+    def check_access(self, addr: Tuple[str, int]) -> Optional[bytes]:
         if self.check_banlist(addr[0]):
-            conn.sendall(b"Your IP address is banned from this server.\n")
             self.logger.info(f"Connections from {addr} are banned.")
-            conn.close()
-            return
+            self.metrics.rejected["banned"].inc()
+            return b"Your IP address is banned from this server.\n"
 
         if not self.check_allowlist(addr[0]):
-            conn.sendall(b"Your IP address is not allowed to connect to this server.\n")
             self.logger.info(f"Connection from {addr} is not allowed.")
+            self.metrics.rejected["not_allowed"].inc()
+            return b"Your IP address is not allowed to connect to this server.\n"
+
+        wait = self.ratelimiter.check(addr[0])
+        if wait is not None:
+            self.logger.info(f"Connection from {addr} is rate limited.")
+            self.metrics.rejected["rate_limited"].inc()
+            return rate_limit_message(wait)
+
+        return None
+
+    def send_rejection(self, conn: socket.socket, message: bytes) -> None:
+        # Closing a socket with unread data resets the connection, and the
+        # client may never see the message. The upload is read and discarded
+        # for a moment first, so a client that sent a small paste gets it.
+        try:
+            conn.sendall(message)
+            conn.shutdown(socket.SHUT_WR)
+            conn.settimeout(self.REJECT_DRAIN_TIMEOUT)
+            deadline = time.monotonic() + self.REJECT_DRAIN_TIMEOUT
+
+            while time.monotonic() < deadline and conn.recv(self.buffer_size):
+                pass
+        except OSError:
+            pass
+        finally:
             conn.close()
-            return
 
-        conn.setblocking(False)
-        conn.settimeout(3)
+    async def send_rejection_async(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, message: bytes
+    ) -> None:
+        # See send_rejection()
+        try:
+            writer.write(message)
+            await writer.drain()
+            writer.write_eof()
+            deadline = time.monotonic() + self.REJECT_DRAIN_TIMEOUT
+
+            while time.monotonic() < deadline:
+                data = await asyncio.wait_for(
+                    reader.read(self.buffer_size), self.REJECT_DRAIN_TIMEOUT
+                )
+                if not data:
+                    break
+        except (asyncio.TimeoutError, OSError):
+            pass
+
+    def store_upload(
+        self, upload: PasteUpload, client: Optional[str] = None
+    ) -> Optional[str]:
+        try:
+            slug = self.slugs.allocate(upload.size)
+        except (OSError, RuntimeError) as e:
+            self.logger.error(f"Error allocating slug: {e}")
+            return None
 
         try:
-            received_data = bytearray()
+            started = time.perf_counter()
+            self.storage.commit(upload, slug)
+            self.metrics.disk_write.observe(time.perf_counter() - started)
+        except Exception as e:
+            self.logger.error(f"Error saving file for {slug}: {e}")
+            self.logger.error("Failed to save data to file.")
+            self.storage.release(slug)
+            return None
 
+        # Indexed once the paste exists, so that an index rebuild running
+        # meanwhile either finds the paste or keeps its entry (see
+        # PasteIndex.rebuild())
+        if self.index:
             try:
-                while True:
-                    data = conn.recv(self.buffer_size)
-                    self.logger.debug(f"Read {len(data)} bytes from {addr}")
-                    if not data:
-                        break
+                self.index.add(
+                    PasteInfo.from_upload(slug, upload, client, self.expiry)
+                )
+            except Exception as e:
+                self.logger.error(f"Error indexing {slug}: {e}")
+                # A complete index would hide the paste for good
+                self.storage.remove(slug)
+                return None
+
+        self.logger.info(f"Received {upload.size} bytes, saved to: {slug}")
+        self.metrics.paste_size.observe(upload.size)
+        return f"{self.base_url}/{slug}\n"
+
+    def get_receive_timeout(
+        self, started: float, max_gap: Optional[float]
+    ) -> Tuple[float, bool]:
+        # Wait the full timeout for the first chunk. After that, adapt to the
+        # pace of the client: a client that has been sending back-to-back
+        # chunks is considered done much sooner than a slow one.
+        if max_gap is None:
+            timeout = self.timeout
+        else:
+            timeout = min(
+                self.timeout,
+                max(self.min_timeout, max_gap * self.IDLE_TIMEOUT_FACTOR),
+            )
 
-                    received_data.extend(data)
+        # Past the deadline, a client gets one last wait to show it's done:
+        # silence or the end of the stream completes the upload, any more
+        # data means it is still sending and has taken too long.
+        past_deadline = bool(self.deadline) and (
+            time.monotonic() - started >= self.deadline
+        )
 
-                    if len(received_data) > self.max_size:
-                        self.logger.error(
-                            f"Received data exceeds maximum size ({self.max_size} bytes), terminating connection."
-                        )
-                        conn.sendall(b"Data exceeds maximum size.\n")
-                        return
+        return timeout, past_deadline
 
-            except socket.timeout:
-                pass
+    def handle_connection(self, conn: socket.socket, addr: Tuple[str, int]):
+        self.logger.info(f"Incoming connection from: {addr}")
+        self.metrics.accepted.inc()
 
-            data = bytes(received_data)
+        rejection = self.check_access(addr)
+        if rejection:
+            self.send_rejection(conn, rejection)
+            return
 
-            self.logger.debug(f"Received {len(data)} bytes in total from {addr}")
+        upload = None
+        self.metrics.in_flight.inc()
 
-            if not data:
-                self.logger.error("No data received from the client!")
-                return
+        try:
+            upload = self.storage.upload(digest=self.index is not None)
+            started = last_read = time.monotonic()
+            max_gap = None
+
+            while True:
+                timeout, past_deadline = self.get_receive_timeout(started, max_gap)
+                conn.settimeout(timeout)
 
-            slug = self.generate_slug(self.slug_size)
-            dir_path = self.create_directory(self.output_dir, slug)
-            if dir_path is None:
+                try:
+                    data = conn.recv(self.buffer_size)
+                except socket.timeout:
+                    break
+
+                self.logger.debug(f"Read {len(data)} bytes from {addr}")
+
+                # The client shut down its sending side, the upload is complete
+                if not data:
+                    break
+
+                if past_deadline:
+                    self.logger.error(
+                        f"Upload from {addr} exceeded the deadline ({self.deadline} seconds), terminating connection."
+                    )
+                    conn.sendall(b"Upload took too long.\n")
+                    return
+
+                now = time.monotonic()
+                max_gap = max(max_gap or 0.0, now - last_read) if upload.size else 0.0
+                last_read = now
+
+                if upload.size + len(data) > self.max_size:
+                    self.logger.error(
+                        f"Received data exceeds maximum size ({self.max_size} bytes), terminating connection."
+                    )
+                    conn.sendall(b"Data exceeds maximum size.\n")
+                    return
+
+                if not self.inflight.acquire(len(data)):
+                    self.logger.warning(
+                        f"In-flight upload limit ({self.max_inflight} bytes) reached, rejecting {addr}."
+                    )
+                    conn.sendall(BUSY_MESSAGE)
+                    return
+
+                upload.write(data)
+
+            self.metrics.upload_duration.observe(time.monotonic() - started)
+            self.logger.debug(f"Received {upload.size} bytes in total from {addr}")
+
+            if not upload.size:
+                self.logger.error("No data received from the client!")
                 return
 
-            file_path = self.save_to_file(data, slug)
+            url = self.store_upload(upload, addr[0])
 
-            if file_path:
-                url = f"{self.base_url}/{slug}\n"
+            if url:
                 conn.sendall(url.encode("utf-8"))
-                self.logger.info(f"Received {len(data)} bytes, saved to: {slug}")
-            else:
-                self.logger.error("Failed to save data to file.")
+                self.metrics.sent.inc(len(url))
+                self.metrics.time_to_url.observe(time.monotonic() - started)
 
         except Exception as e:
             self.logger.error(f"An error occurred: {e}")
             raise
         finally:
+            self.metrics.in_flight.dec()
+            if upload:
+                self.metrics.received.inc(upload.size)
+                self.ratelimiter.charge(addr[0], upload.size)
+                self.inflight.release(upload.size)
+                if not upload.committed:
+                    upload.abort()
             conn.close()
 
+    async def handle_connection_async(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        addr = writer.get_extra_info("peername")[:2]
+        self.logger.info(f"Incoming connection from: {addr}")
+        self.metrics.accepted.inc()
+
+        # Checked before counting the connection, as in handle_connection()
+        rejection = self.check_access(addr)
+        if rejection:
+            await self.send_rejection_async(reader, writer, rejection)
+            writer.close()
+            return
+
+        upload = None
+        self.metrics.in_flight.inc()
+
+        try:
+            upload = self.storage.upload(digest=self.index is not None)
+            started = last_read = time.monotonic()
+            max_gap = None
+
+            while True:
+                timeout, past_deadline = self.get_receive_timeout(started, max_gap)
+
+                try:
+                    data = await asyncio.wait_for(
+                        reader.read(self.buffer_size), timeout
+                    )
+                except asyncio.TimeoutError:
+                    break
+
+                self.logger.debug(f"Read {len(data)} bytes from {addr}")
+
+                # The client shut down its sending side, the upload is complete
+                if not data:
+                    break
+
+                if past_deadline:
+                    self.logger.error(
+                        f"Upload from {addr} exceeded the deadline ({self.deadline} seconds), terminating connection."
+                    )
+                    writer.write(b"Upload took too long.\n")
+                    await writer.drain()
+                    return
+
+                now = time.monotonic()
+                max_gap = max(max_gap or 0.0, now - last_read) if upload.size else 0.0
+                last_read = now
+
+                if upload.size + len(data) > self.max_size:
+                    self.logger.error(
+                        f"Received data exceeds maximum size ({self.max_size} bytes), terminating connection."
+                    )
+                    writer.write(b"Data exceeds maximum size.\n")
+                    await writer.drain()
+                    return
+
+                if not self.inflight.acquire(len(data)):
+                    self.logger.warning(
+                        f"In-flight upload limit ({self.max_inflight} bytes) reached, rejecting {addr}."
+                    )
+                    writer.write(BUSY_MESSAGE)
+                    await writer.drain()
+                    return
+
+                # Buffered writes of a single chunk are cheap enough to do on
+                # the event loop; only the final commit is moved to a thread.
+                upload.write(data)
+
+            self.metrics.upload_duration.observe(time.monotonic() - started)
+            self.logger.debug(f"Received {upload.size} bytes in total from {addr}")
+
+            if not upload.size:
+                self.logger.error("No data received from the client!")
+                return
+
+            url = await asyncio.to_thread(self.store_upload, upload, addr[0])
+
+            if url:
+                writer.write(url.encode("utf-8"))
+                await writer.drain()
+                self.metrics.sent.inc(len(url))
+                self.metrics.time_to_url.observe(time.monotonic() - started)
+
+        except Exception as e:
+            self.logger.error(f"An error occurred: {e}")
+        finally:
+            self.metrics.in_flight.dec()
+            if upload:
+                self.metrics.received.inc(upload.size)
+                self.ratelimiter.charge(addr[0], upload.size)
+                self.inflight.release(upload.size)
+                if not upload.committed:
+                    upload.abort()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
     def run(self):
         if not self.logger:
             self.logger = logging.getLogger("pyfiche")
@@ -275,6 +610,14 @@ class FicheServer:
             self.logger.fatal(f"Allowlist file ({self.allowlist_path}) does not exist!")
             exit(1)
 
+        if self.slug_size <= PasteStorage.SHARD_WIDTH * self.shard_depth:
+            self.logger.fatal("Slugs must be longer than the shard directory names!")
+            exit(1)
+
+        if self.expiry and not self.index_file:
+            self.logger.fatal("Expiring pastes requires an index!")
+            exit(1)
+
         self.logger.info(f"Starting PyFiche...")
 
         if self.output_dir.exists() and not os.access(self.output_dir_path, os.W_OK):
@@ -298,7 +641,52 @@ class FicheServer:
                 self.logger.fatal("Log file not writable!")
                 exit(1)
 
-        self.start_server()
+        removed = PasteUpload.cleanup(self.output_dir, self.STALE_UPLOAD_AGE)
+        if removed:
+            self.logger.info(f"Removed {removed} stale temporary upload files.")
+
+        # Forked before any thread or database connection exists
+        if self.workers > 1:
+            return Prefork(self.workers, self.logger).run(
+                self.listen_addr, self.port, self.serve
+            )
+
+        return self.serve()
+
+    def serve(self, worker: int = 0, sock: Optional[socket.socket] = None):
+        if self.workers > 1:
+            self.worker = worker
+
+        if self.segment_max:
+            self.logger.info(
+                f"Storing pastes up to {self.segment_max} bytes in segments"
+            )
+
+        if self.index:
+            self.logger.info(f"Recording paste metadata in {self.index_file}")
+
+            if self.expiry:
+                self.logger.info(f"Pastes expire after {self.expiry} seconds")
+
+            # One reaper is enough for all workers
+            if self.reap_interval and worker == 0:
+                Reaper(
+                    self.storage, self.index, self.reap_interval, logger=self.logger
+                ).start()
+
+        if self.storage.segments and worker == 0:
+            released = self.storage.segments.sweep()
+            if released:
+                self.logger.info(f"Released {released} stale slug claims.")
+
+        self.slugs.load()
+
+        # Metrics are not shared between processes: every worker serves its
+        # own, labelled with its number, on the next port
+        if self.metrics_port:
+            serve_metrics(self.metrics_port + worker, logger=self.logger)
+
+        self.start_server(sock)
 
         return 0
 
@@ -307,35 +695,18 @@ class FicheServer:
             return True
 
         try:
-            ip = ipaddress.ip_address(addr)
-            with open(self.allowlist_path, "r") as file:
-                for line in file:
-                    line = line.strip()
-                    if line:
-                        network = ipaddress.ip_network(line, strict=False)
-                        if ip in network:
-                            return True
+            return addr in IPFilter.for_path(self.allowlist_path, self.logger)
         except ValueError as e:
             self.logger.error(f"Invalid IP address or network: {e}")
             return False
 
-        return False
-
     def check_banlist(self, addr):
         if not self.banlist_path:
             return False
 
         try:
-            ip = ipaddress.ip_address(addr)
-            with open(self.banlist_path, "r") as file:
-                for line in file:
-                    line = line.strip()
-                    if line:
-                        network = ipaddress.ip_network(line, strict=False)
-                        if ip in network:
-                            return True
+            return addr in IPFilter.for_path(self.banlist_path, self.logger)
         except ValueError as e:
             self.logger.error(f"Invalid IP address or network: {e}")
             return False
 
-        return False
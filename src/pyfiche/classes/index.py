@@ -0,0 +1,258 @@
+import hashlib
+import pathlib
+import sqlite3
+import threading
+import time
+
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Union
+
+from .storage import (
+    COPY_CHUNK_SIZE,
+    SNIFF_SIZE,
+    Paste,
+    PasteUpload,
+    detect_mime,
+    sniff_binary,
+)
+
+
+class PasteInfo(NamedTuple):
+    slug: str
+    size: int
+    created: float
+    client: Optional[str]
+    hash: Optional[str]
+    binary: bool
+    mime: str
+    expires: Optional[float] = None
+
+    @property
+    def expired(self) -> bool:
+        return self.expires is not None and self.expires <= time.time()
+
+    @classmethod
+    def from_upload(
+        cls,
+        slug: str,
+        upload: PasteUpload,
+        client: Optional[str] = None,
+        ttl: Optional[float] = None,
+    ) -> "PasteInfo":
+        binary = sniff_binary(upload.head, upload.size <= SNIFF_SIZE)
+        created = time.time()
+
+        return cls(
+            slug,
+            upload.size,
+            created,
+            client,
+            upload.digest,
+            binary,
+            detect_mime(upload.head, binary),
+            created + ttl if ttl else None,
+        )
+
+    @classmethod
+    def from_paste(cls, paste: Paste) -> "PasteInfo":
+        # For pastes stored before the index existed; the modification time
+        # stands in for the creation time
+        digest = hashlib.sha256()
+
+        with paste.open() as file:
+            head = file.read(SNIFF_SIZE)
+            digest.update(head)
+            size = len(head)
+
+            while chunk := file.read(COPY_CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+
+        binary = sniff_binary(head, size <= SNIFF_SIZE)
+
+        return cls(
+            paste.slug,
+            size,
+            paste.stat.st_mtime,
+            None,
+            digest.hexdigest(),
+            binary,
+            detect_mime(head, binary),
+        )
+
+
+class PasteIndex:
+    """Metadata of all pastes in an SQLite database.
+
+    The database runs in WAL mode, so the servers can read it while another
+    process writes. Every thread gets its own connection.
+
+    Once a full rebuild has been done (see rebuild()), the index is marked
+    complete and a slug missing from it is treated as not existing, without
+    looking at the data directory.
+
+    Pastes with an expiry time are found through a partial index on that
+    column, oldest first, so expired pastes can be removed without scanning
+    anything else."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS pastes (
+            slug TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            client TEXT,
+            hash TEXT,
+            binary INTEGER NOT NULL,
+            mime TEXT NOT NULL,
+            expires REAL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS pastes_created ON pastes (created);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: Union[str, pathlib.Path]):
+        self.path = pathlib.Path(path)
+        self._local = threading.local()
+
+        with self.connection as db:
+            db.executescript(self.SCHEMA)
+
+            # Indexes created before pastes could expire
+            columns = [row[1] for row in db.execute("PRAGMA table_info(pastes)")]
+            if "expires" not in columns:
+                db.execute("ALTER TABLE pastes ADD COLUMN expires REAL")
+
+            db.execute(
+                "CREATE INDEX IF NOT EXISTS pastes_expires ON pastes (expires) "
+                "WHERE expires IS NOT NULL"
+            )
+
+        self.complete = self.get_meta("complete") == "1"
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            # Durable enough in WAL mode: a crash may lose the last commits,
+            # but never corrupts the database
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+
+        return db
+
+    def add(self, info: PasteInfo) -> None:
+        with self.connection as db:
+            db.execute(
+                "INSERT OR REPLACE INTO pastes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", info
+            )
+
+    def get(self, slug: str) -> Optional[PasteInfo]:
+        row = self.connection.execute(
+            "SELECT slug, size, created, client, hash, binary, mime, expires "
+            "FROM pastes WHERE slug = ?",
+            (slug,),
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        return PasteInfo(*row[:5], bool(row[5]), *row[6:])
+
+    def expired(self, limit: int, now: Optional[float] = None) -> List[str]:
+        return [
+            row[0]
+            for row in self.connection.execute(
+                "SELECT slug FROM pastes WHERE expires <= ? ORDER BY expires LIMIT ?",
+                (time.time() if now is None else now, limit),
+            )
+        ]
+
+    def remove(self, slug: str) -> None:
+        with self.connection as db:
+            db.execute("DELETE FROM pastes WHERE slug = ?", (slug,))
+
+    def remove_many(self, slugs: Iterable[str]) -> None:
+        with self.connection as db:
+            db.executemany(
+                "DELETE FROM pastes WHERE slug = ?", ((slug,) for slug in slugs)
+            )
+
+    def stats(self):
+        return self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(created), MAX(created) "
+            "FROM pastes"
+        ).fetchone()
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self.connection as db:
+            db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def rebuild(self, infos: Iterable[PasteInfo], batch_size: int = 1000) -> int:
+        # Adds all pastes in infos and drops entries of pastes that are gone.
+        # The servers index a paste only after storing it, so an entry that
+        # exists before the scan starts belongs to a paste the scan will
+        # find, unless the paste was removed. Entries added later are kept,
+        # as their paste may have been stored where the scan had been.
+        db = self.connection
+        db.execute("CREATE TEMP TABLE IF NOT EXISTS seen (slug TEXT PRIMARY KEY)")
+        db.execute("DELETE FROM seen")
+
+        with db:
+            db.execute("DROP TABLE IF EXISTS temp.existing")
+            db.execute("CREATE TEMP TABLE existing AS SELECT slug FROM pastes")
+
+        count = 0
+
+        for batch in batched(infos, batch_size):
+            with db:
+                # Creation time, client and expiry of indexed pastes are only
+                # known from the upload, so keep those
+                db.executemany(
+                    "INSERT INTO pastes VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (slug) DO UPDATE SET size = excluded.size, "
+                    "hash = excluded.hash, binary = excluded.binary, "
+                    "mime = excluded.mime",
+                    batch,
+                )
+                db.executemany(
+                    "INSERT OR IGNORE INTO seen VALUES (?)",
+                    ((info.slug,) for info in batch),
+                )
+            count += len(batch)
+
+        with db:
+            db.execute(
+                "DELETE FROM pastes WHERE slug IN "
+                "(SELECT slug FROM existing EXCEPT SELECT slug FROM seen)"
+            )
+            db.execute("DROP TABLE seen")
+            db.execute("DROP TABLE existing")
+
+        self.set_meta("complete", "1")
+        self.complete = True
+        return count
+
+
+def batched(items: Iterable, size: int) -> Iterator[List]:
+    batch = []
+
+    for item in items:
+        batch.append(item)
+
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
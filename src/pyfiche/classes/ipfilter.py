@@ -0,0 +1,133 @@
+import bisect
+import ipaddress
+import logging
+import os
+import pathlib
+import threading
+import time
+
+from typing import Dict, List, Optional, Tuple, Union
+
+
+class IPFilter:
+    """Ban/allow list compiled into sorted, merged address intervals.
+
+    Lookups are a binary search per address family. The list file is
+    re-read only when its mtime changes, checked at most once every
+    CHECK_INTERVAL seconds. If it can't be read, the last list loaded
+    stays in use."""
+
+    CHECK_INTERVAL = 1.0
+
+    _registry: Dict[str, "IPFilter"] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(
+        self, path: Union[str, pathlib.Path], logger: Optional[logging.Logger] = None
+    ):
+        self.path = pathlib.Path(path)
+        self.logger = logger or logging.getLogger("pyfiche")
+        self._mtime: Optional[int] = None
+        self._checked: float = float("-inf")
+        self._lock = threading.Lock()
+        self._intervals: Dict[int, Tuple[List[int], List[int]]] = {
+            4: ([], []),
+            6: ([], []),
+        }
+
+    @classmethod
+    def for_path(
+        cls, path: Union[str, pathlib.Path], logger: Optional[logging.Logger] = None
+    ) -> "IPFilter":
+        key = str(pathlib.Path(path).absolute())
+
+        with cls._registry_lock:
+            if key not in cls._registry:
+                cls._registry[key] = cls(key, logger)
+            return cls._registry[key]
+
+    def __len__(self) -> int:
+        return sum(len(starts) for starts, _ in self._intervals.values())
+
+    def __contains__(self, addr: str) -> bool:
+        self.reload_if_changed()
+
+        ip = ipaddress.ip_address(addr)
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+
+        starts, ends = self._intervals[ip.version]
+        value = int(ip)
+        i = bisect.bisect_right(starts, value) - 1
+        return i >= 0 and value <= ends[i]
+
+    def reload_if_changed(self) -> None:
+        now = time.monotonic()
+        if now - self._checked < self.CHECK_INTERVAL:
+            return
+
+        with self._lock:
+            if now - self._checked < self.CHECK_INTERVAL:
+                return
+
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError as e:
+                self.logger.error(f"Cannot read IP list {self.path}: {e}")
+                return
+            finally:
+                self._checked = now
+
+            if mtime != self._mtime:
+                try:
+                    self.load()
+                except (OSError, ValueError) as e:
+                    # E.g. removed or rewritten since the stat(); the last
+                    # good list stays in use and the load is retried
+                    self.logger.error(f"Cannot read IP list {self.path}: {e}")
+                    return
+
+                self._mtime = mtime
+
+    def load(self) -> None:
+        ranges: Dict[int, List[Tuple[int, int]]] = {4: [], 6: []}
+
+        with open(self.path, "r") as file:
+            for number, line in enumerate(file, 1):
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+
+                try:
+                    network = ipaddress.ip_network(line, strict=False)
+                except ValueError as e:
+                    self.logger.error(
+                        f"Invalid IP address or network in {self.path}:{number}: {e}"
+                    )
+                    continue
+
+                ranges[network.version].append(
+                    (int(network.network_address), int(network.broadcast_address))
+                )
+
+        intervals = {}
+
+        for version, networks in ranges.items():
+            starts: List[int] = []
+            ends: List[int] = []
+
+            for start, end in sorted(networks):
+                if ends and start <= ends[-1] + 1:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+
+            intervals[version] = (starts, ends)
+
+        # Swap in one assignment so concurrent lookups never see a partial list
+        self._intervals = intervals
+
+        self.logger.info(
+            f"Loaded {sum(len(n) for n in ranges.values())} networks from {self.path}"
+        )
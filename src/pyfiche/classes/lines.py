@@ -1,13 +1,46 @@
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import urlparse
-from typing import Union, Optional
+from urllib.parse import parse_qs, urlparse
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Union, Optional, List, Tuple, BinaryIO, Iterator
 
 import logging
 import pathlib
-import cgi
-import ipaddress
+import os
+import gzip
+import io
+import math
+import secrets
+import socket
+import sys
+import time
 
 from .fiche import FicheServer
+from .cache import PasteCache
+from .index import PasteIndex, PasteInfo
+from .ipfilter import IPFilter
+from .metrics import CONTENT_TYPE, REGISTRY, ServerMetrics, serve_metrics
+from .multipart import FormPart, MultipartError, MultipartParser
+from .pool import WorkerPool
+from .prefork import Prefork
+from .ratelimit import RateLimiter, rate_limit_message
+from .reaper import Reaper
+from .slugs import SlugAllocator
+from .storage import (
+    COPY_CHUNK_SIZE,
+    GZIP_VARIANT_SUFFIX,
+    SNIFF_SIZE,
+    Paste,
+    PasteStorage,
+    PasteUpload,
+    detect_mime,
+    sniff_binary,
+    send_file,
+    write_gzip_variant,
+)
+
+
+class UploadTooLarge(Exception):
+    pass
 
 
 class LinesHTTPRequestHandler(BaseHTTPRequestHandler):
@@ -65,153 +98,384 @@ body {{
     )
 
     server_version = "PyFiche Lines/dev"
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this, Nagle's
+    # algorithm stalls every response on keep-alive connections
+    disable_nagle_algorithm = True
+
+    CACHE_CONTROL = "public, max-age=31536000, immutable"
+    MAX_RANGES = 16
+    MIN_COMPRESS_SIZE = 256
+    MIN_COMPRESS_RATIO = 0.9
+    # Room for boundaries, part headers and other fields around the paste
+    # in form uploads
+    MAX_FORM_OVERHEAD = 65536
+    MAX_FIELD_SIZE = 1024
+    MAX_CHUNK_LINE = 1024
+    UPLOAD_METHODS = ("POST", "PUT")
+    MAX_TRAILERS = 100
+
+    # Expiry time of the paste being sent, if any
+    expires: Optional[float] = None
 
     def do_POST(self):
         client_ip, client_port = self.client_address
+        started = time.monotonic()
 
-        self.logger.info(f"POST request from {client_ip}:{client_port}")
+        self.logger.info(f"{self.command} request from {client_ip}:{client_port}")
 
-        if (not self.check_allowlist(client_ip)) or self.check_banlist(client_ip):
+        if not self.check_access(client_ip):
             self.logger.info(f"Rejected request from {client_ip}:{client_port}")
             return self.not_found()
 
-        # Reject any POST requests that aren't to /
+        wait = self.ratelimiter.check(client_ip)
+        if wait is not None:
+            return self.too_many_requests(wait)
 
-        url = urlparse(self.path.rstrip("/"))
+        # Reject any uploads that aren't to /
 
-        if url.path != "":
-            return self.not_found()
+        url = urlparse(self.path)
 
-        # Check if we are handling form data
-        if (
-            "Content-Type" in self.headers
-            and "multipart/form-data" in self.headers["Content-Type"]
-        ):
-            form_data = cgi.FieldStorage(
-                fp=self.rfile,
-                headers=self.headers,
-                environ={
-                    "REQUEST_METHOD": "POST",
-                    "CONTENT_TYPE": self.headers["Content-Type"],
-                },
-            )
+        if url.path.rstrip("/") != "":
+            return self.not_found()
 
-            content = form_data.getvalue("file")
+        expires = parse_qs(url.query).get("expires", [None])[0]
 
-            if len(content) > self.max_size:
+        with self.storage.upload(digest=self.index is not None) as upload:
+            try:
+                # Check if we are handling form data
+                if self.headers.get_content_type() == "multipart/form-data":
+                    expires = self.read_form(upload, expires)
+                else:
+                    self.read_body(upload)
+            except UploadTooLarge:
                 return self.file_too_large()
-
-        else:
-            if "Content-Length" not in self.headers:
+            except ValueError:
+                # Also raised for malformed forms, see MultipartError
                 return self.invalid_request()
 
-            if not self.headers["Content-Length"].isdigit():
+            if not upload.size:
+                return self.not_found()
+
+            self.metrics.received.inc(upload.size)
+            self.ratelimiter.charge(client_ip, upload.size)
+            self.metrics.upload_duration.observe(time.monotonic() - started)
+
+            try:
+                ttl = self.get_ttl(expires)
+            except ValueError:
                 return self.invalid_request()
 
-            if int(self.headers["Content-Length"]) > self.max_size:
-                return self.file_too_large()
+            try:
+                slug = self.slugs.allocate(upload.size)
+            except (OSError, RuntimeError) as e:
+                # The upload is discarded when leaving the with block
+                self.logger.error(f"Error allocating slug: {e}")
+                return self.service_unavailable()
 
-            content_length = int(self.headers["Content-Length"])
-            content = self.rfile.read(content_length)
+            try:
+                write_started = time.perf_counter()
+                self.storage.commit(upload, slug)
+                self.metrics.disk_write.observe(time.perf_counter() - write_started)
+            except Exception:
+                self.storage.release(slug)
+                raise
+
+            # Indexed once the paste exists, see FicheServer.store_upload()
+            if self.index:
+                try:
+                    self.index.add(
+                        PasteInfo.from_upload(slug, upload, client_ip, ttl)
+                    )
+                except Exception:
+                    self.storage.remove(slug)
+                    raise
 
-            if len(content) != content_length:
-                return self.invalid_request()
+        # Redirect the user to the new file
 
-        if not content:
-            return self.not_found()
+        self.send_response(303)
+        self.send_header("Location", f"/{slug}")
+        self.send_header("Content-Length", 0)
+        self.end_headers()
 
-        slug = FicheServer().generate_slug(
-            self.slug_size, self.FICHE_SYMBOLS, self.data_dir
-        )
+        self.metrics.paste_size.observe(upload.size)
+        self.metrics.time_to_url.observe(time.monotonic() - started)
 
-        file_path = self.data_dir / slug / self.DATA_FILE_NAME
+    # Same as POST with a raw body, for curl -T and the like
+    do_PUT = do_POST
 
-        file_path.parent.mkdir(parents=True, exist_ok=True)
+    def handle_expect_100(self):
+        # Refuses uploads before the client sends them, rather than after
+        if self.command in self.UPLOAD_METHODS:
+            client_ip, client_port = self.client_address
 
-        if isinstance(content, str):
-            content = content.encode("utf-8")
+            if not self.check_access(client_ip):
+                self.logger.info(f"Rejected request from {client_ip}:{client_port}")
+                self.not_found()
+                return False
 
-        with file_path.open("wb") as f:
-            f.write(content)
+            length = self.headers.get("Content-Length", "")
 
-        # Redirect the user to the new file
+            if length.isdigit() and int(length) > self.body_limit():
+                self.file_too_large()
+                return False
 
-        self.send_response(303)
-        self.send_header("Location", f"/{slug}")
+        return super().handle_expect_100()
+
+    def body_limit(self) -> int:
+        # Largest request body accepted for an upload
+        if self.headers.get_content_type() == "multipart/form-data":
+            return self.max_size + self.MAX_FORM_OVERHEAD
+
+        return self.max_size
+
+    def content_length(self) -> int:
+        value = self.headers.get("Content-Length", "")
+
+        if not value.isdigit():
+            raise ValueError(f"Invalid Content-Length: {value}")
+
+        return int(value)
+
+    def read_request_body(self) -> Iterator[bytes]:
+        # Returns the request body in chunks as it arrives, refusing bodies
+        # larger than body_limit() before reading past it
+        limit = self.body_limit()
+        encoding = self.headers.get("Transfer-Encoding")
+
+        # Takes precedence over any Content-Length
+        if encoding is not None:
+            if encoding.strip().lower() != "chunked":
+                raise ValueError(f"Unsupported Transfer-Encoding: {encoding}")
+
+            return self.read_chunked(limit)
+
+        length = self.content_length()
+
+        if length > limit:
+            raise UploadTooLarge()
+
+        return self.read_chunks(length)
+
+    def read_chunks(self, length: int) -> Iterator[bytes]:
+        # Yields length bytes of the request body in chunks as they arrive
+        while length:
+            chunk = self.rfile.read1(min(length, COPY_CHUNK_SIZE))
+            if not chunk:
+                raise ValueError("Request body ended early")
+
+            length -= len(chunk)
+            yield chunk
+
+    def read_chunk_line(self) -> bytes:
+        line = self.rfile.readline(self.MAX_CHUNK_LINE + 1)
+
+        if len(line) > self.MAX_CHUNK_LINE or not line.endswith(b"\n"):
+            raise ValueError("Invalid chunk")
+
+        return line.rstrip(b"\r\n")
+
+    def read_chunked(self, limit: int) -> Iterator[bytes]:
+        # Decodes a body with chunked transfer encoding (RFC 9112, 7.1)
+        received = 0
+
+        while True:
+            # Chunk extensions after the size are ignored
+            size = self.read_chunk_line().split(b";", 1)[0].strip()
+
+            if not size or len(size) > 16 or size.strip(b"0123456789abcdefABCDEF"):
+                raise ValueError(f"Invalid chunk size: {size!r}")
+
+            size = int(size, 16)
+            if not size:
+                break
+
+            # Refused by its size, before any of the chunk is read
+            received += size
+            if received > limit:
+                raise UploadTooLarge()
+
+            yield from self.read_chunks(size)
+
+            if self.read_chunk_line():
+                raise ValueError("Invalid chunk")
+
+        # Trailer fields are read and ignored
+        for _ in range(self.MAX_TRAILERS):
+            if not self.read_chunk_line():
+                return
+
+        raise ValueError("Too many trailer fields")
+
+    def write_upload(self, upload: PasteUpload, data: bytes):
+        # Refuses uploads as soon as they get too large, not once read
+        if upload.size + len(data) > self.max_size:
+            raise UploadTooLarge()
+
+        upload.write(data)
+
+    def read_body(self, upload: PasteUpload):
+        for chunk in self.read_request_body():
+            upload.write(chunk)
+
+    def read_form(self, upload: PasteUpload, expires: Optional[str]) -> Optional[str]:
+        # Streams the file field of a form into upload, returns the expires
+        # field if there is one
+        boundary = self.headers.get_param("boundary")
+        if not boundary:
+            raise MultipartError("Missing boundary")
+
+        body = self.read_request_body()
+        fields = {}
+
+        def write_field(data: bytes, field: bytearray):
+            if len(field) + len(data) > self.MAX_FIELD_SIZE:
+                raise MultipartError("Form field too large")
+            field += data
+
+        def sink(part: FormPart):
+            if part.name == "file":
+                return lambda data: self.write_upload(upload, data)
+
+            if part.name == "expires":
+                field = fields[part.name] = bytearray()
+                return lambda data: write_field(data, field)
+
+            return None
+
+        parser = MultipartParser(boundary.encode("latin-1"), sink)
+
+        for chunk in body:
+            parser.feed(chunk)
+
+        parser.close()
+
+        if "expires" in fields:
+            return fields["expires"].decode("latin-1")
+
+        return expires
+
+    def get_ttl(self, value: Optional[str]) -> int:
+        if value is None:
+            return self.expiry
+
+        # Expiry times are kept in the index, so without one they're refused
+        if not value.isdigit() or not int(value) or not self.index:
+            raise ValueError(f"Invalid expiry: {value}")
+
+        # Clients may shorten the server's expiry time, but not extend it
+        return min(int(value), self.expiry) if self.expiry else int(value)
+
+    def send_metrics(self):
+        body = REGISTRY.render()
+
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", len(body))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.write_body(body)
+
+    def send_text(self, code: int, body: bytes, close: bool = False):
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", len(body))
+        # If a request body may still be unread, the connection can't be reused
+        if close:
+            self.send_header("Connection", "close")
         self.end_headers()
+        self.write_body(body)
 
     def invalid_request(self):
-        self.send_response(400)
-        self.end_headers()
-        self.wfile.write(b"Invalid request")
+        self.send_text(400, b"Invalid request", close=True)
 
     def file_too_large(self):
-        self.send_response(413)
-        self.end_headers()
-        self.wfile.write(b"File too large")
+        self.send_text(413, b"File too large", close=True)
 
     def not_found(self):
-        self.send_response(404)
+        self.send_text(404, b"Not found", close=self.command in self.UPLOAD_METHODS)
+
+    def service_unavailable(self):
+        self.send_text(503, b"Service unavailable")
+
+    def too_many_requests(self, wait: float):
+        client_ip, client_port = self.client_address
+        self.logger.info(f"Rate limited request from {client_ip}:{client_port}")
+        self.metrics.rejected["rate_limited"].inc()
+
+        body = rate_limit_message(wait)
+        self.send_response(429)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", len(body))
+        self.send_header("Retry-After", math.ceil(wait))
+        if self.command in self.UPLOAD_METHODS:
+            self.send_header("Connection", "close")
         self.end_headers()
-        self.wfile.write(b"Not found")
+        self.write_body(body)
+
+    def count_sent(self, size: int):
+        self.metrics.sent.inc(size)
+        self.ratelimiter.charge(self.client_address[0], size)
+
+    def check_access(self, addr) -> bool:
+        if self.check_banlist(addr):
+            self.metrics.rejected["banned"].inc()
+            return False
+
+        if not self.check_allowlist(addr):
+            self.metrics.rejected["not_allowed"].inc()
+            return False
+
+        return True
 
     def check_allowlist(self, addr):
         if not self.allowlist:
             return True
 
         try:
-            ip = ipaddress.ip_address(addr)
-            with open(self.allowlist, "r") as file:
-                for line in file:
-                    line = line.strip()
-                    if line:
-                        network = ipaddress.ip_network(line, strict=False)
-                        if ip in network:
-                            return True
+            return addr in IPFilter.for_path(self.allowlist, self.logger)
         except ValueError as e:
             self.logger.error(f"Invalid IP address or network: {e}")
             return False
 
-        return False
-
     def check_banlist(self, addr):
         if not self.banlist:
             return False
 
         try:
-            ip = ipaddress.ip_address(addr)
-            with open(self.banlist, "r") as file:
-                for line in file:
-                    line = line.strip()
-                    if line:
-                        network = ipaddress.ip_network(line, strict=False)
-                        if ip in network:
-                            return True
+            return addr in IPFilter.for_path(self.banlist, self.logger)
         except ValueError as e:
             self.logger.error(f"Invalid IP address or network: {e}")
             return False
 
-        return False
-
     def do_GET(self):
         client_ip, client_port = self.client_address
 
-        if (not self.check_allowlist(client_ip)) or self.check_banlist(client_ip):
+        if not self.check_access(client_ip):
             self.logger.info(f"Rejected request from {client_ip}:{client_port}")
             return self.not_found()
 
+        wait = self.ratelimiter.check(client_ip)
+        if wait is not None:
+            return self.too_many_requests(wait)
+
         self.logger.info(f"GET request from {client_ip}:{client_port}")
 
         url = urlparse(self.path.rstrip("/"))
 
+        if self.metrics_path and url.path == self.metrics_path.rstrip("/"):
+            return self.send_metrics()
+
         # If the URL is /, display the index page
         if url.path == "":
+            content = self.INDEX_CONTENT.encode("utf-8")
+
             self.send_response(200)
-            self.send_header("Content-Type", "text/html")
-            self.send_header("Content-Length", len(self.INDEX_CONTENT))
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", len(content))
             self.end_headers()
 
-            self.wfile.write(self.INDEX_CONTENT.encode("utf-8"))
+            self.write_body(content)
             return
 
         # Discard any URLs that aren't of the form /<slug> or /<slug>/raw
@@ -231,13 +495,157 @@ body {{
         if any([c not in self.FICHE_SYMBOLS for c in slug]):
             return self.not_found()
 
-        file_path = self.data_dir / slug / self.DATA_FILE_NAME
+        info = self.index.get(slug) if self.index else None
+        self.expires = info.expires if info else None
+
+        # A complete index knows every paste, so misses don't touch the disk,
+        # and expired pastes are gone even before the reaper removes them
+        if (info is None and self.index and self.index.complete) or (
+            info and info.expired
+        ):
+            self.cache.invalidate(slug)
+            return self.not_found()
+
+        paste = self.storage.find(slug)
+
+        if paste is None:
+            self.cache.invalidate(slug)
+            return self.not_found()
+
+        if raw:
+            return self.send_raw(paste, info)
+
+        return self.send_html(paste, info)
+
+    def send_raw(self, paste: Paste, info: Optional[PasteInfo] = None):
+        slug, stat = paste.slug, paste.stat
+        gzip_path = paste.path.with_name(self.storage.FILE_NAME + GZIP_VARIANT_SUFFIX)
+        gzip_stat = None
+
+        # Ranges always refer to the uncompressed file. Pastes in segments
+        # are too small to be worth a compressed variant.
+        if (
+            "Range" not in self.headers
+            and self.accepts_gzip()
+            and paste.segment is None
+        ):
+            if paste.codec == "gzip":
+                # Stored gzip-compressed already, send it as it is
+                gzip_stat = stat
+            elif stat.st_size >= self.MIN_COMPRESS_SIZE:
+                gzip_stat = self.get_gzip_variant(paste, gzip_path)
+
+        view = "raw.gzip" if gzip_stat else "raw"
+        etag = self.get_etag(stat, "gzip" if gzip_stat else "")
+
+        if self.is_not_modified(etag, stat):
+            return self.send_not_modified(etag, stat)
+
+        if "Range" not in self.headers:
+            cached = self.cache.get((slug, view), etag)
 
-        if not file_path.exists():
+            if cached is not None:
+                headers, body = cached
+                return self.send_paste(headers, body, etag, stat)
+
+        try:
+            if gzip_stat:
+                f = open(gzip_path, "rb")
+            elif paste.codec:
+                # Pastes are small enough to be decompressed into memory,
+                # which also makes them seekable for ranges
+                f = io.BytesIO(paste.read())
+            else:
+                f = paste.open()
+        except (FileNotFoundError, NotADirectoryError):
+            self.cache.invalidate(slug)
             return self.not_found()
 
-        with open(file_path, "rb") as f:
-            content = f.read()
+        with f:
+            if gzip_stat:
+                size = gzip_stat.st_size
+            else:
+                size = len(f.getvalue()) if paste.codec else stat.st_size
+
+            if info is not None:
+                binary, content_type = info.binary, info.mime
+            elif gzip_stat and paste.codec != "gzip":
+                # Only text pastes get a compressed variant
+                binary, content_type = False, "text/plain"
+            else:
+                if gzip_stat:
+                    head = self.read_head(paste)
+                    binary = sniff_binary(head, len(head) < SNIFF_SIZE)
+                else:
+                    head = f.read(SNIFF_SIZE)
+                    binary = sniff_binary(head, size <= SNIFF_SIZE)
+
+                content_type = detect_mime(head, binary)
+
+            disposition = f'attachment; filename="{slug}.{"bin" if binary else "txt"}"'
+
+            if gzip_stat:
+                headers = (
+                    ("Content-Type", content_type),
+                    ("Content-Encoding", "gzip"),
+                    ("Content-Disposition", disposition),
+                )
+
+            else:
+                ranges = self.get_ranges(etag, stat, size)
+
+                if ranges is not None:
+                    return self.send_ranges(
+                        f, ranges, stat, size, etag, content_type, disposition
+                    )
+
+                headers = (
+                    ("Content-Type", content_type),
+                    ("Content-Disposition", disposition),
+                    ("Accept-Ranges", "bytes"),
+                )
+
+            # Small files are kept in memory, anything else is sent from
+            # the file with sendfile()
+            if size > self.cache.max_entry_bytes:
+                return self.send_paste(headers, f, etag, stat, size)
+
+            f.seek(0)
+            body = f.read()
+
+        self.cache_paste(slug, view, etag, headers, body)
+        self.send_paste(headers, body, etag, stat)
+
+    def send_html(self, paste: Paste, info: Optional[PasteInfo] = None):
+        slug, stat = paste.slug, paste.stat
+
+        # Whether the page ends up compressed only depends on the paste, so
+        # all clients accepting gzip get the same bytes for this tag
+        view = "html.gzip" if self.accepts_gzip() else "html"
+
+        # The HTML page and the raw file are different representations
+        # of the same paste, so they need different entity tags
+        etag = self.get_etag(stat, view.replace(".", "-"))
+
+        if self.is_not_modified(etag, stat):
+            return self.send_not_modified(etag, stat)
+
+        cached = self.cache.get((slug, view), etag)
+
+        if cached is not None:
+            headers, body = cached
+            return self.send_paste(headers, body, etag, stat)
+
+        if info is not None and info.binary:
+            # No need to read a binary paste that is not displayed anyway
+            content = b""
+            binary = True
+        else:
+            try:
+                content = paste.read()
+            except (FileNotFoundError, NotADirectoryError):
+                self.cache.invalidate(slug)
+                return self.not_found()
 
             try:
                 content.decode("utf-8")
@@ -245,43 +653,329 @@ body {{
             except UnicodeDecodeError:
                 binary = True
 
-            self.send_response(200)
+        if binary:
+            content = (
+                f'Binary file - cannot display. <a href="{slug}/raw">Download</a>'
+            )
+        else:
+            content = f'Displaying text file content below. <a href="{slug}/raw">Download</a><br><br><code>{content.decode("utf-8")}</code>'
+
+        headers = (("Content-Type", "text/html; charset=utf-8"),)
+        body = self.BASE_HTML.format(content=content).encode("utf-8")
+
+        if view == "html.gzip" and len(body) >= self.MIN_COMPRESS_SIZE:
+            compressed = gzip.compress(body, mtime=0)
+
+            if len(compressed) < len(body) * self.MIN_COMPRESS_RATIO:
+                headers += (("Content-Encoding", "gzip"),)
+                body = compressed
+
+        self.cache_paste(slug, view, etag, headers, body)
+        self.send_paste(headers, body, etag, stat)
+
+    def cache_paste(
+        self,
+        slug: str,
+        view: str,
+        etag: str,
+        headers: Tuple[Tuple[str, str], ...],
+        body: bytes,
+    ):
+        self.cache.put((slug, view), etag, (headers, body), len(body))
+        self.logger.debug(
+            f"Cached {view} view of {slug} ({len(body)} bytes, "
+            f"hits: {self.cache.hits}, misses: {self.cache.misses})"
+        )
 
-            if raw:
-                # Veeeeery basic MIME type detection - TODO?
-                self.send_header(
-                    "Content-Type",
-                    "application/octet-stream" if binary else "text/plain",
-                )
-                self.send_header("Content-Length", len(content))
-                self.send_header(
-                    "Content-Disposition",
-                    f'attachment; filename="{slug}.{"bin" if binary else "txt"}"',
-                )
-                self.end_headers()
+    def send_paste(
+        self,
+        headers: Tuple[Tuple[str, str], ...],
+        body: Union[bytes, BinaryIO],
+        etag: str,
+        stat: os.stat_result,
+        size: Optional[int] = None,
+    ):
+        self.send_response(200)
+
+        for name, value in headers:
+            self.send_header(name, value)
+
+        if isinstance(body, bytes):
+            self.send_header("Content-Length", len(body))
+            self.send_validators(etag, stat)
+            self.end_headers()
+            self.write_body(body)
+            return
 
-                self.wfile.write(content)
-                return
+        self.send_header("Content-Length", stat.st_size if size is None else size)
+        self.send_validators(etag, stat)
+        self.end_headers()
+
+        if self.command != "HEAD":
+            self.count_sent(send_file(self.connection, body))
+
+    def accepts_gzip(self) -> bool:
+        for coding in self.headers.get("Accept-Encoding", "").split(","):
+            name, _, params = coding.partition(";")
+
+            if name.strip().lower() not in ("gzip", "x-gzip", "*"):
+                continue
+
+            for param in params.split(";"):
+                key, _, value = param.partition("=")
 
-            if binary:
-                content = (
-                    f'Binary file - cannot display. <a href="{slug}/raw">Download</a>'
+                if key.strip().lower() == "q":
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+
+            return True
+
+        return False
+
+    def read_head(self, paste: Paste) -> bytes:
+        with paste.open() as f:
+            return f.read(SNIFF_SIZE)
+
+    def get_gzip_variant(
+        self, paste: Paste, gzip_path: pathlib.Path
+    ) -> Optional[os.stat_result]:
+        # Pastes are compressed once, on the first request that accepts gzip.
+        # An empty variant marks pastes that are binary or don't compress.
+        try:
+            gzip_stat = os.stat(gzip_path)
+        except FileNotFoundError:
+            try:
+                write_gzip_variant(
+                    paste, gzip_path, self.MIN_COMPRESS_RATIO, self.storage.root
                 )
-            else:
-                content = f'Displaying text file content below. <a href="{slug}/raw">Download</a><br><br><code>{content.decode("utf-8")}</code>'
+                gzip_stat = os.stat(gzip_path)
+            except OSError as e:
+                self.logger.error(f"Could not compress {paste.path}: {e}")
+                return None
+
+        return gzip_stat if gzip_stat.st_size else None
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def write_body(self, body: bytes):
+        if self.command != "HEAD":
+            self.wfile.write(body)
+            self.count_sent(len(body))
+
+    def get_etag(self, stat: os.stat_result, variant: str = "") -> str:
+        # Pastes are never modified after they have been written, so inode,
+        # size and modification time identify the content
+        tag = f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+        return f'"{tag}-{variant}"' if variant else f'"{tag}"'
+
+    def send_validators(self, etag: str, stat: os.stat_result):
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(stat.st_mtime, usegmt=True))
+
+        if self.expires is None:
+            self.send_header("Cache-Control", self.CACHE_CONTROL)
+            return
+
+        # Caches must not keep a paste past its expiry
+        max_age = max(min(int(self.expires - time.time()), 31536000), 0)
+        self.send_header("Cache-Control", f"public, max-age={max_age}")
+        self.send_header("Expires", formatdate(self.expires, usegmt=True))
+
+    def is_not_modified(self, etag: str, stat: os.stat_result) -> bool:
+        if_none_match = self.headers.get("If-None-Match")
+
+        # If-None-Match takes precedence over If-Modified-Since (RFC 9110)
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            return "*" in tags or any(
+                tag.removeprefix("W/") == etag for tag in tags
+            )
+
+        if_modified_since = self.headers.get("If-Modified-Since")
+
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+
+            return int(stat.st_mtime) <= since
+
+        return False
+
+    def send_not_modified(self, etag: str, stat: os.stat_result):
+        self.send_response(304)
+        self.send_validators(etag, stat)
+        self.end_headers()
+
+    def get_ranges(
+        self, etag: str, stat: os.stat_result, size: int
+    ) -> Optional[List[Tuple[int, int]]]:
+        # Returns None if the whole file should be sent, an empty list if the
+        # requested ranges can't be satisfied, and (start, end) pairs with
+        # inclusive ends otherwise.
+        header = self.headers.get("Range")
+
+        if header is None:
+            return None
+
+        if_range = self.headers.get("If-Range")
+
+        if if_range is not None:
+            if_range = if_range.strip()
+
+            # If-Range requires a strong match: weak tags never match and
+            # dates must be identical to Last-Modified
+            if if_range.startswith('"') or if_range.startswith("W/"):
+                if if_range != etag:
+                    return None
+            elif if_range != formatdate(stat.st_mtime, usegmt=True):
+                return None
+
+        unit, _, specs = header.partition("=")
+
+        if unit.strip().lower() != "bytes":
+            return None
 
-            full_html = self.BASE_HTML.format(content=content)
+        ranges = []
 
-            self.send_header("Content-Type", "text/html")
-            self.send_header("Content-Length", len(full_html))
+        for spec in specs.split(","):
+            start, sep, end = spec.strip().partition("-")
+
+            if not sep:
+                return None
+
+            try:
+                if not start:
+                    # Suffix range: the last <end> bytes
+                    length = int(end)
+                    if length <= 0:
+                        continue
+                    ranges.append((max(size - length, 0), size - 1))
+                    continue
+
+                start = int(start)
+                end = int(end) if end else None
+            except ValueError:
+                return None
+
+            if end is not None and start > end:
+                return None
+
+            if start < size:
+                end = size - 1 if end is None else min(end, size - 1)
+                ranges.append((start, end))
+
+        # Refuse to split a file into an absurd number of parts
+        if len(ranges) > self.MAX_RANGES:
+            return None
+
+        return ranges
+
+    def send_ranges(
+        self,
+        f,
+        ranges: List[Tuple[int, int]],
+        stat: os.stat_result,
+        size: int,
+        etag: str,
+        content_type: str,
+        disposition: str,
+    ):
+        if not ranges:
+            body = b"Requested range not satisfiable"
+
+            self.send_response(416)
+            self.send_header("Content-Type", "text/plain")
+            self.send_header("Content-Length", len(body))
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            self.write_body(body)
+            return
+
+        self.send_response(206)
+        self.send_header("Content-Disposition", disposition)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_validators(etag, stat)
+
+        if len(ranges) == 1:
+            start, end = ranges[0]
+
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            self.send_header("Content-Length", end - start + 1)
             self.end_headers()
 
-            self.wfile.write(full_html.encode("utf-8"))
+            if self.command != "HEAD":
+                sent = send_file(self.connection, f, start, end - start + 1)
+                self.count_sent(sent)
+            return
+
+        boundary = secrets.token_hex(16)
+        parts = [
+            (
+                f"\r\n--{boundary}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n"
+                "\r\n"
+            ).encode("ascii")
+            for start, end in ranges
+        ]
+        trailer = f"\r\n--{boundary}--\r\n".encode("ascii")
+
+        self.send_header(
+            "Content-Type", f"multipart/byteranges; boundary={boundary}"
+        )
+        self.send_header(
+            "Content-Length",
+            sum(len(part) for part in parts)
+            + sum(end - start + 1 for start, end in ranges)
+            + len(trailer),
+        )
+        self.end_headers()
+
+        if self.command == "HEAD":
+            return
+
+        for part, (start, end) in zip(parts, ranges):
+            self.wfile.write(part)
+            sent = send_file(self.connection, f, start, end - start + 1)
+            self.count_sent(len(part) + sent)
+
+        self.wfile.write(trailer)
 
 
 def make_lines_handler(
-    data_dir, logger, banlist=None, allowlist=None, max_size=5242880, slug_size=8
+    data_dir,
+    logger,
+    banlist=None,
+    allowlist=None,
+    max_size=5242880,
+    slug_size=8,
+    keepalive_timeout=5.0,
+    cache=None,
+    storage=None,
+    slugs=None,
+    index=None,
+    expiry=0,
+    metrics=None,
+    metrics_path=None,
+    ratelimiter=None,
 ):
+    cache = cache if cache is not None else PasteCache(0)
+    metrics = metrics if metrics is not None else ServerMetrics("lines")
+    ratelimiter = ratelimiter if ratelimiter is not None else RateLimiter()
+    storage = storage if storage is not None else PasteStorage(data_dir)
+    slugs = (
+        slugs
+        if slugs is not None
+        else SlugAllocator(storage, slug_size, FicheServer.FICHE_SYMBOLS, logger)
+    )
+
     class CustomHandler(LinesHTTPRequestHandler):
         def __init__(self, *args, **kwargs):
             self.data_dir: pathlib.Path = data_dir
@@ -290,16 +984,111 @@ def make_lines_handler(
             self.allowlist: Optional[pathlib.Path] = allowlist
             self.max_size: int = max_size
             self.slug_size: int = slug_size
+            # Applied to the socket in setup(), so idle keep-alive
+            # connections are closed after this many seconds
+            self.timeout: float = keepalive_timeout
+            self.cache: PasteCache = cache
+            self.storage: PasteStorage = storage
+            self.slugs: SlugAllocator = slugs
+            self.index: Optional[PasteIndex] = index
+            self.expiry: int = expiry
+            self.metrics: ServerMetrics = metrics
+            self.metrics_path: Optional[str] = metrics_path
+            self.ratelimiter: RateLimiter = ratelimiter
 
             super().__init__(*args, **kwargs)
 
     return CustomHandler
 
 
+class LinesHTTPServer(HTTPServer):
+    BUSY_RESPONSE = (
+        b"HTTP/1.1 503 Service Unavailable\r\n"
+        b"Content-Type: text/plain\r\n"
+        b"Content-Length: 12\r\n"
+        b"Connection: close\r\n"
+        b"\r\n"
+        b"Server busy\n"
+    )
+    # Same backlog as the sockets of Fiche and Recup; the default of 5
+    # resets connections when many clients connect at once
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(
+        self,
+        server_address,
+        handler_class,
+        max_connections: int,
+        queue_size: int,
+        logger: Optional[logging.Logger] = None,
+        metrics: Optional[ServerMetrics] = None,
+        sock: Optional[socket.socket] = None,
+    ):
+        super().__init__(server_address, handler_class, bind_and_activate=not sock)
+
+        if sock:
+            # Listening socket of a prefork worker
+            self.socket.close()
+            self.socket = sock
+            self.server_address = sock.getsockname()
+            self.server_name, self.server_port = self.server_address[:2]
+
+        self.metrics = metrics if metrics is not None else ServerMetrics("lines")
+        self.pool = WorkerPool(
+            self.process_request_thread,
+            max_connections,
+            queue_size,
+            logger,
+            self.reject_request,
+        )
+
+    def process_request(self, request, client_address):
+        self.pool.submit(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        self.metrics.accepted.inc()
+        self.metrics.in_flight.inc()
+
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.metrics.in_flight.dec()
+            self.shutdown_request(request)
+
+    def reject_request(self, request):
+        self.metrics.rejected["busy"].inc()
+
+        try:
+            request.sendall(self.BUSY_RESPONSE)
+        except OSError:
+            pass
+        finally:
+            self.shutdown_request(request)
+
+
 class LinesServer:
     port: int = 9997
     listen_addr: str = "0.0.0.0"
     max_size: int = 5242880  # 5 MB by default
+    slug_size: int = FicheServer.slug_size
+    shard_depth: int = 0
+    index_file: Optional[str] = None
+    segment_max: int = 0  # 0 to store every paste as a file
+    expiry: int = 0  # in seconds, 0 to keep pastes forever
+    reap_interval: float = FicheServer.reap_interval
+    metrics_port: int = 0  # 0 to disable
+    metrics_path: Optional[str] = None
+    rate_limit: float = 0.0  # requests per second per client, 0 to disable
+    byte_rate_limit: int = 0  # bytes per second per client, 0 to disable
+    workers: int = 1
+    max_connections: int = FicheServer.max_connections
+    queue_size: int = FicheServer.queue_size
+    keepalive_timeout: float = 5.0
+    cache_size: int = 67108864  # 64 MB by default, 0 to disable
+    compression: Optional[str] = None
+    dedup: bool = False
     _data_dir: pathlib.Path = pathlib.Path("data/")
     _log_file: Optional[pathlib.Path] = None
     _banlist: Optional[pathlib.Path] = None
@@ -369,30 +1158,148 @@ class LinesServer:
         lines.port = args.port or lines.port
         lines.listen_addr = args.listen_addr or lines.listen_addr
         lines.max_size = args.max_size or lines.max_size
+        lines.slug_size = args.slug_size or lines.slug_size
+        lines.shard_depth = args.shard_depth or lines.shard_depth
+        lines.index_file = args.index or lines.index_file
+        lines.segment_max = args.segment_max or lines.segment_max
+        lines.expiry = args.expiry or lines.expiry
+        if args.reap_interval is not None:
+            lines.reap_interval = args.reap_interval
+        lines.metrics_port = args.metrics_port or lines.metrics_port
+        lines.metrics_path = args.metrics_path or lines.metrics_path
+        lines.rate_limit = args.rate_limit or lines.rate_limit
+        lines.byte_rate_limit = args.byte_rate_limit or lines.byte_rate_limit
+        lines.workers = args.workers or lines.workers
         lines.data_dir = args.data_dir or lines.data_dir
         lines.log_file = args.log_file or lines.log_file
         lines.banlist = args.banlist or lines.banlist
         lines.allowlist = args.allowlist or lines.allowlist
+        lines.max_connections = args.max_connections or lines.max_connections
+        lines.queue_size = args.queue_size or lines.queue_size
+        lines.keepalive_timeout = args.keepalive_timeout or lines.keepalive_timeout
+        if args.cache_size is not None:
+            lines.cache_size = args.cache_size
+        if args.compression and args.compression != "none":
+            lines.compression = args.compression
+        lines.dedup = args.dedup or lines.dedup
 
         lines.logger = logging.getLogger("pyfiche")
         lines.logger.setLevel(logging.INFO if not args.debug else logging.DEBUG)
-        handler = (
-            logging.StreamHandler()
-            if not args.log_file
-            else logging.FileHandler(args.log_file)
-        )
-        handler.setFormatter(
-            logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-        )
-        lines.logger.addHandler(handler)
+
+        # Servers run together in one process share the logger
+        if not lines.logger.handlers:
+            handler = (
+                logging.StreamHandler()
+                if not args.log_file
+                else logging.FileHandler(args.log_file)
+            )
+            handler.setFormatter(
+                logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+            )
+            lines.logger.addHandler(handler)
 
         return lines
 
     def run(self):
+        if self.slug_size <= PasteStorage.SHARD_WIDTH * self.shard_depth:
+            self.logger.fatal("Slugs must be longer than the shard directory names!")
+            sys.exit(1)
+
+        if self.expiry and not self.index_file:
+            self.logger.fatal("Expiring pastes requires an index!")
+            sys.exit(1)
+
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+
+        removed = PasteUpload.cleanup(self.data_dir, FicheServer.STALE_UPLOAD_AGE)
+        if removed:
+            self.logger.info(f"Removed {removed} stale temporary upload files.")
+
+        # Forked before any thread or database connection exists
+        if self.workers > 1:
+            return Prefork(self.workers, self.logger).run(
+                self.listen_addr, self.port, self.serve
+            )
+
+        return self.serve()
+
+    @property
+    def storage(self) -> PasteStorage:
+        if not hasattr(self, "_storage"):
+            self._storage = PasteStorage(
+                self.data_dir,
+                self.compression,
+                self.dedup,
+                self.shard_depth,
+                self.segment_max,
+            )
+        return self._storage
+
+    @property
+    def index(self) -> Optional[PasteIndex]:
+        if self.index_file and not hasattr(self, "_index"):
+            self._index = PasteIndex(self.index_file)
+        return getattr(self, "_index", None)
+
+    @property
+    def slugs(self) -> SlugAllocator:
+        if not hasattr(self, "_slugs"):
+            self._slugs = SlugAllocator(
+                self.storage, self.slug_size, FicheServer.FICHE_SYMBOLS, self.logger
+            )
+        return self._slugs
+
+    @property
+    def cache(self) -> PasteCache:
+        if not hasattr(self, "_cache"):
+            self._cache = PasteCache(self.cache_size)
+        return self._cache
+
+    def serve(self, worker: int = 0, sock: Optional[socket.socket] = None):
+        self.slugs.load()
+
+        # One reaper is enough for all workers
+        if self.index and self.reap_interval and worker == 0:
+            Reaper(
+                self.storage, self.index, self.reap_interval, logger=self.logger
+            ).start()
+
+        if self.storage.segments and worker == 0:
+            released = self.storage.segments.sweep()
+            if released:
+                self.logger.info(f"Released {released} stale slug claims.")
+
+        metrics = ServerMetrics("lines", worker=worker if self.workers > 1 else None)
+
+        if self.metrics_port:
+            serve_metrics(self.metrics_port + worker, logger=self.logger)
+
         handler_class = make_lines_handler(
-            self.data_dir, self.logger, self.banlist, self.allowlist, self.max_size
+            self.data_dir,
+            self.logger,
+            self.banlist,
+            self.allowlist,
+            self.max_size,
+            self.slug_size,
+            keepalive_timeout=self.keepalive_timeout,
+            cache=self.cache,
+            storage=self.storage,
+            slugs=self.slugs,
+            index=self.index,
+            expiry=self.expiry,
+            metrics=metrics,
+            metrics_path=self.metrics_path,
+            ratelimiter=RateLimiter(self.rate_limit, self.byte_rate_limit),
         )
 
-        with HTTPServer((self.listen_addr, self.port), handler_class) as httpd:
+        with LinesHTTPServer(
+            (self.listen_addr, self.port),
+            handler_class,
+            self.max_connections,
+            self.queue_size,
+            self.logger,
+            metrics,
+            sock,
+        ) as httpd:
             self.logger.info(f"Listening on {self.listen_addr}:{self.port}")
             httpd.serve_forever()
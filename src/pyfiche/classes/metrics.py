@@ -0,0 +1,262 @@
+import bisect
+import logging
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+)
+DISK_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1
+)
+SIZE_BUCKETS = (
+    256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864
+)
+
+
+class Metric:
+    """Base class for metrics aggregated per thread.
+
+    Every thread updates a list of its own, so the hot path takes no lock
+    and no two threads ever write the same value. Reading a metric adds up
+    the lists of all threads, including threads that have ended."""
+
+    TYPE = "untyped"
+    size = 1
+
+    def __init__(self, name: str, help: str, labels: Dict[str, str]):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._local = threading.local()
+        self._cells: List[list] = []
+        self._lock = threading.Lock()
+
+    def _cell(self) -> list:
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = [0] * self.size
+
+            with self._lock:
+                self._cells.append(cell)
+
+            return cell
+
+    def values(self) -> List[float]:
+        with self._lock:
+            cells = list(self._cells)
+
+        return [sum(column) for column in zip(*cells)] or [0] * self.size
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        return [(self.name, self.labels, self.values()[0])]
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount: float = 1) -> None:
+        self._cell()[0] += amount
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def inc(self, amount: float = 1) -> None:
+        self._cell()[0] += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self._cell()[0] -= amount
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(
+        self, name: str, help: str, labels: Dict[str, str], buckets: Sequence[float]
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # One count per bucket plus +Inf, then the sum of all values
+        self.size = len(self.buckets) + 2
+
+    def observe(self, value: float) -> None:
+        cell = self._cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        values = self.values()
+        samples = []
+        count = 0
+
+        for bound, value in zip((*self.buckets, "+Inf"), values):
+            count += value
+            labels = {**self.labels, "le": str(bound)}
+            samples.append((f"{self.name}_bucket", labels, count))
+
+        samples.append((f"{self.name}_sum", self.labels, values[-1]))
+        samples.append((f"{self.name}_count", self.labels, count))
+        return samples
+
+
+class Registry:
+    """All metrics of a process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: Dict[Tuple[str, Tuple], Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name: str, help: str, labels: Dict[str, str], *args):
+        key = (name, tuple(sorted(labels.items())))
+
+        with self._lock:
+            if key not in self._metrics:
+                self._metrics[key] = cls(name, help, labels, *args)
+
+            return self._metrics[key]
+
+    def counter(self, name: str, help: str, labels: Dict[str, str]) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str, labels: Dict[str, str]) -> Gauge:
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Dict[str, str],
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def render(self) -> bytes:
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        seen = set()
+
+        # Metrics with the same name share one HELP and TYPE line
+        for metric in sorted(metrics, key=lambda metric: metric.name):
+            if metric.name not in seen:
+                seen.add(metric.name)
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+
+            for name, labels, value in metric.samples():
+                label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}")
+
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+REGISTRY = Registry()
+
+
+class ServerMetrics:
+    """Metrics reported by every server, labelled with the server's name,
+    and with the number of the worker process if there are several."""
+
+    REJECTION_REASONS = ("busy", "banned", "not_allowed", "rate_limited")
+
+    def __init__(
+        self,
+        server: str,
+        registry: Registry = REGISTRY,
+        worker: Optional[int] = None,
+    ):
+        labels = {"server": server}
+        if worker is not None:
+            labels["worker"] = str(worker)
+
+        self.accepted = registry.counter(
+            "pyfiche_connections_accepted_total", "Connections accepted", labels
+        )
+        self.rejected = {
+            reason: registry.counter(
+                "pyfiche_connections_rejected_total",
+                "Connections rejected",
+                {**labels, "reason": reason},
+            )
+            for reason in self.REJECTION_REASONS
+        }
+        self.in_flight = registry.gauge(
+            "pyfiche_connections_in_flight", "Connections being handled", labels
+        )
+        self.received = registry.counter(
+            "pyfiche_received_bytes_total", "Paste and request bytes received", labels
+        )
+        self.sent = registry.counter(
+            "pyfiche_sent_bytes_total", "Paste and response bytes sent", labels
+        )
+        self.upload_duration = registry.histogram(
+            "pyfiche_upload_duration_seconds",
+            "Time from the start of an upload until all data was received",
+            labels,
+        )
+        self.time_to_url = registry.histogram(
+            "pyfiche_time_to_url_seconds",
+            "Time from the start of an upload until the URL was sent",
+            labels,
+        )
+        self.paste_size = registry.histogram(
+            "pyfiche_paste_size_bytes", "Size of stored pastes", labels, SIZE_BUCKETS
+        )
+        self.disk_write = registry.histogram(
+            "pyfiche_disk_write_seconds",
+            "Time taken to write a paste to the data directory",
+            labels,
+            DISK_BUCKETS,
+        )
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry: Registry = REGISTRY
+    logger: Optional[logging.Logger] = None
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.logger:
+            self.logger.debug(f"Metrics request: {format % args}")
+
+
+def serve_metrics(
+    port: int,
+    listen_addr: str = "127.0.0.1",
+    registry: Registry = REGISTRY,
+    logger: Optional[logging.Logger] = None,
+) -> ThreadingHTTPServer:
+    # Serves /metrics from a thread of its own
+    handler = type(
+        "Handler", (MetricsHandler,), {"registry": registry, "logger": logger}
+    )
+    server = ThreadingHTTPServer((listen_addr, port), handler)
+    server.daemon_threads = True
+
+    threading.Thread(
+        target=server.serve_forever, name="pyfiche-metrics", daemon=True
+    ).start()
+
+    if logger:
+        logger.info(f"Serving metrics on http://{listen_addr}:{port}/metrics")
+
+    return server
@@ -0,0 +1,128 @@
+from email.parser import BytesHeaderParser
+from email.utils import collapse_rfc2231_value
+from typing import Callable, Optional
+
+
+class MultipartError(ValueError):
+    """The body is not valid multipart/form-data."""
+
+
+class FormPart:
+    """Headers of one part of a multipart/form-data body."""
+
+    def __init__(self, header_bytes: bytes):
+        headers = BytesHeaderParser().parsebytes(header_bytes)
+
+        self.name = self._param(headers, "name")
+        self.filename = self._param(headers, "filename")
+        self.content_type = headers.get_content_type()
+
+    @staticmethod
+    def _param(headers, param: str) -> Optional[str]:
+        value = headers.get_param(param, header="content-disposition")
+        return collapse_rfc2231_value(value) if value is not None else None
+
+
+class MultipartParser:
+    """Incremental parser for multipart/form-data bodies (RFC 7578).
+
+    The body is fed in chunks as it arrives. For every part, sink is called
+    with its headers and returns a callable that takes the part's data, or
+    None to skip the part. Data is passed on as soon as it can't be the
+    start of a boundary, so at most one chunk plus a boundary is held in
+    memory however large a part is."""
+
+    MAX_HEADER_SIZE = 16384  # of all headers of a part
+
+    _PREAMBLE, _HEADERS, _BODY, _DELIMITER, _END = range(5)
+
+    def __init__(
+        self,
+        boundary: bytes,
+        sink: Callable[[FormPart], Optional[Callable[[bytes], None]]],
+    ):
+        if not boundary or len(boundary) > 70:
+            raise MultipartError("Invalid boundary")
+
+        # The first boundary may be at the very start of the body, without
+        # the line break that comes before every other one
+        self.delimiter = b"\r\n--" + boundary
+        self.sink = sink
+        self.state = self._PREAMBLE
+        self._buffer = bytearray(b"\r\n")
+        self._write: Optional[Callable[[bytes], None]] = None
+
+    @property
+    def done(self) -> bool:
+        return self.state == self._END
+
+    def feed(self, data: bytes) -> None:
+        if self.state == self._END:
+            # Anything after the final boundary is an epilogue to ignore
+            return
+
+        self._buffer += data
+
+        while self._step():
+            pass
+
+    def close(self) -> None:
+        if self.state != self._END:
+            raise MultipartError("Body ended before the final boundary")
+
+    def _step(self) -> bool:
+        # Consumes what it can from the buffer, returns whether to go on
+        buffer = self._buffer
+
+        if self.state in (self._PREAMBLE, self._BODY):
+            index = buffer.find(self.delimiter)
+
+            if index < 0:
+                # The end of the buffer may be the start of a delimiter
+                keep = len(self.delimiter) - 1
+                if len(buffer) > keep:
+                    self._emit(buffer[:-keep])
+                    del buffer[:-keep]
+                return False
+
+            self._emit(buffer[:index])
+            del buffer[: index + len(self.delimiter)]
+            self.state = self._DELIMITER
+            return True
+
+        if self.state == self._DELIMITER:
+            if len(buffer) < 2:
+                return False
+
+            if buffer[:2] == b"--":
+                self.state = self._END
+                self._write = None
+                buffer.clear()
+                return False
+
+            if buffer[:2] != b"\r\n":
+                raise MultipartError("Invalid boundary")
+
+            del buffer[:2]
+            self.state = self._HEADERS
+            return True
+
+        if self.state == self._HEADERS:
+            index = buffer.find(b"\r\n\r\n")
+
+            if index < 0:
+                if len(buffer) > self.MAX_HEADER_SIZE:
+                    raise MultipartError("Part headers too large")
+                return False
+
+            part = FormPart(bytes(buffer[: index + 2]))
+            del buffer[: index + 4]
+            self._write = self.sink(part)
+            self.state = self._BODY
+            return True
+
+        return False
+
+    def _emit(self, data: bytearray) -> None:
+        if data and self.state == self._BODY and self._write:
+            self._write(bytes(data))
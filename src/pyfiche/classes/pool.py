@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import queue
+import socket
+import threading
+
+from typing import Callable, Optional, Tuple
+
+
+BUSY_MESSAGE = b"Server busy, please try again later.\n"
+
+
+def reject_connection(conn: socket.socket) -> None:
+    try:
+        conn.sendall(BUSY_MESSAGE)
+    except OSError:
+        pass
+    finally:
+        conn.close()
+
+
+async def reject_connection_async(writer: asyncio.StreamWriter) -> None:
+    try:
+        writer.write(BUSY_MESSAGE)
+        await writer.drain()
+        writer.close()
+        await writer.wait_closed()
+    except (ConnectionError, OSError):
+        pass
+
+
+class ByteBudget:
+    """Tracks the number of bytes held by all connections at the same time.
+
+    A limit of 0 disables the budget."""
+
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, size: int) -> bool:
+        with self._lock:
+            if self.limit and self.used + size > self.limit:
+                return False
+
+            self.used += size
+            return True
+
+    def release(self, size: int) -> None:
+        with self._lock:
+            self.used -= size
+
+
+class WorkerPool:
+    """Fixed number of worker threads fed from a bounded accept queue.
+
+    Connections that do not fit into the queue are rejected right away
+    instead of being accepted and left waiting."""
+
+    def __init__(
+        self,
+        handler: Callable[[socket.socket, Tuple[str, int]], None],
+        workers: int,
+        queue_size: int,
+        logger: Optional[logging.Logger] = None,
+        reject: Callable[[socket.socket], None] = reject_connection,
+    ):
+        self.handler = handler
+        self.logger = logger or logging.getLogger("pyfiche")
+        self.reject = reject
+        self.rejections = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+
+        for i in range(workers):
+            threading.Thread(
+                target=self._work, name=f"pyfiche-worker-{i}", daemon=True
+            ).start()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, conn: socket.socket, addr: Tuple[str, int]) -> bool:
+        try:
+            self._queue.put_nowait((conn, addr))
+        except queue.Full:
+            self.rejections += 1
+            self.logger.warning(
+                f"Rejected connection from {addr}: queue full "
+                f"(depth: {self.queue_depth}, rejections: {self.rejections})"
+            )
+            self.reject(conn)
+            return False
+
+        self.logger.debug(f"Queued connection from {addr} (depth: {self.queue_depth})")
+        return True
+
+    def _work(self) -> None:
+        while True:
+            conn, addr = self._queue.get()
+
+            try:
+                self.handler(conn, addr)
+            except Exception as e:
+                self.logger.error(f"Error handling connection from {addr}: {e}")
+            finally:
+                self._queue.task_done()
+
+
+class AsyncWorkerPool:
+    """asyncio counterpart of WorkerPool.
+
+    At most `workers` connections are handled at once and at most
+    `queue_size` more may wait for a free slot."""
+
+    def __init__(
+        self,
+        handler: Callable[[asyncio.StreamReader, asyncio.StreamWriter], "asyncio.Future"],
+        workers: int,
+        queue_size: int,
+        logger: Optional[logging.Logger] = None,
+        reject: Callable[
+            [asyncio.StreamWriter], "asyncio.Future"
+        ] = reject_connection_async,
+    ):
+        self.handler = handler
+        self.queue_size = queue_size
+        self.logger = logger or logging.getLogger("pyfiche")
+        self.reject = reject
+        self.rejections = 0
+        self.queue_depth = 0
+        self._slots = asyncio.Semaphore(workers)
+
+    async def submit(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        addr = writer.get_extra_info("peername")[:2]
+
+        if self._slots.locked() and self.queue_depth >= self.queue_size:
+            self.rejections += 1
+            self.logger.warning(
+                f"Rejected connection from {addr}: queue full "
+                f"(depth: {self.queue_depth}, rejections: {self.rejections})"
+            )
+            await self.reject(writer)
+            return
+
+        self.queue_depth += 1
+        self.logger.debug(f"Queued connection from {addr} (depth: {self.queue_depth})")
+
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queue_depth -= 1
+
+        try:
+            await self.handler(reader, writer)
+        finally:
+            self._slots.release()
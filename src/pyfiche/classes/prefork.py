@@ -0,0 +1,151 @@
+import logging
+import os
+import signal
+import socket
+import time
+
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+def listen_socket(
+    listen_addr: str, port: int, reuse_port: bool = False
+) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((listen_addr, port))
+        sock.listen(socket.SOMAXCONN)
+    except OSError:
+        sock.close()
+        raise
+
+    return sock
+
+
+class Prefork:
+    """Runs a server in several worker processes sharing one port.
+
+    Where SO_REUSEPORT is available, every worker binds a socket of its
+    own and the kernel spreads new connections over them. Elsewhere, the
+    master binds the socket before forking and all workers accept on it.
+    The master only supervises: it restarts workers that exit and stops
+    them all on SIGTERM or SIGINT.
+
+    The master must not have started any threads or opened any database
+    connections, as neither survives a fork()."""
+
+    RESTART_DELAY = 1.0  # minimum time between restarts of a worker
+
+    def __init__(
+        self,
+        workers: int,
+        logger: Optional[logging.Logger] = None,
+        reuse_port: Optional[bool] = None,
+    ):
+        self.workers = workers
+        self.logger = logger or logging.getLogger("pyfiche")
+        self.reuse_port = (
+            hasattr(socket, "SO_REUSEPORT") if reuse_port is None else reuse_port
+        )
+        self.restarts = 0
+        # PID -> worker number and start time
+        self._children: Dict[int, Tuple[int, float]] = {}
+        self._stopping = False
+        self._socket: Optional[socket.socket] = None
+
+    def run(
+        self,
+        listen_addr: str,
+        port: int,
+        serve: Callable[[int, socket.socket], Any],
+    ) -> int:
+        # serve(worker, sock) is called in every worker with its number,
+        # from 0, and the listening socket
+        if self.reuse_port:
+            # Fails here rather than in every worker if the port is taken
+            listen_socket(listen_addr, port, reuse_port=True).close()
+        else:
+            self._socket = listen_socket(listen_addr, port)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        self.logger.info(
+            f"Starting {self.workers} workers on {listen_addr}:{port} "
+            f"({'SO_REUSEPORT' if self.reuse_port else 'shared socket'})"
+        )
+
+        for worker in range(self.workers):
+            self.spawn(worker, listen_addr, port, serve)
+
+        while self._children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+
+            worker, started = self._children.pop(pid, (None, 0.0))
+            if worker is None or self._stopping:
+                continue
+
+            self.logger.error(
+                f"Worker {worker} (PID {pid}) exited with status "
+                f"{os.waitstatus_to_exitcode(status)}, restarting it"
+            )
+
+            # Don't restart a worker that fails right away in a tight loop
+            if time.monotonic() - started < self.RESTART_DELAY:
+                time.sleep(self.RESTART_DELAY)
+
+            if not self._stopping:
+                self.restarts += 1
+                self.spawn(worker, listen_addr, port, serve)
+
+        return 0
+
+    def spawn(
+        self,
+        worker: int,
+        listen_addr: str,
+        port: int,
+        serve: Callable[[int, socket.socket], Any],
+    ) -> None:
+        pid = os.fork()
+
+        if pid:
+            self._children[pid] = (worker, time.monotonic())
+            return
+
+        # The master stops the workers with SIGTERM, also on Ctrl+C
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        status = 1
+
+        try:
+            sock = self._socket or listen_socket(listen_addr, port, reuse_port=True)
+            serve(worker, sock)
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            self.logger.exception(f"Worker {worker} failed")
+        finally:
+            logging.shutdown()
+            # Never return into the master's code
+            os._exit(status)
+
+    def stop(self, signum=None, frame=None) -> None:
+        if self._stopping:
+            return
+
+        self._stopping = True
+        self.logger.info("Stopping workers...")
+
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,139 @@
+import math
+import socket
+import threading
+import time
+
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+
+class RateLimiter:
+    """Per-client and per-subnet token buckets for requests and bytes.
+
+    Every client address, and the /24 (IPv4) or /64 (IPv6) subnet it is in,
+    has a bucket of request tokens and a bucket of byte tokens, refilled at
+    the configured rate up to BURST seconds worth. A request takes one token
+    and is refused while any bucket of its client is empty. Bytes are only
+    known once they have been sent or received, so they are charged
+    afterwards and may take a bucket below zero, refusing further requests
+    until it has been refilled.
+
+    Buckets are kept in an LRU table of at most max_clients entries. The
+    least recently seen ones are dropped first; these are usually full
+    anyway, so memory stays flat however many addresses connect."""
+
+    BURST = 10.0  # seconds worth of tokens
+    SUBNET_PREFIXES = {4: 24, 6: 64}
+    SUBNET_FACTOR = 4  # subnets may use this many times a single client's rate
+    MAX_CLIENTS = 65536
+    IPV4_MAPPED = 0xFFFF00000000
+
+    def __init__(
+        self,
+        rate: float = 0.0,
+        byte_rate: float = 0.0,
+        burst: float = BURST,
+        max_clients: int = MAX_CLIENTS,
+    ):
+        self.rate = rate
+        self.byte_rate = byte_rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.limited = 0
+        # Key -> [request tokens, byte tokens, time of last update]
+        self._buckets: "OrderedDict[int, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __bool__(self) -> bool:
+        return bool(self.rate or self.byte_rate)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def keys(self, addr: str) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+        # The client's bucket and its subnet's, with the factor of each.
+        # Keys are integers rather than strings to keep the table small:
+        # the address as IPv6, with IPv4 as IPv4-mapped, and the inverted
+        # subnet address and prefix length for the subnet.
+        try:
+            value = int.from_bytes(socket.inet_pton(socket.AF_INET, addr), "big")
+            value |= self.IPV4_MAPPED
+        except OSError:
+            value = int.from_bytes(socket.inet_pton(socket.AF_INET6, addr), "big")
+
+        if value >> 32 == self.IPV4_MAPPED >> 32:
+            prefix = 96 + self.SUBNET_PREFIXES[4]
+        else:
+            prefix = self.SUBNET_PREFIXES[6]
+
+        subnet = ~((value >> (128 - prefix)) << 8 | prefix)
+        return (value, 1), (subnet, self.SUBNET_FACTOR)
+
+    def check(self, addr: str) -> Optional[float]:
+        """Takes a request token of addr.
+
+        Returns None if the request is allowed, or else the number of
+        seconds after which it would be."""
+
+        if not self:
+            return None
+
+        keys = self.keys(addr)
+        now = time.monotonic()
+        wait = 0.0
+
+        with self._lock:
+            buckets = [(self._bucket(key, factor, now), factor) for key, factor in keys]
+
+            for bucket, factor in buckets:
+                if self.rate and bucket[0] < 1:
+                    wait = max(wait, (1 - bucket[0]) / (self.rate * factor))
+                if self.byte_rate and bucket[1] < 0:
+                    wait = max(wait, -bucket[1] / (self.byte_rate * factor))
+
+            if wait:
+                self.limited += 1
+                return wait
+
+            for bucket, _ in buckets:
+                bucket[0] -= 1
+
+        return None
+
+    def charge(self, addr: str, size: int) -> None:
+        """Takes size byte tokens of addr for data sent or received."""
+
+        if not self.byte_rate or not size:
+            return
+
+        keys = self.keys(addr)
+        now = time.monotonic()
+
+        with self._lock:
+            for key, factor in keys:
+                self._bucket(key, factor, now)[1] -= size
+
+    def _bucket(self, key: int, factor: int, now: float) -> List[float]:
+        # Returns the bucket of key, refilled up to now
+        capacity = self.rate * factor * self.burst
+        byte_capacity = self.byte_rate * factor * self.burst
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            bucket = self._buckets[key] = [max(capacity, 1), byte_capacity, now]
+
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+
+            return bucket
+
+        self._buckets.move_to_end(key)
+        elapsed = now - bucket[2]
+        bucket[0] = min(bucket[0] + elapsed * self.rate * factor, max(capacity, 1))
+        bucket[1] = min(bucket[1] + elapsed * self.byte_rate * factor, byte_capacity)
+        bucket[2] = now
+        return bucket
+
+
+def rate_limit_message(wait: float) -> bytes:
+    return f"Too many requests, try again in {math.ceil(wait)} seconds.\n".encode()
@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+
+from typing import Optional
+
+from .index import PasteIndex
+from .storage import PasteStorage
+
+
+class Reaper:
+    """Removes expired pastes in the background.
+
+    Expired pastes come from the index, oldest first, so the data directory
+    is never scanned. They are removed in small batches with a pause in
+    between to leave the disk to the servers. Until a paste has been
+    removed, Recup and Lines already treat it as not found."""
+
+    def __init__(
+        self,
+        storage: PasteStorage,
+        index: PasteIndex,
+        interval: float = 60.0,
+        batch_size: int = 100,
+        pause: float = 0.1,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.storage = storage
+        self.index = index
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.logger = logger or logging.getLogger("pyfiche")
+        self.reaped = 0
+        self.busy = 0.0
+
+    def start(self) -> None:
+        threading.Thread(target=self.run, name="pyfiche-reaper", daemon=True).start()
+
+    def run(self) -> None:
+        while True:
+            try:
+                self.reap()
+            except Exception as e:
+                self.logger.error(f"Error removing expired pastes: {e}")
+
+            time.sleep(self.interval)
+
+    def reap(self, now: Optional[float] = None) -> int:
+        # Pastes expiring while this runs are left for the next round
+        now = time.time() if now is None else now
+        started = time.monotonic()
+        count = 0
+
+        while True:
+            slugs = self.index.expired(self.batch_size, now)
+            removed = []
+
+            for slug in slugs:
+                try:
+                    self.storage.remove(slug)
+                except FileNotFoundError:
+                    # Removed by another server's reaper at the same time
+                    pass
+                except OSError as e:
+                    # Kept in the index, so it is still not found and
+                    # removing it is retried in the next round
+                    self.logger.error(f"Could not remove expired paste {slug}: {e}")
+                    continue
+
+                removed.append(slug)
+
+            self.index.remove_many(removed)
+            count += len(removed)
+
+            if len(slugs) < self.batch_size or not removed:
+                break
+
+            time.sleep(self.pause)
+
+        elapsed = time.monotonic() - started
+        self.reaped += count
+        self.busy += elapsed
+
+        if count:
+            self.logger.info(
+                f"Removed {count} expired pastes in {elapsed:.2f} seconds "
+                f"(total: {self.reaped})"
+            )
+
+        return count
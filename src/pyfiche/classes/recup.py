@@ -3,22 +3,40 @@ import socket
 import pathlib
 import logging
 import argparse
-import ipaddress
 import os
 import sys
-import threading
+import asyncio
 
 from typing import Optional, Union
 
 from .fiche import FicheServer
+from .index import PasteIndex
+from .ipfilter import IPFilter
+from .metrics import ServerMetrics, serve_metrics
+from .pool import WorkerPool, AsyncWorkerPool, reject_connection, reject_connection_async
+from .prefork import Prefork, listen_socket
+from .ratelimit import RateLimiter, rate_limit_message
+from .storage import Paste, PasteStorage, copy_file, send_file
 
 class RecupServer:
     FICHE_SYMBOLS = FicheServer.FICHE_SYMBOLS
     DATA_FILE_NAME = FicheServer.OUTPUT_FILE_NAME
-    
+    ENGINES = FicheServer.ENGINES
+
     port: int = 9998
     listen_addr: str = '0.0.0.0'
     buffer_size: int = 16
+    engine: str = 'threading'
+    timeout: float = FicheServer.timeout
+    max_connections: int = FicheServer.max_connections
+    queue_size: int = FicheServer.queue_size
+    shard_depth: int = 0
+    index_file: Optional[str] = None
+    metrics_port: int = 0
+    rate_limit: float = 0.0  # requests per second per client, 0 to disable
+    byte_rate_limit: int = 0  # bytes per second per client, 0 to disable
+    workers: int = 1
+    worker: Optional[int] = None
     _data_dir: pathlib.Path = pathlib.Path('data/')
     _log_file: Optional[pathlib.Path] = None
     _banlist: Optional[pathlib.Path] = None
@@ -92,82 +110,248 @@ class RecupServer:
         recup.log_file = args.log_file or recup.log_file
         recup.banlist = args.banlist or recup.banlist
         recup.allowlist = args.allowlist or recup.allowlist
+        recup.engine = args.engine or recup.engine
+        recup.timeout = args.timeout or recup.timeout
+        recup.max_connections = args.max_connections or recup.max_connections
+        recup.queue_size = args.queue_size or recup.queue_size
+        recup.shard_depth = args.shard_depth or recup.shard_depth
+        recup.index_file = args.index or recup.index_file
+        recup.metrics_port = args.metrics_port or recup.metrics_port
+        recup.rate_limit = args.rate_limit or recup.rate_limit
+        recup.byte_rate_limit = args.byte_rate_limit or recup.byte_rate_limit
+        recup.workers = args.workers or recup.workers
 
         recup.logger = logging.getLogger('pyfiche')
         recup.logger.setLevel(logging.INFO if not args.debug else logging.DEBUG)
-        handler = logging.StreamHandler() if not args.log_file else logging.FileHandler(args.log_file)
-        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-        recup.logger.addHandler(handler)
+
+        # Servers run together in one process share the logger
+        if not recup.logger.handlers:
+            handler = logging.StreamHandler() if not args.log_file else logging.FileHandler(args.log_file)
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+            recup.logger.addHandler(handler)
 
         return recup
 
     def handle_connection(self, conn, addr):
         self.logger.info(f"Incoming connection from: {addr}")
+        self.metrics.accepted.inc()
+
+        rejection = self.check_access(addr)
+        if rejection:
+            self.send_rejection(conn, rejection)
+            return
+
+        conn.setblocking(False)
+        conn.settimeout(self.timeout)
+        self.metrics.in_flight.inc()
+
+        with conn:
+            self.logger.debug(f"New connection by {addr}")
+
+            try:
+                request = conn.recv(self.buffer_size)
+                self.metrics.received.inc(len(request))
+                paste = self.get_paste(request)
+
+                with paste.open() as file:
+                    if paste.codec:
+                        sent = copy_file(conn.sendall, file)
+                    else:
+                        sent = send_file(conn, file)
+
+                self.metrics.sent.inc(sent)
+                self.ratelimiter.charge(addr[0], sent)
+
+            except (ValueError, FileNotFoundError) as e:
+                self.logger.error(e)
+                conn.close()
 
+            finally:
+                self.metrics.in_flight.dec()
+
+    @property
+    def metrics(self) -> ServerMetrics:
+        if not hasattr(self, '_metrics'):
+            self._metrics = ServerMetrics('recup', worker=self.worker)
+        return self._metrics
+
+    @property
+    def ratelimiter(self) -> RateLimiter:
+        if not hasattr(self, '_ratelimiter'):
+            self._ratelimiter = RateLimiter(self.rate_limit, self.byte_rate_limit)
+        return self._ratelimiter
+
+    def check_access(self, addr) -> Optional[bytes]:
         if self.check_banlist(addr[0]):
-            conn.sendall(b"Your IP address is banned from this server.\n")
             self.logger.info(f"Connections from {addr} are banned.")
-            conn.close()
-            return
+            self.metrics.rejected['banned'].inc()
+            return b"Your IP address is banned from this server.\n"
 
         if not self.check_allowlist(addr[0]):
-            conn.sendall(b"Your IP address is not allowed to connect to this server.\n")
             self.logger.info(f"Connection from {addr} is not allowed.")
+            self.metrics.rejected['not_allowed'].inc()
+            return b"Your IP address is not allowed to connect to this server.\n"
+
+        wait = self.ratelimiter.check(addr[0])
+        if wait is not None:
+            self.logger.info(f"Connection from {addr} is rate limited.")
+            self.metrics.rejected['rate_limited'].inc()
+            return rate_limit_message(wait)
+
+        return None
+
+    def send_rejection(self, conn, message):
+        # The slug is read before closing, as closing a socket with unread
+        # data resets the connection and the message may get lost
+        try:
+            conn.sendall(message)
+            conn.shutdown(socket.SHUT_WR)
+            conn.settimeout(FicheServer.REJECT_DRAIN_TIMEOUT)
+            conn.recv(self.buffer_size)
+        except OSError:
+            pass
+        finally:
             conn.close()
-            return
 
-        conn.setblocking(False)
-        conn.settimeout(3)
+    async def send_rejection_async(self, reader, writer, message):
+        try:
+            writer.write(message)
+            await writer.drain()
+            writer.write_eof()
+            await asyncio.wait_for(reader.read(self.buffer_size), FicheServer.REJECT_DRAIN_TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            pass
 
-        with conn:
-            self.logger.debug(f"New connection by {addr}")
+    def reject_connection(self, conn):
+        self.metrics.rejected['busy'].inc()
+        reject_connection(conn)
 
-            if not self.check_allowlist(addr[0]):
-                conn.sendall(b"Your IP address is not allowed to connect to this server.\n")
-                self.logger.info(f"Connection from {addr} is not allowed.")
-                conn.close()
-                return
+    async def reject_connection_async(self, writer):
+        self.metrics.rejected['busy'].inc()
+        await reject_connection_async(writer)
 
-            if self.check_banlist(addr[0]):
-                conn.sendall(b"Your IP address is banned from this server.\n")
-                self.logger.info(f"Connections from {addr} are banned.")
-                conn.close()
-                return
+    @property
+    def storage(self) -> PasteStorage:
+        if not hasattr(self, '_storage'):
+            self._storage = PasteStorage(
+                self.data_dir, shard_depth=self.shard_depth
+            )
+        return self._storage
 
-            try:
-                slug = conn.recv(self.buffer_size).decode().strip()
+    @property
+    def index(self) -> Optional[PasteIndex]:
+        if self.index_file and not hasattr(self, '_index'):
+            self._index = PasteIndex(self.index_file)
+        return getattr(self, '_index', None)
 
-                if not slug:
-                    raise ValueError('No slug received, terminating connection.')
+    def get_paste(self, request: bytes) -> Paste:
+        slug = request.decode().strip()
 
-                # Check if the received slug matches the allowed pattern.
-                # This should effectively prevent directory traversal attacks.
-                if any([c not in self.FICHE_SYMBOLS for c in slug]):
-                    raise ValueError('Invalid slug received, terminating connection.')
+        if not slug:
+            raise ValueError('No slug received, terminating connection.')
 
-                file_path = self.data_dir / slug / self.DATA_FILE_NAME
-                if not file_path.is_file():
-                    raise FileNotFoundError(f"File with slug '{slug}' not found.")
+        # Check if the received slug matches the allowed pattern.
+        # This should effectively prevent directory traversal attacks.
+        if any([c not in self.FICHE_SYMBOLS for c in slug]):
+            raise ValueError('Invalid slug received, terminating connection.')
 
-                with open(file_path, 'rb') as file:
-                    content = file.read()
-                    conn.sendall(content)
+        info = self.index.get(slug) if self.index else None
 
-            except (ValueError, FileNotFoundError) as e:
-                self.logger.error(e)
-                conn.close()
+        # A complete index knows every paste, so misses don't touch the disk
+        if info is None and self.index and self.index.complete:
+            raise FileNotFoundError(f"File with slug '{slug}' not found.")
+
+        # Expired pastes are gone, even if the reaper hasn't removed them yet
+        if info and info.expired:
+            raise FileNotFoundError(f"File with slug '{slug}' has expired.")
 
-    def start_server(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            s.bind((self.listen_addr, self.port))
-            s.listen()
+        paste = self.storage.find(slug)
+        if paste is None:
+            raise FileNotFoundError(f"File with slug '{slug}' not found.")
+
+        return paste
+
+    async def handle_connection_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info('peername')[:2]
+        self.logger.info(f"Incoming connection from: {addr}")
+        self.metrics.accepted.inc()
+
+        # Checked before counting the connection, as in handle_connection()
+        rejection = self.check_access(addr)
+        if rejection:
+            await self.send_rejection_async(reader, writer, rejection)
+            writer.close()
+            return
+
+        self.metrics.in_flight.inc()
+
+        try:
+            request = await asyncio.wait_for(reader.read(self.buffer_size), self.timeout)
+            self.metrics.received.inc(len(request))
+            paste = self.get_paste(request)
+
+            if paste.codec:
+                # Decompressing is blocking, so keep it off the event loop
+                data = await asyncio.to_thread(paste.read)
+                writer.write(data)
+                await writer.drain()
+                self.metrics.sent.inc(len(data))
+                self.ratelimiter.charge(addr[0], len(data))
+                return
 
+            with paste.open() as file:
+                await writer.drain()
+                # Uses os.sendfile() where possible, falls back to reading
+                # the file in chunks otherwise
+                sent = await asyncio.get_running_loop().sendfile(writer.transport, file, fallback=True)
+                self.metrics.sent.inc(sent)
+                self.ratelimiter.charge(addr[0], sent)
+
+        except asyncio.TimeoutError:
+            self.logger.error('No slug received, terminating connection.')
+
+        except (ValueError, FileNotFoundError) as e:
+            self.logger.error(e)
+
+        except Exception as e:
+            self.logger.error(f"An error occurred: {e}")
+        finally:
+            self.metrics.in_flight.dec()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    def start_server(self, sock=None):
+        if self.engine == 'asyncio':
+            asyncio.run(self.start_server_async(sock))
+            return
+
+        if sock is None:
+            sock = listen_socket(self.listen_addr, self.port)
+
+        with sock as s:
             self.logger.info(f"Server started listening on: {self.listen_addr}:{self.port}")
 
+            pool = WorkerPool(self.handle_connection, self.max_connections, self.queue_size, self.logger, self.reject_connection)
+
             while True:
                 conn, addr = s.accept()
-                threading.Thread(target=self.handle_connection, args=(conn, addr,)).start()
+                pool.submit(conn, addr)
+
+    async def start_server_async(self, sock=None):
+        pool = AsyncWorkerPool(self.handle_connection_async, self.max_connections, self.queue_size, self.logger, self.reject_connection_async)
+
+        if sock is None:
+            sock = listen_socket(self.listen_addr, self.port)
+
+        server = await asyncio.start_server(pool.submit, sock=sock)
+
+        self.logger.info(f"Server started listening on: {self.listen_addr}:{self.port} (asyncio)")
+
+        async with server:
+            await server.serve_forever()
 
     def run(self):
         if not self.logger:
@@ -207,7 +391,23 @@ class RecupServer:
                 self.logger.fatal("Log file not writable!")
                 sys.exit(1)
 
-        self.start_server()
+        # Forked before any thread or database connection exists
+        if self.workers > 1:
+            return Prefork(self.workers, self.logger).run(self.listen_addr, self.port, self.serve)
+
+        return self.serve()
+
+    def serve(self, worker=0, sock=None):
+        if self.workers > 1:
+            self.worker = worker
+
+        if self.index:
+            self.logger.info(f"Using paste index {self.index_file} (complete: {self.index.complete})")
+
+        if self.metrics_port:
+            serve_metrics(self.metrics_port + worker, logger=self.logger)
+
+        self.start_server(sock)
 
         return 0
 
@@ -216,35 +416,18 @@ class RecupServer:
             return True
 
         try:
-            ip = ipaddress.ip_address(addr)
-            with open(self.allowlist_path, 'r') as file:
-                for line in file:
-                    line = line.strip()
-                    if line:
-                        network = ipaddress.ip_network(line, strict=False)
-                        if ip in network:
-                            return True
+            return addr in IPFilter.for_path(self.allowlist_path, self.logger)
         except ValueError as e:
             self.logger.error(f"Invalid IP address or network: {e}")
             return False
 
-        return False
-
     def check_banlist(self, addr):
         if not self.banlist_path:
             return False
 
         try:
-            ip = ipaddress.ip_address(addr)
-            with open(self.banlist_path, 'r') as file:
-                for line in file:
-                    line = line.strip()
-                    if line:
-                        network = ipaddress.ip_network(line, strict=False)
-                        if ip in network:
-                            return True
+            return addr in IPFilter.for_path(self.banlist_path, self.logger)
         except ValueError as e:
             self.logger.error(f"Invalid IP address or network: {e}")
             return False
 
-        return False
\ No newline at end of file
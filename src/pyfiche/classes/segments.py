@@ -0,0 +1,282 @@
+import fcntl
+import os
+import pathlib
+import sqlite3
+import threading
+import time
+
+from typing import Iterator, List, NamedTuple, Optional, Tuple, Union
+
+
+class SegmentEntry(NamedTuple):
+    slug: str
+    segment: int
+    offset: int
+    length: int
+    codec: Optional[str]
+    created: float
+
+
+class SegmentStore:
+    """Small pastes appended to shared segment files.
+
+    Every process appends to a segment of its own and holds an exclusive
+    flock() on it until the segment is full, so a segment nobody holds a
+    lock on is never written to again. Where each paste is kept is recorded
+    in an SQLite database next to the segments; a row without a segment is
+    a slug that has been claimed but has no paste yet.
+
+    Removing a paste only removes its row. compact() copies the pastes
+    still in mostly unused segments to a new segment and deletes the old
+    files."""
+
+    DB_NAME = "index.db"
+    SUFFIX = ".seg"
+    SEGMENT_SIZE = 67108864  # 64 MB
+    # Claims are appended to right after the upload they were made for, so
+    # an older claim without a paste was left behind by a crashed process
+    STALE_CLAIM_AGE = 3600
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            slug TEXT PRIMARY KEY,
+            segment INTEGER,
+            offset INTEGER,
+            length INTEGER,
+            codec TEXT,
+            created REAL NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS entries_segment ON entries (segment);
+        CREATE TABLE IF NOT EXISTS segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created REAL NOT NULL
+        );
+    """
+
+    def __init__(self, root: Union[str, pathlib.Path]):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(exist_ok=True)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Segment this process appends to
+        self._fd: Optional[int] = None
+        self._segment = 0
+        self._offset = 0
+
+        with self.connection as db:
+            db.executescript(self.SCHEMA)
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # Same settings as PasteIndex
+        db = getattr(self._local, "db", None)
+
+        if db is None:
+            db = sqlite3.connect(self.root / self.DB_NAME, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+
+        return db
+
+    def segment_path(self, segment: int) -> pathlib.Path:
+        return self.root / f"{segment:08d}{self.SUFFIX}"
+
+    def claim(self, slug: str) -> None:
+        try:
+            with self.connection as db:
+                db.execute(
+                    "INSERT INTO entries (slug, created) VALUES (?, ?)",
+                    (slug, time.time()),
+                )
+        except sqlite3.IntegrityError:
+            raise FileExistsError(f"Slug {slug} is taken")
+
+    def release(self, slug: str) -> None:
+        with self.connection as db:
+            db.execute(
+                "DELETE FROM entries WHERE slug = ? AND segment IS NULL", (slug,)
+            )
+
+    def sweep(self, max_age: Optional[float] = None) -> int:
+        # Releases claims older than max_age that never got a paste
+        cutoff = time.time() - (self.STALE_CLAIM_AGE if max_age is None else max_age)
+
+        with self.connection as db:
+            return db.execute(
+                "DELETE FROM entries WHERE segment IS NULL AND created < ?",
+                (cutoff,),
+            ).rowcount
+
+    def exists(self, slug: str) -> bool:
+        # Claimed slugs count as well
+        return (
+            self.connection.execute(
+                "SELECT 1 FROM entries WHERE slug = ?", (slug,)
+            ).fetchone()
+            is not None
+        )
+
+    def get(self, slug: str) -> Optional[SegmentEntry]:
+        row = self.connection.execute(
+            "SELECT slug, segment, offset, length, codec, created FROM entries "
+            "WHERE slug = ? AND segment IS NOT NULL",
+            (slug,),
+        ).fetchone()
+
+        return SegmentEntry(*row) if row else None
+
+    def slugs(self) -> Iterator[str]:
+        for row in self.connection.execute(
+            "SELECT slug FROM entries WHERE segment IS NOT NULL"
+        ):
+            yield row[0]
+
+    def append(self, slug: str, data: bytes, codec: Optional[str] = None) -> None:
+        # The data is written before the row points to it; after a crash in
+        # between, it is garbage that compact() reclaims
+        segment, offset = self._write(data)
+
+        with self.connection as db:
+            db.execute(
+                "UPDATE entries SET segment = ?, offset = ?, length = ?, codec = ? "
+                "WHERE slug = ? AND segment IS NULL",
+                (segment, offset, len(data), codec, slug),
+            )
+
+    def read(self, entry: SegmentEntry) -> bytes:
+        try:
+            return self._pread(entry)
+        except FileNotFoundError:
+            # The paste was moved by compact() after it was looked up
+            moved = self.get(entry.slug)
+            if moved is None or moved.segment == entry.segment:
+                raise
+
+            return self._pread(moved)
+
+    def remove(self, slug: str) -> bool:
+        with self.connection as db:
+            return (
+                db.execute(
+                    "DELETE FROM entries WHERE slug = ? AND segment IS NOT NULL",
+                    (slug,),
+                ).rowcount
+                > 0
+            )
+
+    def stats(self) -> Tuple[int, int, int]:
+        # Number of segments, their total size and the bytes still in use
+        used = self.connection.execute(
+            "SELECT COALESCE(SUM(length), 0) FROM entries WHERE segment IS NOT NULL"
+        ).fetchone()[0]
+        sizes = [path.stat().st_size for path in self.root.glob("*" + self.SUFFIX)]
+        return len(sizes), sum(sizes), used
+
+    def compact(self, max_usage: float = 0.5) -> Tuple[int, int]:
+        # Rewrites segments of which at most max_usage is still in use.
+        # Returns the number of segments removed and the bytes reclaimed.
+        self.sweep()
+
+        used = dict(
+            self.connection.execute(
+                "SELECT segment, SUM(length) FROM entries "
+                "WHERE segment IS NOT NULL GROUP BY segment"
+            )
+        )
+        compacted = reclaimed = 0
+
+        for path in sorted(self.root.glob("*" + self.SUFFIX)):
+            segment = int(path.stem)
+            fd = os.open(path, os.O_RDONLY)
+
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Still being appended to
+                    continue
+
+                size = os.fstat(fd).st_size
+                if used.get(segment, 0) > size * max_usage:
+                    continue
+
+                moves = []
+
+                for entry in self.entries(segment):
+                    data = os.pread(fd, entry.length, entry.offset)
+                    new_segment, new_offset = self._write(data)
+                    moves.append(
+                        (new_segment, new_offset, entry.slug, segment, entry.offset)
+                    )
+
+                # Pastes removed in the meantime are not moved back in
+                with self.connection as db:
+                    db.executemany(
+                        "UPDATE entries SET segment = ?, offset = ? "
+                        "WHERE slug = ? AND segment = ? AND offset = ?",
+                        moves,
+                    )
+                    db.execute("DELETE FROM segments WHERE id = ?", (segment,))
+
+                os.unlink(path)
+            finally:
+                os.close(fd)
+
+            compacted += 1
+            reclaimed += size - used.get(segment, 0)
+
+        return compacted, reclaimed
+
+    def entries(self, segment: int) -> List[SegmentEntry]:
+        return [
+            SegmentEntry(*row)
+            for row in self.connection.execute(
+                "SELECT slug, segment, offset, length, codec, created FROM entries "
+                "WHERE segment = ?",
+                (segment,),
+            )
+        ]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _pread(self, entry: SegmentEntry) -> bytes:
+        fd = os.open(self.segment_path(entry.segment), os.O_RDONLY)
+
+        try:
+            return os.pread(fd, entry.length, entry.offset)
+        finally:
+            os.close(fd)
+
+    def _write(self, data: bytes) -> Tuple[int, int]:
+        with self._lock:
+            if self._fd is None or self._offset + len(data) > self.SEGMENT_SIZE:
+                self._roll()
+
+            offset = self._offset
+            os.pwrite(self._fd, data, offset)
+            self._offset += len(data)
+            return self._segment, offset
+
+    def _roll(self) -> None:
+        # Starts a new segment. Closing the full one releases its lock.
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+        with self.connection as db:
+            segment = db.execute(
+                "INSERT INTO segments (created) VALUES (?)", (time.time(),)
+            ).lastrowid
+
+        # Locked before it gets its name, so compact() never finds it unlocked
+        temp = self.root / f".segment-{segment}"
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(temp, self.segment_path(segment))
+
+        self._fd, self._segment, self._offset = fd, segment, 0
@@ -0,0 +1,174 @@
+import logging
+import math
+import secrets
+import threading
+import time
+
+from typing import List, Optional
+
+from .storage import PasteStorage
+
+
+class BloomFilter:
+    """Set of strings with false positives but no false negatives.
+
+    Uses Python's own (per-process salted) string hash, which is cached on
+    the string object and good enough for a filter that is never persisted."""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(capacity, 1)
+        # Optimal number of bits and hash functions for the error rate
+        self.size = math.ceil(
+            -self.capacity * math.log(error_rate) / math.log(2) ** 2
+        )
+        self.hashes = max(round(self.size / self.capacity * math.log(2)), 1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _positions(self, item: str) -> List[int]:
+        # Double hashing: two 32-bit halves of one 64-bit hash
+        value = hash(item)
+        h1, h2 = value & 0xFFFFFFFF, ((value >> 32) & 0xFFFFFFFF) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str) -> None:
+        bits = self._bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        for position in self._positions(item):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class SlugAllocator:
+    """Hands out unused slugs.
+
+    Candidates come from the secrets module and are claimed by creating the
+    paste directory with os.mkdir(), which fails atomically if the slug
+    exists, even if another process (e.g. Lines next to Fiche) created it.
+    A Bloom filter of the existing slugs, loaded in the background, lets
+    most collisions be skipped without a system call. Until it is loaded,
+    os.mkdir() alone decides."""
+
+    MIN_CAPACITY = 1048576
+    MAX_ATTEMPTS = 64
+
+    def __init__(
+        self,
+        storage: PasteStorage,
+        length: int,
+        symbols: str,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.storage = storage
+        self.length = length
+        self.symbols = symbols
+        self.logger = logger or logging.getLogger("pyfiche")
+        self.collisions = 0
+        self._space = len(symbols) ** length
+        self._filter: Optional[BloomFilter] = None
+        self._capacity = self.MIN_CAPACITY
+        # Slugs allocated while the filter is being (re)built
+        self._recent: List[str] = []
+        self._lock = threading.Lock()
+
+    def load(self, background: bool = True) -> None:
+        if background:
+            threading.Thread(
+                target=self.load, args=(False,), name="pyfiche-slugs", daemon=True
+            ).start()
+            return
+
+        # Every worker loads its own filter, so the slugs are streamed into
+        # it rather than listed first. A filter that fills up more than half
+        # is built again with twice the room.
+        started = time.monotonic()
+        capacity = self._capacity
+
+        while True:
+            bloom = BloomFilter(capacity)
+
+            for slug in self.storage.slugs():
+                bloom.add(slug)
+
+                if len(bloom) * 2 > capacity:
+                    break
+            else:
+                break
+
+            capacity *= 2
+
+        self._capacity = capacity
+
+        # Slugs allocated while loading are on disk already, but may have
+        # been missed by the directory scan
+        with self._lock:
+            for slug in self._recent:
+                bloom.add(slug)
+            self._filter = bloom
+            self._recent = []
+
+        self.logger.info(
+            f"Indexed {len(bloom)} existing slugs in "
+            f"{time.monotonic() - started:.2f} seconds"
+        )
+
+    def generate(self) -> str:
+        # One random number per slug, written in base len(symbols)
+        value = secrets.randbelow(self._space)
+        base = len(self.symbols)
+        chars = []
+
+        for _ in range(self.length):
+            value, index = divmod(value, base)
+            chars.append(self.symbols[index])
+
+        return "".join(chars)
+
+    def allocate(self, size: Optional[int] = None) -> str:
+        # The size of the paste decides where it is stored, see
+        # PasteStorage.claim()
+        for _ in range(self.MAX_ATTEMPTS):
+            slug = self.generate()
+
+            if self._filter is not None and slug in self._filter:
+                self.collisions += 1
+                continue
+
+            try:
+                self.storage.claim(slug, size)
+            except FileExistsError:
+                self.collisions += 1
+                self._remember(slug)
+                continue
+
+            self._remember(slug)
+            return slug
+
+        raise RuntimeError(
+            f"No free slug found in {self.MAX_ATTEMPTS} attempts, "
+            "consider a larger slug size"
+        )
+
+    def _remember(self, slug: str) -> None:
+        with self._lock:
+            if self._filter is None:
+                self._recent.append(slug)
+                return
+
+            self._filter.add(slug)
+
+            # Past its capacity, the filter mostly answers "maybe"; rebuild
+            # it from disk with room for twice as many slugs
+            if len(self._filter) > self._filter.capacity:
+                self._capacity = self._filter.capacity * 2
+                self._filter = None
+                self.load()
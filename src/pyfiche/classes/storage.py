@@ -0,0 +1,789 @@
+import codecs
+import gzip
+import hashlib
+import io
+import lzma
+import os
+import pathlib
+import socket
+import tempfile
+import time
+import zlib
+
+from stat import S_IFREG
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
+
+from .cache import PasteCache
+from .segments import SegmentEntry, SegmentStore
+
+SNIFF_SIZE = 65536
+COPY_CHUNK_SIZE = 65536
+GZIP_SUFFIX = ".gz"
+# Suffix of the gzip copy Lines keeps next to a paste (see
+# write_gzip_variant()). It must not end in the suffix of any codec, or a
+# reader could take a variant for the paste itself.
+GZIP_VARIANT_SUFFIX = ".variant" + GZIP_SUFFIX
+
+# Codecs for compressed-at-rest pastes and the suffix added to the file name
+CODECS = {
+    "zlib": ".zz",
+    "lzma": ".xz",
+    "gzip": GZIP_SUFFIX,
+}
+
+# mkstemp() creates files readable by the owner only; pastes should get the
+# same permissions open() would give them. Read once, while still
+# single-threaded, as the umask can only be queried by changing it.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class PasteUpload:
+    """Temporary file an upload is streamed into.
+
+    The file lives in the data directory itself, so that commit() can move
+    it into place with an atomic rename. If the upload is not committed,
+    the temporary file is removed again."""
+
+    TEMP_PREFIX = ".upload-"
+
+    def __init__(
+        self,
+        directory: Union[str, pathlib.Path],
+        codec: Optional[str] = None,
+        digest: bool = False,
+        keep: int = 0,
+    ):
+        fd, self.path = tempfile.mkstemp(prefix=self.TEMP_PREFIX, dir=directory)
+        os.fchmod(fd, 0o666 & ~_UMASK)
+        self.file = os.fdopen(fd, "wb")
+        self.codec = codec
+        self.compressor = make_compressor(codec) if codec else None
+        # Size of the uncompressed data, which is what max_size applies to
+        self.size = 0
+        # Hash of the uncompressed data, used to deduplicate pastes
+        self.hash = hashlib.sha256() if digest else None
+        # Beginning of the uncompressed data, to tell text from binary
+        self.head = b""
+        # Uncompressed data of uploads up to keep bytes, held in memory
+        self.keep = keep
+        self.chunks: Optional[List[bytes]] = [] if keep else None
+        self.committed = False
+
+    def __enter__(self) -> "PasteUpload":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        if not self.committed:
+            self.abort()
+
+    @property
+    def digest(self) -> Optional[str]:
+        return self.hash.hexdigest() if self.hash else None
+
+    @property
+    def data(self) -> Optional[bytes]:
+        return b"".join(self.chunks) if self.chunks is not None else None
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+
+        if self.hash:
+            self.hash.update(data)
+
+        if len(self.head) < SNIFF_SIZE:
+            self.head += data[: SNIFF_SIZE - len(self.head)]
+
+        if self.chunks is not None:
+            if self.size <= self.keep:
+                self.chunks.append(data)
+            else:
+                self.chunks = None
+
+        if self.compressor:
+            data = self.compressor.compress(data)
+
+        self.file.write(data)
+
+    def finish(self) -> None:
+        # Completes the temporary file without moving it anywhere
+        if self.file.closed:
+            return
+
+        if self.compressor:
+            self.file.write(self.compressor.flush())
+
+        self.file.close()
+
+    def commit(self, path: Union[str, pathlib.Path]) -> None:
+        self.finish()
+        os.replace(self.path, path)
+        self.committed = True
+
+    def abort(self) -> None:
+        self.file.close()
+
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    @classmethod
+    def cleanup(cls, directory: Union[str, pathlib.Path], max_age: float) -> int:
+        # Remove temporary files left behind by a crashed process
+        removed = 0
+        cutoff = time.time() - max_age
+
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.startswith(cls.TEMP_PREFIX):
+                    continue
+
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+
+        return removed
+
+
+class Paste:
+    """A stored paste, possibly compressed at rest."""
+
+    # Set for pastes stored in a segment file
+    segment: Optional[int] = None
+
+    def __init__(
+        self, slug: str, path: pathlib.Path, codec: Optional[str], stat: os.stat_result
+    ):
+        self.slug = slug
+        self.path = path
+        self.codec = codec
+        self.stat = stat
+
+    def open(self) -> BinaryIO:
+        # Returns a file object yielding the uncompressed content
+        if self.codec == "gzip":
+            return gzip.open(self.path, "rb")
+
+        if self.codec == "lzma":
+            return lzma.open(self.path, "rb")
+
+        if self.codec == "zlib":
+            return io.BufferedReader(ZlibReader(open(self.path, "rb")))
+
+        return open(self.path, "rb")
+
+    def read(self) -> bytes:
+        with self.open() as file:
+            return file.read()
+
+    @property
+    def validator(self) -> Tuple:
+        # Changes whenever the paste is stored anew, e.g. compressed
+        stat = self.stat
+        return self.path, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+class SegmentPaste(Paste):
+    """A small paste stored in a segment file (see SegmentStore)."""
+
+    def __init__(self, slug: str, store: SegmentStore, entry: SegmentEntry):
+        # Lines builds entity tags and Last-Modified from the stat, so the
+        # creation time stands in for the modification time
+        created = entry.created
+        created_ns = int(created * 1e9)
+        times = (int(created),) * 3 + (created,) * 3 + (created_ns,) * 3
+        paste_stat = os.stat_result(
+            (S_IFREG | 0o644, 0, 0, 1, 0, 0, entry.length) + times
+        )
+
+        path = store.segment_path(entry.segment)
+        super().__init__(slug, path, entry.codec, paste_stat)
+        self.segment = entry.segment
+        self.store = store
+        self.entry = entry
+
+    def open(self) -> BinaryIO:
+        # Read with a single pread(); small enough to decompress in memory
+        return io.BytesIO(decompress(self.store.read(self.entry), self.codec))
+
+    @property
+    def validator(self) -> Tuple:
+        # Changes when compact() moves the paste
+        return self.entry.segment, self.entry.offset
+
+
+class MemoryPaste(Paste):
+    """A stored paste whose content is held in memory (see PasteStorage).
+
+    Everything but the content comes from the paste as stored, so e.g. the
+    entity tags of Lines are the same either way."""
+
+    def __init__(self, paste: Paste, data: bytes):
+        super().__init__(paste.slug, paste.path, paste.codec, paste.stat)
+        self.segment = paste.segment
+        self.data = data
+
+    def open(self) -> BinaryIO:
+        return io.BytesIO(self.data)
+
+    def read(self) -> bytes:
+        return self.data
+
+
+class PasteStorage:
+    """Locates pastes in a data directory and creates new ones.
+
+    With a shard depth of n, pastes live in n levels of directories named
+    after pairs of characters of the slug, e.g. ab/cd/abcdefgh/ for n = 2.
+    Pastes not moved there yet (see migrate()) are still found in the flat
+    layout.
+
+    With dedup enabled, every distinct content is stored once as a blob in
+    BLOB_DIR, named after its SHA-256, and pastes are hard links to their
+    blob. A blob's link count is the number of pastes using it plus one, so
+    a blob with a single link is unused.
+
+    With a segment size limit, pastes up to that size are appended to
+    segment files in SEGMENT_DIR instead (see SegmentStore), which saves
+    a directory, a file and a filesystem block per paste. Dedup only
+    applies to pastes stored as files.
+
+    With a cache size, the content of new pastes is also kept in memory,
+    so every server using the same storage object serves a paste right
+    after its upload without reading it back. Lookups still check the
+    paste on disk (or in its segment) and ignore the cached content once
+    the paste was removed or stored anew."""
+
+    FILE_NAME = "index.txt"
+    BLOB_DIR = ".blobs"
+    SEGMENT_DIR = ".segments"
+    SHARD_WIDTH = 2
+
+    def __init__(
+        self,
+        root: Union[str, pathlib.Path],
+        compression: Optional[str] = None,
+        dedup: bool = False,
+        shard_depth: int = 0,
+        segment_max: int = 0,
+        cache_size: int = 0,
+    ):
+        self.root = pathlib.Path(root)
+        self.compression = compression
+        self.dedup = dedup
+        self.shard_depth = shard_depth
+        self.segment_max = segment_max
+        self.cache = PasteCache(cache_size) if cache_size else None
+
+    @property
+    def segments(self) -> Optional[SegmentStore]:
+        # Also used without a size limit, to find pastes other processes
+        # stored in segments
+        if not hasattr(self, "_segments"):
+            path = self.root / self.SEGMENT_DIR
+
+            if not self.segment_max and not path.is_dir():
+                return None
+
+            self._segments = SegmentStore(path)
+
+        return self._segments
+
+    def fits_segment(self, size: int) -> bool:
+        return 0 < size <= self.segment_max
+
+    def paste_dir(self, slug: str) -> pathlib.Path:
+        width = self.SHARD_WIDTH
+        shards = [slug[i * width : (i + 1) * width] for i in range(self.shard_depth)]
+        return self.root.joinpath(*shards, slug)
+
+    def flat_dir(self, slug: str) -> pathlib.Path:
+        return self.root / slug
+
+    def locations(self, slug: str) -> Tuple[pathlib.Path, ...]:
+        if not self.shard_depth:
+            return (self.flat_dir(slug),)
+
+        # Checking the sharded directory again after missing in the flat one
+        # covers pastes that were migrated in between
+        sharded = self.paste_dir(slug)
+        return sharded, self.flat_dir(slug), sharded
+
+    def paste_path(self, slug: str, codec: Optional[str] = None) -> pathlib.Path:
+        return self.paste_dir(slug) / (self.FILE_NAME + CODECS.get(codec, ""))
+
+    def claim(self, slug: str, size: Optional[int] = None) -> pathlib.Path:
+        # Creates the paste directory, or the segment entry for pastes of
+        # the given size that fit in a segment; raises FileExistsError if
+        # the slug is taken
+        if size is not None and self.fits_segment(size):
+            self.segments.claim(slug)
+
+            # Each side checks the other after claiming, so a slug can't be
+            # taken both in a segment and as a directory
+            if any(os.path.lexists(path) for path in self.locations(slug)):
+                self.segments.release(slug)
+                raise FileExistsError(f"Slug {slug} is taken")
+
+            return self.segments.root
+
+        path = self.paste_dir(slug)
+
+        if self.shard_depth:
+            path.parent.mkdir(parents=True, exist_ok=True)
+
+        os.mkdir(path)
+
+        # migrate() claims the sharded directory before moving a paste, so
+        # a paste still in the flat layout is seen here
+        if (self.shard_depth and os.path.lexists(self.flat_dir(slug))) or (
+            self.segments and self.segments.exists(slug)
+        ):
+            os.rmdir(path)
+            raise FileExistsError(f"Slug {slug} is taken")
+
+        return path
+
+    def release(self, slug: str) -> None:
+        # Gives up a claimed slug that did not get a paste
+        try:
+            os.rmdir(self.paste_dir(slug))
+        except OSError:
+            pass
+
+        if self.segments:
+            self.segments.release(slug)
+
+    def blob_path(self, digest: str, codec: Optional[str] = None) -> pathlib.Path:
+        name = digest + CODECS.get(codec, "")
+        return self.root / self.BLOB_DIR / digest[:2] / name
+
+    def upload(self, digest: bool = False) -> PasteUpload:
+        keep = self.cache.max_entry_bytes if self.cache is not None else 0
+        return PasteUpload(self.root, self.compression, self.dedup or digest, keep)
+
+    def commit(self, upload: PasteUpload, slug: str) -> pathlib.Path:
+        path = self._commit(upload, slug)
+        data = upload.data
+
+        if self.cache is not None and data is not None:
+            paste = self.locate(slug)
+
+            if paste is not None:
+                self.cache.put((slug, "content"), paste.validator, data, len(data))
+
+        return path
+
+    def _commit(self, upload: PasteUpload, slug: str) -> pathlib.Path:
+        # Must match the size the slug was claimed with
+        if self.fits_segment(upload.size):
+            upload.finish()
+
+            with open(upload.path, "rb") as file:
+                self.segments.append(slug, file.read(), upload.codec)
+
+            upload.abort()
+            upload.committed = True
+            return self.segments.root
+
+        path = self.paste_path(slug, upload.codec)
+
+        # Uploads may be hashed for the index only
+        if not self.dedup or upload.digest is None:
+            upload.commit(path)
+            return path
+
+        blob = self.blob_path(upload.digest, upload.codec)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        upload.finish()
+
+        try:
+            # Fails if the same content has been stored before
+            os.link(upload.path, blob)
+        except FileExistsError:
+            try:
+                os.link(blob, path)
+            except FileNotFoundError:
+                # The blob was removed in the meantime, keep our own copy
+                upload.commit(path)
+                return path
+
+            upload.abort()
+            upload.committed = True
+            return path
+
+        upload.commit(path)
+        return path
+
+    def remove(self, slug: str) -> bool:
+        paste = self.find(slug)
+        if paste is None:
+            return False
+
+        if self.cache is not None:
+            self.cache.invalidate(slug)
+
+        if paste.segment is not None:
+            return self.segments.remove(slug)
+
+        blob = None
+
+        if paste.stat.st_nlink > 1:
+            with paste.open() as file:
+                blob = self.blob_path(hash_file(file), paste.codec)
+
+        # Also removes variants like the gzip copy written by Lines
+        for path in paste.path.parent.iterdir():
+            path.unlink()
+        paste.path.parent.rmdir()
+
+        if blob is not None:
+            self.release_blob(blob)
+
+        return True
+
+    def release_blob(self, blob: pathlib.Path) -> bool:
+        # Pastes are hard links, so even if another paste links to the blob
+        # right after the check, unlinking the blob never removes its data
+        try:
+            if os.stat(blob).st_nlink == 1:
+                os.unlink(blob)
+                return True
+        except FileNotFoundError:
+            pass
+
+        return False
+
+    def collect(self) -> int:
+        # Removes unused blobs, e.g. after paste directories were deleted by
+        # hand
+        blob_dir = self.root / self.BLOB_DIR
+        if not blob_dir.is_dir():
+            return 0
+
+        return sum(
+            self.release_blob(blob)
+            for shard in blob_dir.iterdir()
+            for blob in shard.iterdir()
+        )
+
+    def cleanup(self, max_age: float) -> int:
+        # Removes temporary files left behind by crashed processes, also in
+        # paste directories, where older versions of Lines wrote compressed
+        # variants. Visits every paste, unlike PasteUpload.cleanup().
+        removed = 0
+
+        for directory, dirs, _ in os.walk(self.root):
+            # Blobs and segments are not written through temporary files
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            removed += PasteUpload.cleanup(directory, max_age)
+
+        return removed
+
+    def find(self, slug: str) -> Optional[Paste]:
+        paste = self.locate(slug)
+
+        if paste is None or self.cache is None:
+            return paste
+
+        data = self.cache.get((slug, "content"), paste.validator)
+        return MemoryPaste(paste, data) if data is not None else paste
+
+    def locate(self, slug: str) -> Optional[Paste]:
+        # Finds the paste as stored, without looking at the cache
+        if self.segments:
+            entry = self.segments.get(slug)
+            if entry is not None:
+                return SegmentPaste(slug, self.segments, entry)
+
+        for directory in self.locations(slug):
+            for codec in (None, *CODECS):
+                path = directory / (self.FILE_NAME + CODECS.get(codec, ""))
+
+                try:
+                    stat = os.stat(path)
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+
+                return Paste(slug, path, codec, stat)
+
+        return None
+
+    def slugs(self) -> Iterator[str]:
+        yield from self.scan(self.root, self.shard_depth)
+
+        if self.segments:
+            yield from self.segments.slugs()
+
+    def scan(self, directory: Union[str, pathlib.Path], depth: int) -> Iterator[str]:
+        # Shard directories are recognised by their length, so slugs must be
+        # longer than SHARD_WIDTH when sharding is enabled
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.is_dir() or entry.name.startswith("."):
+                    continue
+
+                if depth and len(entry.name) == self.SHARD_WIDTH:
+                    yield from self.scan(entry.path, depth - 1)
+                else:
+                    yield entry.name
+
+    def flat_slugs(self) -> Iterator[str]:
+        # Pastes not migrated to the sharded layout yet
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if (
+                    entry.is_dir()
+                    and not entry.name.startswith(".")
+                    and len(entry.name) != self.SHARD_WIDTH
+                ):
+                    yield entry.name
+
+    def migrate(self, slug: str) -> bool:
+        # Moves a paste from the flat layout into its shard directory while
+        # the servers keep running: the sharded directory is claimed first,
+        # then the files are moved one by one with rename(), which readers
+        # see either before or after
+        source = self.flat_dir(slug)
+        target = self.paste_dir(slug)
+
+        if not self.shard_depth or not source.is_dir():
+            return False
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+
+        try:
+            os.mkdir(target)
+        except FileExistsError:
+            return False
+
+        while True:
+            for entry in os.scandir(source):
+                os.rename(entry.path, target / entry.name)
+
+            try:
+                os.rmdir(source)
+                return True
+            except OSError:
+                # A file (e.g. a gzip variant) was added in the meantime
+                continue
+
+    def compress(self, slug: str, codec: str) -> Optional[Tuple[int, int]]:
+        # Compresses an uncompressed paste in place, keeping its modification
+        # time. Returns the sizes before and after, or None if there was
+        # nothing to do.
+        paste = self.find(slug)
+        if paste is None or paste.codec is not None or paste.segment is not None:
+            return None
+
+        # Deduplicated pastes share their file with other pastes
+        if paste.stat.st_nlink > 1:
+            return None
+
+        path = paste.path.with_name(self.FILE_NAME + CODECS[codec])
+
+        with paste.open() as file, PasteUpload(self.root, codec) as upload:
+            while chunk := file.read(COPY_CHUNK_SIZE):
+                upload.write(chunk)
+
+            upload.commit(path)
+
+        os.utime(path, ns=(paste.stat.st_atime_ns, paste.stat.st_mtime_ns))
+        os.unlink(paste.path)
+        return paste.stat.st_size, os.stat(path).st_size
+
+
+class ZlibReader(io.RawIOBase):
+    """Streaming reader for zlib-compressed files (the stdlib has gzip.open()
+    and lzma.open(), but nothing for a bare zlib stream)."""
+
+    def __init__(self, file: BinaryIO):
+        self._file = file
+        self._decompressor = zlib.decompressobj()
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while not self._buffer:
+            if self._decompressor.eof:
+                return 0
+
+            chunk = self._file.read(COPY_CHUNK_SIZE)
+
+            if not chunk:
+                self._buffer = self._decompressor.flush()
+                if not self._buffer:
+                    return 0
+                break
+
+            self._buffer = self._decompressor.decompress(chunk)
+
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self) -> None:
+        self._file.close()
+        super().close()
+
+
+def hash_file(file: BinaryIO) -> str:
+    digest = hashlib.sha256()
+
+    while chunk := file.read(COPY_CHUNK_SIZE):
+        digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def decompress(data: bytes, codec: Optional[str]) -> bytes:
+    if codec == "gzip":
+        return gzip.decompress(data)
+
+    if codec == "lzma":
+        return lzma.decompress(data)
+
+    if codec == "zlib":
+        return zlib.decompress(data)
+
+    return data
+
+
+def make_compressor(codec: str):
+    if codec == "gzip":
+        # wbits=31 produces a gzip container; its header has no mtime, so the
+        # output is the same for the same input
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    if codec == "zlib":
+        return zlib.compressobj(6)
+
+    if codec == "lzma":
+        return lzma.LZMACompressor()
+
+    raise ValueError(f"Unknown compression codec: {codec}")
+
+
+def sniff_binary(data: bytes, complete: bool = True) -> bool:
+    # Pass complete=False when data is only the beginning of a file, so a
+    # multi-byte character cut off at the end is not mistaken for binary.
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(data, final=complete)
+        return False
+    except UnicodeDecodeError:
+        return True
+
+
+# Signatures of common binary formats; everything else is text/plain or
+# application/octet-stream, depending on sniff_binary()
+MIME_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"%PDF-", "application/pdf"),
+    (b"PK\x03\x04", "application/zip"),
+    (b"\x1f\x8b", "application/gzip"),
+    (b"\xfd7zXZ\x00", "application/x-xz"),
+    (b"BZh", "application/x-bzip2"),
+    (b"\x7fELF", "application/x-executable"),
+)
+
+
+def detect_mime(data: bytes, binary: bool) -> str:
+    if not binary:
+        return "text/plain"
+
+    for signature, mime in MIME_SIGNATURES:
+        if data.startswith(signature):
+            return mime
+
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+
+    return "application/octet-stream"
+
+
+def send_file(
+    conn: Union[socket.socket, BinaryIO],
+    file: BinaryIO,
+    offset: int = 0,
+    count: Optional[int] = None,
+) -> int:
+    # socket.sendfile() uses os.sendfile() where the platform supports it and
+    # falls back to send() on its own otherwise. That fallback (always taken
+    # for in-memory files) only seeks for a non-zero offset, so position the
+    # file here in case it has been read from already, e.g. to sniff its type.
+    # Objects without sendfile() (e.g. buffered writers) get a plain copy loop.
+    file.seek(offset)
+
+    if hasattr(conn, "sendfile"):
+        return conn.sendfile(file, offset, count)
+
+    return copy_file(getattr(conn, "sendall", None) or conn.write, file, count)
+
+
+def copy_file(write, file: BinaryIO, count: Optional[int] = None) -> int:
+    # Never hand decompressing readers (Paste.open() of a compressed paste) to
+    # send_file(): GzipFile and LZMAFile expose the fileno() of the compressed
+    # file, which os.sendfile() would happily send as is.
+    sent = 0
+
+    while count is None or sent < count:
+        size = COPY_CHUNK_SIZE if count is None else min(COPY_CHUNK_SIZE, count - sent)
+        chunk = file.read(size)
+        if not chunk:
+            break
+
+        write(chunk)
+        sent += len(chunk)
+
+    return sent
+
+
+def write_gzip_variant(
+    paste: Paste,
+    gzip_path: Union[str, pathlib.Path],
+    min_ratio: float = 0.9,
+    temp_dir: Optional[Union[str, pathlib.Path]] = None,
+) -> bool:
+    # Writes a gzip-compressed copy of a text paste next to it. Binary pastes
+    # and pastes that don't shrink below min_ratio get an empty file instead,
+    # so the decision is made only once. Returns whether a usable variant
+    # was written. The copy is written in temp_dir (by default the directory
+    # of gzip_path) first; give the storage root so that PasteUpload.cleanup()
+    # at startup finds it after a crash.
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    # See make_compressor(); variants are written once, so use the best level
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    size = 0
+
+    with paste.open() as file, PasteUpload(
+        temp_dir or pathlib.Path(gzip_path).parent
+    ) as upload:
+        try:
+            while chunk := file.read(COPY_CHUNK_SIZE):
+                decoder.decode(chunk)
+                upload.write(compressor.compress(chunk))
+                size += len(chunk)
+
+            decoder.decode(b"", final=True)
+            upload.write(compressor.flush())
+            usable = upload.size < size * min_ratio
+        except UnicodeDecodeError:
+            usable = False
+
+        if not usable:
+            upload.file.truncate(0)
+            upload.file.seek(0)
+
+        upload.commit(gzip_path)
+
+    return usable
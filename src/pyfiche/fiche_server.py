@@ -23,7 +23,24 @@ def main():
     parser.add_argument('-b', '--banlist', help='Banlist file path')
     parser.add_argument('-w', '--allowlist', help='Allowlist file path')
     parser.add_argument('-D', '--debug', action='store_true', help='Debug mode')
-    parser.add_argument('-t', '--timeout', type=int, help='Timeout for incoming connections (in seconds)')
+    parser.add_argument('-t', '--timeout', type=float, help='Maximum idle time before an upload is considered complete (in seconds) (default: 3)')
+    parser.add_argument('-m', '--min_timeout', type=float, help='Minimum idle time once a client has started sending data (in seconds) (default: 1)')
+    parser.add_argument('-T', '--deadline', type=float, help='Maximum total duration of an upload (in seconds), 0 to disable (default: 60)')
+    parser.add_argument('-e', '--engine', choices=FicheServer.ENGINES, help='Connection engine (default: threading)')
+    parser.add_argument('-c', '--max_connections', type=int, help='Maximum number of connections handled at once (default: 64)')
+    parser.add_argument('-q', '--queue_size', type=int, help='Maximum number of connections waiting to be handled (default: 128)')
+    parser.add_argument('-I', '--max_inflight', type=int, help='Maximum number of upload bytes held in memory across all connections, 0 to disable (default: 104857600)')
+    parser.add_argument('-z', '--compression', choices=FicheServer.COMPRESSION_CODECS, help='Compress pastes on disk with this codec (default: none)')
+    parser.add_argument('-x', '--dedup', action='store_true', help='Store identical pastes only once')
+    parser.add_argument('-n', '--shard_depth', type=int, help='Number of directory levels pastes are spread over, 0 for a flat layout (default: 0)')
+    parser.add_argument('-i', '--index', help='SQLite database to record paste metadata in (default: None - no index)')
+    parser.add_argument('-g', '--segment_max', type=int, help='Append pastes up to this size (in bytes) to shared segment files instead of storing each in its own directory, 0 to disable (default: 0)')
+    parser.add_argument('-E', '--expiry', type=int, help='Time after which pastes expire (in seconds), requires an index, 0 to keep pastes forever (default: 0)')
+    parser.add_argument('-R', '--reap_interval', type=float, help='Time between removals of expired pastes (in seconds), 0 to disable (default: 60)')
+    parser.add_argument('-P', '--metrics_port', type=int, help='Serve Prometheus metrics on this port of 127.0.0.1 (default: None - no metrics)')
+    parser.add_argument('-r', '--rate_limit', type=float, help='Maximum number of uploads per second per client address, with bursts of up to 10 seconds worth (default: 0 - no limit)')
+    parser.add_argument('-y', '--byte_rate_limit', type=int, help='Maximum number of uploaded bytes per second per client address (default: 0 - no limit)')
+    parser.add_argument('-W', '--workers', type=int, help='Number of worker processes sharing the port, restarted if they exit; limits and metrics are per worker (default: 1)')
     parser.add_argument('-u', '--user_name', help=argparse.SUPPRESS)
 
     # Parse the arguments
@@ -43,6 +60,23 @@ def main():
     allowlist = os.environ.get('PYFICHE_ALLOWLIST', None)
     debug = os.environ.get('PYFICHE_DEBUG', False)
     timeout = os.environ.get('PYFICHE_TIMEOUT', None)
+    min_timeout = os.environ.get('PYFICHE_MIN_TIMEOUT', None)
+    deadline = os.environ.get('PYFICHE_DEADLINE', None)
+    compression = os.environ.get('PYFICHE_COMPRESSION', 'none')
+    dedup = os.environ.get('PYFICHE_DEDUP', False)
+    shard_depth = os.environ.get('PYFICHE_SHARD_DEPTH', 0)
+    index = os.environ.get('PYFICHE_INDEX', None)
+    segment_max = os.environ.get('PYFICHE_SEGMENT_MAX', 0)
+    expiry = os.environ.get('PYFICHE_EXPIRY', 0)
+    reap_interval = os.environ.get('PYFICHE_REAP_INTERVAL', None)
+    metrics_port = os.environ.get('PYFICHE_METRICS_PORT', 0)
+    rate_limit = os.environ.get('PYFICHE_RATE_LIMIT', 0)
+    workers = os.environ.get('PYFICHE_WORKERS', 1)
+    byte_rate_limit = os.environ.get('PYFICHE_BYTE_RATE_LIMIT', 0)
+    engine = os.environ.get('PYFICHE_ENGINE', 'threading')
+    max_connections = os.environ.get('PYFICHE_MAX_CONNECTIONS', 64)
+    queue_size = os.environ.get('PYFICHE_QUEUE_SIZE', 128)
+    max_inflight = os.environ.get('PYFICHE_MAX_INFLIGHT', 104857600)
 
     # Set the arguments
     args.domain = args.domain or domain
@@ -57,7 +91,24 @@ def main():
     args.banlist = args.banlist or banlist
     args.allowlist = args.allowlist or allowlist
     args.debug = args.debug or bool(debug)
-    args.timeout = args.timeout or timeout
+    args.timeout = args.timeout or (float(timeout) if timeout else None)
+    args.min_timeout = args.min_timeout or (float(min_timeout) if min_timeout else None)
+    args.compression = args.compression or compression
+    args.dedup = args.dedup or bool(dedup)
+    args.shard_depth = args.shard_depth or int(shard_depth)
+    args.index = args.index or index
+    args.segment_max = args.segment_max or int(segment_max)
+    args.expiry = args.expiry or int(expiry)
+    args.metrics_port = args.metrics_port or int(metrics_port)
+    args.rate_limit = args.rate_limit or float(rate_limit)
+    args.workers = args.workers or int(workers)
+    args.byte_rate_limit = args.byte_rate_limit or int(byte_rate_limit)
+    args.reap_interval = args.reap_interval if args.reap_interval is not None else (float(reap_interval) if reap_interval else None)
+    args.deadline = args.deadline if args.deadline is not None else (float(deadline) if deadline else None)
+    args.engine = args.engine or engine
+    args.max_connections = args.max_connections or int(max_connections)
+    args.queue_size = args.queue_size or int(queue_size)
+    args.max_inflight = args.max_inflight if args.max_inflight is not None else int(max_inflight)
 
     # Create a Fiche object
     fiche = FicheServer.from_args(args)
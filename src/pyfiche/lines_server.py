@@ -3,7 +3,7 @@ import sys
 import os
 import threading
 
-from . import LinesServer
+from . import LinesServer, FicheServer
 
 # Define the main function
 def main():
@@ -18,6 +18,23 @@ def main():
     parser.add_argument('-b', '--banlist', help='Banlist file path')
     parser.add_argument('-w', '--allowlist', help='Allowlist file path')
     parser.add_argument('-M', '--max_size', type=int, help='Maximum file size (in bytes) (default: 5242880)')
+    parser.add_argument('-s', '--slug_size', type=int, help='Length of slugs to generate (default: 8)')
+    parser.add_argument('-c', '--max_connections', type=int, help='Maximum number of connections handled at once (default: 64)')
+    parser.add_argument('-q', '--queue_size', type=int, help='Maximum number of connections waiting to be handled (default: 128)')
+    parser.add_argument('-k', '--keepalive_timeout', type=float, help='Time after which idle keep-alive connections are closed (in seconds) (default: 5)')
+    parser.add_argument('-C', '--cache_size', type=int, help='Maximum size of the in-memory paste cache (in bytes), 0 to disable (default: 67108864)')
+    parser.add_argument('-z', '--compression', choices=FicheServer.COMPRESSION_CODECS, help='Compress pastes uploaded through Lines on disk with this codec (default: none)')
+    parser.add_argument('-x', '--dedup', action='store_true', help='Store identical pastes uploaded through Lines only once')
+    parser.add_argument('-n', '--shard_depth', type=int, help='Number of directory levels pastes are spread over, 0 for a flat layout (default: 0)')
+    parser.add_argument('-i', '--index', help='SQLite paste index to record and look up pastes in (default: None - no index)')
+    parser.add_argument('-g', '--segment_max', type=int, help='Append pastes up to this size (in bytes) uploaded through Lines to shared segment files, 0 to disable (default: 0)')
+    parser.add_argument('-E', '--expiry', type=int, help='Time after which pastes expire (in seconds), requires an index; clients may ask for less with the expires parameter, 0 to keep pastes forever (default: 0)')
+    parser.add_argument('-R', '--reap_interval', type=float, help='Time between removals of expired pastes (in seconds), 0 to disable (default: 60)')
+    parser.add_argument('-P', '--metrics_port', type=int, help='Serve Prometheus metrics on this port of 127.0.0.1 (default: None - no metrics)')
+    parser.add_argument('-A', '--metrics_path', help='Also serve Prometheus metrics on this path of the Lines server, e.g. /metrics (default: None)')
+    parser.add_argument('-r', '--rate_limit', type=float, help='Maximum number of requests per second per client address, with bursts of up to 10 seconds worth (default: 0 - no limit)')
+    parser.add_argument('-y', '--byte_rate_limit', type=int, help='Maximum number of uploaded and downloaded bytes per second per client address (default: 0 - no limit)')
+    parser.add_argument('-W', '--workers', type=int, help='Number of worker processes sharing the port, restarted if they exit; limits and metrics are per worker (default: 1)')
     parser.add_argument('-D', '--debug', action='store_true', help='Debug mode')
 
     # Parse the arguments
@@ -31,7 +48,24 @@ def main():
     banlist = os.environ.get('PYFICHE_LINES_BANLIST', os.environ.get('PYFICHE_BANLIST', None))
     allowlist = os.environ.get('PYFICHE_LINES_ALLOWLIST', os.environ.get('PYFICHE_ALLOWLIST', None))
     max_size = os.environ.get('PYFICHE_LINES_MAX_SIZE', os.environ.get('PYFICHE_MAX_SIZE', 5242880))
+    slug_size = os.environ.get('PYFICHE_LINES_SLUG_SIZE', os.environ.get('PYFICHE_SLUG_SIZE', 8))
     debug = os.environ.get('PYFICHE_LINES_DEBUG', os.environ.get('PYFICHE_DEBUG', False))    
+    max_connections = os.environ.get('PYFICHE_LINES_MAX_CONNECTIONS', os.environ.get('PYFICHE_MAX_CONNECTIONS', 64))
+    queue_size = os.environ.get('PYFICHE_LINES_QUEUE_SIZE', os.environ.get('PYFICHE_QUEUE_SIZE', 128))
+    keepalive_timeout = os.environ.get('PYFICHE_LINES_KEEPALIVE_TIMEOUT', 5)
+    cache_size = os.environ.get('PYFICHE_LINES_CACHE_SIZE', 67108864)
+    compression = os.environ.get('PYFICHE_LINES_COMPRESSION', os.environ.get('PYFICHE_COMPRESSION', 'none'))
+    dedup = os.environ.get('PYFICHE_LINES_DEDUP', os.environ.get('PYFICHE_DEDUP', False))
+    shard_depth = os.environ.get('PYFICHE_LINES_SHARD_DEPTH', os.environ.get('PYFICHE_SHARD_DEPTH', 0))
+    index = os.environ.get('PYFICHE_LINES_INDEX', os.environ.get('PYFICHE_INDEX', None))
+    segment_max = os.environ.get('PYFICHE_LINES_SEGMENT_MAX', os.environ.get('PYFICHE_SEGMENT_MAX', 0))
+    expiry = os.environ.get('PYFICHE_LINES_EXPIRY', os.environ.get('PYFICHE_EXPIRY', 0))
+    metrics_port = os.environ.get('PYFICHE_LINES_METRICS_PORT', 0)
+    metrics_path = os.environ.get('PYFICHE_LINES_METRICS_PATH', None)
+    workers = os.environ.get('PYFICHE_LINES_WORKERS', os.environ.get('PYFICHE_WORKERS', 1))
+    rate_limit = os.environ.get('PYFICHE_LINES_RATE_LIMIT', os.environ.get('PYFICHE_RATE_LIMIT', 0))
+    byte_rate_limit = os.environ.get('PYFICHE_LINES_BYTE_RATE_LIMIT', os.environ.get('PYFICHE_BYTE_RATE_LIMIT', 0))
+    reap_interval = os.environ.get('PYFICHE_LINES_REAP_INTERVAL', os.environ.get('PYFICHE_REAP_INTERVAL', None))
 
     # Set the arguments
     args.port = args.port or int(port)
@@ -40,8 +74,25 @@ def main():
     args.log_file = args.log_file or log_file
     args.banlist = args.banlist or banlist
     args.allowlist = args.allowlist or allowlist
-    args.max_size = args.max_size or max_size
+    args.max_size = args.max_size or int(max_size)
+    args.slug_size = args.slug_size or int(slug_size)
     args.debug = args.debug or bool(debug)
+    args.max_connections = args.max_connections or int(max_connections)
+    args.queue_size = args.queue_size or int(queue_size)
+    args.keepalive_timeout = args.keepalive_timeout or float(keepalive_timeout)
+    args.cache_size = args.cache_size if args.cache_size is not None else int(cache_size)
+    args.compression = args.compression or compression
+    args.dedup = args.dedup or bool(dedup)
+    args.shard_depth = args.shard_depth or int(shard_depth)
+    args.index = args.index or index
+    args.segment_max = args.segment_max or int(segment_max)
+    args.expiry = args.expiry or int(expiry)
+    args.metrics_port = args.metrics_port or int(metrics_port)
+    args.metrics_path = args.metrics_path or metrics_path
+    args.workers = args.workers or int(workers)
+    args.rate_limit = args.rate_limit or float(rate_limit)
+    args.byte_rate_limit = args.byte_rate_limit or int(byte_rate_limit)
+    args.reap_interval = args.reap_interval if args.reap_interval is not None else (float(reap_interval) if reap_interval else None)
 
     # Create a Lines object
     lines = LinesServer.from_args(args)
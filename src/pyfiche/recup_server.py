@@ -33,8 +33,61 @@ def main():
     parser.add_argument(
         "-t",
         "--timeout",
+        type=float,
+        help="Timeout for incoming connections (in seconds) (default: 3)",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=RecupServer.ENGINES,
+        help="Connection engine (default: threading)",
+    )
+    parser.add_argument(
+        "-c",
+        "--max_connections",
+        type=int,
+        help="Maximum number of connections handled at once (default: 64)",
+    )
+    parser.add_argument(
+        "-q",
+        "--queue_size",
+        type=int,
+        help="Maximum number of connections waiting to be handled (default: 128)",
+    )
+    parser.add_argument(
+        "-i",
+        "--index",
+        help="SQLite paste index to look up pastes in (default: None - no index)",
+    )
+    parser.add_argument(
+        "-n",
+        "--shard_depth",
+        type=int,
+        help="Number of directory levels pastes are spread over, 0 for a flat layout (default: 0)",
+    )
+    parser.add_argument(
+        "-P",
+        "--metrics_port",
+        type=int,
+        help="Serve Prometheus metrics on this port of 127.0.0.1 (default: None - no metrics)",
+    )
+    parser.add_argument(
+        "-r",
+        "--rate_limit",
+        type=float,
+        help="Maximum number of requests per second per client address, with bursts of up to 10 seconds worth (default: 0 - no limit)",
+    )
+    parser.add_argument(
+        "-y",
+        "--byte_rate_limit",
         type=int,
-        help="Timeout for incoming connections (in seconds)",
+        help="Maximum number of downloaded bytes per second per client address (default: 0 - no limit)",
+    )
+    parser.add_argument(
+        "-W",
+        "--workers",
+        type=int,
+        help="Number of worker processes sharing the port, restarted if they exit; limits and metrics are per worker (default: 1)",
     )
 
     # Parse the arguments
@@ -61,7 +114,33 @@ def main():
     debug = os.environ.get(
         "PYFICHE_RECUP_DEBUG", os.environ.get("PYFICHE_DEBUG", False)
     )
-    timeout = os.environ.get("PYFICHE_RECUP_TIMEOUT", None)
+    timeout = os.environ.get(
+        "PYFICHE_RECUP_TIMEOUT", os.environ.get("PYFICHE_TIMEOUT", None)
+    )
+    engine = os.environ.get(
+        "PYFICHE_RECUP_ENGINE", os.environ.get("PYFICHE_ENGINE", "threading")
+    )
+
+    max_connections = os.environ.get(
+        "PYFICHE_RECUP_MAX_CONNECTIONS", os.environ.get("PYFICHE_MAX_CONNECTIONS", 64)
+    )
+    queue_size = os.environ.get(
+        "PYFICHE_RECUP_QUEUE_SIZE", os.environ.get("PYFICHE_QUEUE_SIZE", 128)
+    )
+    shard_depth = os.environ.get(
+        "PYFICHE_RECUP_SHARD_DEPTH", os.environ.get("PYFICHE_SHARD_DEPTH", 0)
+    )
+    index = os.environ.get("PYFICHE_RECUP_INDEX", os.environ.get("PYFICHE_INDEX", None))
+    metrics_port = os.environ.get("PYFICHE_RECUP_METRICS_PORT", 0)
+    workers = os.environ.get(
+        "PYFICHE_RECUP_WORKERS", os.environ.get("PYFICHE_WORKERS", 1)
+    )
+    rate_limit = os.environ.get(
+        "PYFICHE_RECUP_RATE_LIMIT", os.environ.get("PYFICHE_RATE_LIMIT", 0)
+    )
+    byte_rate_limit = os.environ.get(
+        "PYFICHE_RECUP_BYTE_RATE_LIMIT", os.environ.get("PYFICHE_BYTE_RATE_LIMIT", 0)
+    )
 
     # Set the arguments
     args.port = args.port or int(port)
@@ -72,7 +151,16 @@ def main():
     args.banlist = args.banlist or banlist
     args.allowlist = args.allowlist or allowlist
     args.debug = args.debug or bool(debug)
-    args.timeout = args.timeout or timeout
+    args.timeout = args.timeout or (float(timeout) if timeout else None)
+    args.engine = args.engine or engine
+    args.max_connections = args.max_connections or int(max_connections)
+    args.queue_size = args.queue_size or int(queue_size)
+    args.shard_depth = args.shard_depth or int(shard_depth)
+    args.index = args.index or index
+    args.metrics_port = args.metrics_port or int(metrics_port)
+    args.rate_limit = args.rate_limit or float(rate_limit)
+    args.byte_rate_limit = args.byte_rate_limit or int(byte_rate_limit)
+    args.workers = args.workers or int(workers)
 
     # Create a Recup object
     recup = RecupServer.from_args(args)
@@ -0,0 +1,67 @@
+import http.client
+import logging
+import threading
+
+import pytest
+
+from pyfiche.classes.lines import LinesHTTPServer, make_lines_handler
+from pyfiche.classes.storage import PasteStorage
+
+# Longer than SNIFF_SIZE, so sniffing the type does not read the whole paste
+CONTENT = b"".join(b"line %d of a paste\n" % i for i in range(1000))
+
+
+@pytest.fixture(params=["file", "zlib", "segment"])
+def lines(request, tmp_path):
+    # Without a cache, pastes are always sent from the file object
+    if request.param == "segment":
+        storage = PasteStorage(tmp_path, segment_max=len(CONTENT))
+    elif request.param == "zlib":
+        storage = PasteStorage(tmp_path, compression="zlib")
+    else:
+        storage = PasteStorage(tmp_path)
+
+    handler = make_lines_handler(tmp_path, logging.getLogger("test"), storage=storage)
+    server = LinesHTTPServer(("127.0.0.1", 0), handler, 4, 4)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server.server_address
+
+    server.shutdown()
+    server.server_close()
+
+
+def request(address, method, path, body=None, headers={}):
+    conn = http.client.HTTPConnection(*address, timeout=5)
+
+    try:
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        return response, response.read()
+    finally:
+        conn.close()
+
+
+def upload(address) -> str:
+    response, _ = request(address, "POST", "/", CONTENT)
+    assert response.status == 303
+    return response.getheader("Location")
+
+
+def test_raw(lines):
+    response, body = request(lines, "GET", upload(lines) + "/raw")
+
+    assert response.status == 200
+    assert response.getheader("Content-Length") == str(len(CONTENT))
+    assert body == CONTENT
+
+
+@pytest.mark.parametrize("start,end", [(0, 9), (0, 2047), (10, 19), (100, 5000)])
+def test_raw_range(lines, start, end):
+    headers = {"Range": f"bytes={start}-{end}"}
+    response, body = request(lines, "GET", upload(lines) + "/raw", headers=headers)
+
+    assert response.status == 206
+    assert response.getheader("Content-Range") == f"bytes {start}-{end}/{len(CONTENT)}"
+    assert body == CONTENT[start : end + 1]